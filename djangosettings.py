@@ -337,6 +337,11 @@ MAXCPUTIME = None        # limit in seconds, use None for unlimited
 # Max total log files size in MB, if the limit is reached deletes the oldest.
 MAXTOTALLOGFILESIZE = 200
 
+# Maximum number of tasks executed at the same time in a database.
+# Only exports and imports run in parallel with other tasks. Generating a
+# plan and the other tasks run one after the other.
+MAXWORKERS = 4
+
 # A list of available user interface themes.
 # If multiple themes are configured in this list, the user's can change their
 # preferences among the ones listed here.
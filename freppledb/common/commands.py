@@ -20,6 +20,7 @@ from importlib import import_module
 from operator import attrgetter
 import os
 import sys
+from time import time, process_time
 import logging
 
 if __name__ == "__main__":
@@ -31,7 +32,7 @@ from django.conf import settings
 from django.db import DEFAULT_DB_ALIAS
 from django.utils.encoding import force_text
 
-from freppledb.execute.models import Task
+from freppledb.execute.models import Task, TaskStep
 
 logger = logging.getLogger(__name__)
 
@@ -105,6 +106,7 @@ class PlanTaskRegistry:
   @classmethod
   def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
     cls.task = None
+    cls.profiles = []
     if 'FREPPLE_TASKID' in os.environ:
       try:
         cls.task = Task.objects.all().using(database).get(pk=os.environ['FREPPLE_TASKID'])
@@ -114,6 +116,9 @@ class PlanTaskRegistry:
       cls.task.status = 'Cancelled'
       cls.task.save(using=database)
       sys.exit(2)
+    if cls.task:
+      # Profiles of a previous run of the task are replaced
+      TaskStep.objects.using(database).filter(task=cls.task).delete()
 
     # Collect the list of tasks
     task_weights = 0
@@ -131,21 +136,29 @@ class PlanTaskRegistry:
     try:
       progress = 0
       for step in task_list:
-        # Update status and message
+        # Update status and message, throttled to avoid a database write for
+        # every short step
         if cls.task:
-          cls.task.status = '%d%%' % int(progress * 100.0 / task_weights)
-          cls.task.message = step.description
-          cls.task.save(using=database)
+          cls.task.setProgress(
+            status='%d%%' % int(progress * 100.0 / task_weights),
+            message=step.description, using=database
+            )
 
         # Run the step
+        started = datetime.now()
         logger.info("Start step %s '%s' at %s" % (
           step.sequence,
           step.description,
-          datetime.now().strftime("%H:%M:%S")
+          started.strftime("%H:%M:%S")
           ))
-        step.run(database=database, **kwargs)
+        wallclock = time()
+        cputime = process_time()
+        rows = step.run(database=database, **kwargs)
+        wallclock = time() - wallclock
+        cputime = process_time() - cputime
         if step.sequence > 0:
           logger.info("Finished '%s' at %s \n" % (step.description, datetime.now().strftime("%H:%M:%S")))
+        cls.profile(step, started, wallclock, cputime, rows)
         progress += step.weight
 
       # Final task status
@@ -154,6 +167,7 @@ class PlanTaskRegistry:
         cls.task.status = '100%'
         cls.task.message = ''
         cls.task.save(using=database)
+      cls.saveProfiles(database)
       logger.info("Finished planning at %s" % datetime.now().strftime("%H:%M:%S"))
     except Exception as e:
       if cls.task:
@@ -161,8 +175,39 @@ class PlanTaskRegistry:
         cls.task.status = 'Failed'
         cls.task.message = str(e)
         cls.task.save(using=database)
+        cls.saveProfiles(database)
       raise
 
+  @classmethod
+  def profile(cls, step, started, wallclock, cputime, rows):
+    '''
+    Logs the profile of a step, and collects it to be saved with the task.
+    A step can return the number of records it processed.
+    '''
+    memory = TaskStep.getPeakMemory()
+    if not isinstance(rows, int) or isinstance(rows, bool):
+      rows = None
+    logger.info("Profile of step %s: %.2f seconds wall clock, %.2f seconds cpu%s%s" % (
+      step.sequence, wallclock, cputime,
+      ", %.0f MB peak memory" % memory if memory is not None else '',
+      ", %d records" % rows if rows is not None else ''
+      ))
+    if cls.task:
+      cls.profiles.append(TaskStep(
+        task=cls.task, sequence=step.sequence, description=step.description[:300],
+        weight=step.weight, started=started, wallclock=wallclock,
+        cputime=cputime, memory=memory, rows=rows
+        ))
+
+  @classmethod
+  def saveProfiles(cls, database=DEFAULT_DB_ALIAS):
+    if cls.task and cls.profiles:
+      try:
+        TaskStep.objects.using(database).bulk_create(cls.profiles)
+      except Exception as e:
+        logger.warning("Warning: can't save the profile of the task: %s" % e)
+    cls.profiles = []
+
 
 class PlanTask:
   '''
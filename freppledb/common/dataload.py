@@ -15,15 +15,25 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import OrderedDict
+import codecs
+import csv
 from datetime import timedelta, datetime
 from decimal import Decimal
+import gzip
+import io
+from itertools import islice
+import logging
 from logging import INFO, ERROR, WARNING, DEBUG
+import os
+
+from django.conf import settings
 
 from django import forms
 from django.contrib.admin.models import LogEntry, CHANGE, ADDITION
 from django.contrib.contenttypes.models import ContentType
 from django.core.validators import EMPTY_VALUES
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models.fields import IntegerField, AutoField, DurationField, BooleanField, DecimalField
 from django.db.models.fields import DateField, DateTimeField, TimeField, CharField, NOT_PROVIDED
 from django.db.models.fields.related import RelatedField
@@ -33,8 +43,96 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import force_text
 from django.utils.text import get_text_list
 
+from freppledb.common.dbcopy import copyRows
+from freppledb.common.models import AuditModel, HierarchyModel
+
+logger = logging.getLogger(__name__)
+
+
+class EncodedCSVReader:
+  '''
+  A CSV reader that streams the rows from a data file.
+
+  The data file is a file name or a binary file object, such as an uploaded
+  file. Data compressed with gzip or zstandard is detected from its first
+  bytes and decompressed on the fly. Reading zstandard data requires the
+  zstandard package.
+
+  The reader will scan the BOM header in the data to detect the right
+  encoding. Without BOM header the data is expected in the CSV_CHARSET
+  encoding. The data is read and decoded in chunks of the given size, and
+  the bytesread and size attributes report the progress through the file.
+  '''
+  def __init__(self, datafile, chunksize=1048576, **kwds):
+    if isinstance(datafile, str):
+      self.raw = open(datafile, 'rb', buffering=chunksize)
+      self.size = os.path.getsize(datafile)
+    else:
+      self.size = getattr(datafile, 'size', None)
+      self.raw = getattr(datafile, 'file', datafile)
+
+    # Detect the compression
+    magic = self.raw.read(4)
+    self.raw.seek(0)
+    if magic.startswith(b'\x1f\x8b'):
+      data = gzip.GzipFile(fileobj=self.raw, mode='rb')
+    elif magic == b'\x28\xb5\x2f\xfd':
+      try:
+        import zstandard
+      except ImportError:
+        raise Exception("Reading zstandard compressed data requires the zstandard package")
+      data = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(self.raw), buffer_size=chunksize)
+    else:
+      data = self.raw
+
+    # Detect the encoding of the data by scanning the BOM.
+    # The utf_8_sig, utf_16 and utf_32 codecs skip the BOM header.
+    if hasattr(data, 'peek'):
+      bom = data.peek(4)[:4]
+    else:
+      bom = data.read(4)
+      data.seek(0)
+    if bom.startswith((codecs.BOM_UTF32_BE, codecs.BOM_UTF32_LE)):
+      encoding = 'utf_32'
+    elif bom.startswith((codecs.BOM_UTF16_BE, codecs.BOM_UTF16_LE)):
+      encoding = 'utf_16'
+    elif bom.startswith(codecs.BOM_UTF8):
+      encoding = 'utf_8_sig'
+    else:
+      # No BOM header found. We assume the data is encoded in the default CSV character set.
+      encoding = settings.CSV_CHARSET
+    self.reader = io.TextIOWrapper(data, encoding=encoding, newline='')
+    # Decode big chunks at a time, rather than the default of 8KB
+    self.reader._CHUNK_SIZE = chunksize
+    self.csvreader = csv.reader(self.reader, **kwds)
+
+  @property
+  def bytesread(self):
+    try:
+      return self.raw.tell()
+    except Exception:
+      return None
+
+  def progress(self):
+    '''
+    Returns the percentage of the data file processed, or None when unknown.
+    '''
+    bytesread = self.bytesread
+    if not self.size or bytesread is None:
+      return None
+    return min(100, int(bytesread * 100 / self.size))
+
+  def close(self):
+    self.reader.close()
 
-def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
+  def __next__(self):
+    return next(self.csvreader)
+
+  def __iter__(self):
+    return self
+
+
+def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=False):
 
   class MappedRow:
     '''
@@ -133,11 +231,13 @@ def parseExcelWorksheet(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=
   if hasattr(model, 'parseData'):
     # Some models have their own special uploading logic
     return model.parseData(data, MappedRow, user, database, ping)
+  elif bulk:
+    return _parseDataBulk(model, data, MappedRow, user, database, ping)
   else:
     return _parseData(model, data, MappedRow, user, database, ping)
 
 
-def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
+def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False, bulk=False):
   '''
   This method:
     - reads CSV data from an input iterator
@@ -148,6 +248,9 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
     - the first row contains a header, listing all field names
     - a first character # marks a comment line
     - empty rows are skipped
+
+  With the bulk argument the data is loaded in batches rather than record
+  by record. This is a lot faster for big data files.
   '''
 
   class MappedRow:
@@ -226,24 +329,146 @@ def parseCSVdata(model, data, user=None, database=DEFAULT_DB_ALIAS, ping=False):
   if hasattr(model, 'parseData'):
     # Some models have their own special uploading logic
     return model.parseData(data, MappedRow, user, database, ping)
+  elif bulk:
+    return _parseDataBulk(model, data, MappedRow, user, database, ping)
   else:
     return _parseData(model, data, MappedRow, user, database, ping)
 
 
+def _parseHeader(model, columns, headers):
+  '''
+  Match the columns of the header row with the fields of the model.
+
+  The matching fields are appended to the headers argument. None is appended
+  for columns that don't match a field.
+  The generator yields the warning and error messages, and returns a tuple
+  with a flag indicating whether the primary key is present and the number
+  of warnings. A NameError is raised when required fields are missing.
+  '''
+  errors = 0
+  warnings = 0
+  has_pk_field = False
+
+  # Collect required fields
+  required_fields = set()
+  for i in model._meta.fields:
+    if not i.blank and i.default == NOT_PROVIDED and not isinstance(i, AutoField):
+      required_fields.add(i.name)
+
+  # Validate all columns
+  for col in columns:
+    col = str(col).strip().strip('#').lower() if col else ""
+    if col == "":
+      headers.append(None)
+      continue
+    ok = False
+    for i in model._meta.fields:
+      # Try with translated field names
+      if col == i.name.lower() \
+        or col == i.verbose_name.lower() \
+        or col == ("%s - %s" % (model.__name__, i.verbose_name)).lower():
+          if i.editable is True:
+            headers.append(i)
+          else:
+            headers.append(None)
+          required_fields.discard(i.name)
+          ok = True
+          break
+      if translation.get_language() != 'en':
+        # Try with English field names
+        with translation.override('en'):
+          if col == i.name.lower() \
+            or col == i.verbose_name.lower() \
+            or col == ("%s - %s" % (model.__name__, i.verbose_name)).lower():
+              if i.editable is True:
+                headers.append(i)
+              else:
+                headers.append(None)
+              required_fields.discard(i.name)
+              ok = True
+              break
+    if not ok:
+      headers.append(None)
+      warnings += 1
+      yield (
+        WARNING, None, None, None,
+        force_text(_('Skipping unknown field %(column)s' % {'column': col}))
+        )
+    if col == model._meta.pk.name.lower() or \
+       col == model._meta.pk.verbose_name.lower():
+      has_pk_field = True
+  if required_fields:
+    # We are missing some required fields
+    errors += 1
+    #. Translators: Translation included with django
+    yield (
+      ERROR, None, None, None,
+      force_text(_('Some keys were missing: %(keys)s' % {'keys': ', '.join(required_fields)}))
+      )
+  # Abort when there are errors
+  if errors:
+    raise NameError("Can't proceed")
+  return has_pk_field, warnings
+
+
+def _getNaturalKey(model):
+  '''
+  Returns the names of the fields in the natural key of a model, or None.
+  '''
+  if hasattr(model.objects, 'get_by_natural_key'):
+    if model._meta.unique_together:
+      return model._meta.unique_together[0]
+    elif hasattr(model, 'natural_key') and isinstance(model.natural_key, tuple):
+      return model.natural_key
+  return None
+
+
+def _readAhead(data, prefetch, size=1000):
+  '''
+  Iterates over the data rows, reading them in chunks. The functions in the
+  prefetch list are called with each chunk before its rows are returned.
+  The first chunk only contains the header row.
+  '''
+  data = iter(data)
+  chunksize = 1
+  while True:
+    chunk = list(islice(data, chunksize))
+    if not chunk:
+      return
+    for f in prefetch:
+      f(chunk)
+    yield from chunk
+    chunksize = size
+
+
 def _parseData(model, data, rowmapper, user, database, ping):
 
   selfReferencing = []
+  foreignKeys = []
+  prefetch = []
 
   def formfieldCallback(f):
     #global selfReferencing
     if isinstance(f, RelatedField):
-      tmp = BulkForeignKeyFormField(field=f, using=database)
+      tmp = BulkForeignKeyFormField(
+        field=f, using=database,
+        fields=getattr(model, 'presaveRelated', {}).get(f.name, ())
+        )
+      foreignKeys.append( (f.name, tmp) )
       if f.remote_field.model == model:
         selfReferencing.append(tmp)
       return tmp
     else:
       return f.formfield(localize=True)
 
+  def prefetchForeignKeys(chunk, mapper):
+    for name, formfield in foreignKeys:
+      values = []
+      for row in chunk:
+        mapper.setData(row)
+        values.append(mapper[name])
+      formfield.prefetch(values)
+
   # Initialize
   headers = []
   rownumber = 0
@@ -257,73 +482,14 @@ def _parseData(model, data, rowmapper, user, database, ping):
   warnings = 0
   has_pk_field = False
   rowWrapper = rowmapper()
-  for row in data:
+  for row in _readAhead(data, prefetch):
 
     rownumber += 1
     rowWrapper.setData(row)
 
     # Case 1: The first line is read as a header line
     if rownumber == 1:
-
-      # Collect required fields
-      required_fields = set()
-      for i in model._meta.fields:
-        if not i.blank and i.default == NOT_PROVIDED and not isinstance(i, AutoField):
-          required_fields.add(i.name)
-
-      # Validate all columns
-      for col in rowWrapper.values():
-        col = str(col).strip().strip('#').lower() if col else ""
-        if col == "":
-          headers.append(None)
-          continue
-        ok = False
-        for i in model._meta.fields:
-          # Try with translated field names
-          if col == i.name.lower() \
-            or col == i.verbose_name.lower() \
-            or col == ("%s - %s" % (model.__name__, i.verbose_name)).lower():
-              if i.editable is True:
-                headers.append(i)
-              else:
-                headers.append(None)
-              required_fields.discard(i.name)
-              ok = True
-              break
-          if translation.get_language() != 'en':
-            # Try with English field names
-            with translation.override('en'):
-              if col == i.name.lower() \
-                or col == i.verbose_name.lower() \
-                or col == ("%s - %s" % (model.__name__, i.verbose_name)).lower():
-                  if i.editable is True:
-                    headers.append(i)
-                  else:
-                    headers.append(None)
-                  required_fields.discard(i.name)
-                  ok = True
-                  break
-        if not ok:
-          headers.append(None)
-          warnings += 1
-          yield (
-            WARNING, None, None, None,
-            force_text(_('Skipping unknown field %(column)s' % {'column': col}))
-            )
-        if col == model._meta.pk.name.lower() or \
-           col == model._meta.pk.verbose_name.lower():
-          has_pk_field = True
-      if required_fields:
-        # We are missing some required fields
-        errors += 1
-        #. Translators: Translation included with django
-        yield (
-          ERROR, None, None, None,
-          force_text(_('Some keys were missing: %(keys)s' % {'keys': ', '.join(required_fields)}))
-          )
-      # Abort when there are errors
-      if errors:
-        raise NameError("Can't proceed")
+      has_pk_field, warnings = yield from _parseHeader(model, rowWrapper.values(), headers)
 
       # Create a form class that will be used to validate the data
       fields = [i.name for i in headers if i]
@@ -334,13 +500,13 @@ def _parseData(model, data, rowmapper, user, database, ping):
         )
       rowWrapper = rowmapper(headers)
 
+      # Look up the foreign keys of each chunk of rows with a single query
+      if foreignKeys:
+        mapper = rowmapper(headers)
+        prefetch.append(lambda chunk: prefetchForeignKeys(chunk, mapper))
+
       # Get natural keys for the class
-      natural_key = None
-      if hasattr(model.objects, 'get_by_natural_key'):
-        if model._meta.unique_together:
-          natural_key = model._meta.unique_together[0]
-        elif hasattr(model, 'natural_key') and isinstance(model.natural_key, tuple):
-          natural_key = model.natural_key
+      natural_key = _getNaturalKey(model)
 
     # Case 2: Skip empty rows
     elif rowWrapper.empty():
@@ -404,8 +570,7 @@ def _parseData(model, data, rowmapper, user, database, ping):
               obj.save(using=database, force_insert=True)
               # Add the new object in the cache of available keys
               for x in selfReferencing:
-                if x.cache is not None and obj.pk not in x.cache:
-                  x.cache[obj.pk] = obj
+                x.add(obj)
             if user:
               admin_log.append(
                 LogEntry(
@@ -437,6 +602,13 @@ def _parseData(model, data, rowmapper, user, database, ping):
   # Save remaining admin log entries
   LogEntry.objects.all().using(database).bulk_create(admin_log)
 
+  for name, formfield in foreignKeys:
+    logger.info(
+      "Foreign key cache for %s.%s: %d hits, %d misses, %d queries" % (
+        model.__name__, name, formfield.stats['hits'],
+        formfield.stats['misses'], formfield.stats['queries']
+      ))
+
   yield (
     INFO, None, None, None,
     _('%(rows)d data rows, changed %(changed)d and added %(added)d records, %(errors)d errors, %(warnings)d warnings') % {
@@ -446,42 +618,454 @@ def _parseData(model, data, rowmapper, user, database, ping):
     )
 
 
+def _parseDataBulk(model, data, rowmapper, user, database, ping, batchsize=5000):
+  '''
+  Bulk version of _parseData, intended for big data files.
+
+  The rows are processed in batches:
+    - Every column is converted and validated with the form field of the
+      model field, rather than validating each row with a model form.
+    - Foreign keys and existing records are looked up with a single query
+      per batch.
+    - New records are inserted with bulk_create, and changed records are
+      updated from a temporary table that is filled with the COPY command.
+
+  The save method of the model isn't called: the lastmodified field, the
+  presave hook and the reset of the hierarchy are handled here instead.
+  No admin log entries are created for the records.
+
+  The generator yields the same messages as _parseData.
+  '''
+  if not issubclass(model, AuditModel):
+    yield (
+      WARNING, None, None, None,
+      force_text(_('Bulk mode is not available for %(model)s') % {'model': model._meta.verbose_name})
+      )
+    yield from _parseData(model, data, rowmapper, user, database, ping)
+    return
+
+  # Initialize
+  headers = []
+  rownumber = 0
+  pingcounter = 0
+  warnings = 0
+  batch = []
+  rowWrapper = rowmapper()
+  for row in data:
+
+    rownumber += 1
+    rowWrapper.setData(row)
+
+    # Case 1: The first line is read as a header line
+    if rownumber == 1:
+      has_pk_field, warnings = yield from _parseHeader(model, rowWrapper.values(), headers)
+      loader = _BulkLoader(model, [i for i in headers if i], has_pk_field, database)
+      rowWrapper = rowmapper(headers)
+
+    # Case 2: Skip empty rows
+    elif rowWrapper.empty():
+      continue
+
+    # Case 3: Collect a data row
+    else:
+      # Send a ping-alive message to make the upload interruptable
+      if ping:
+        pingcounter += 1
+        if pingcounter >= 100:
+          pingcounter = 0
+          yield (DEBUG, rownumber, None, None, None)
+      batch.append( (rownumber, [ rowWrapper[i.name] for i in loader.fields ]) )
+      if len(batch) >= batchsize:
+        yield from loader.load(batch)
+        batch = []
+
+  if rownumber > 1:
+    if batch:
+      yield from loader.load(batch)
+    loader.finish()
+    changed = loader.changed
+    added = loader.added
+    errors = loader.errors
+  else:
+    changed = added = errors = 0
+
+  yield (
+    INFO, None, None, None,
+    _('%(rows)d data rows, changed %(changed)d and added %(added)d records, %(errors)d errors, %(warnings)d warnings') % {
+      'rows': rownumber - 1, 'changed': changed, 'added': added,
+      'errors': errors, 'warnings': warnings
+      }
+    )
+
+
+class _BulkLoader:
+  '''
+  Validates and saves batches of data rows for _parseDataBulk.
+  '''
+
+  def __init__(self, model, fields, has_pk_field, database):
+    self.model = model
+    self.fields = fields
+    self.database = database
+    self.timestamp = datetime.now()
+    self.changed = 0
+    self.added = 0
+    self.errors = 0
+    self.hierarchy = issubclass(model, HierarchyModel)
+    self.concrete_fields = [ i for i in model._meta.concrete_fields if not i.primary_key ]
+    self.updatefields = set()
+
+    # New records get a key above the current maximum, like OperationPlan.save does
+    self.autokey = isinstance(model._meta.pk, AutoField)
+    self.nextid = None
+
+    # Key to find existing records
+    self.index = { i.name: idx for idx, i in enumerate(fields) }
+    if has_pk_field:
+      self.key = [model._meta.pk]
+    else:
+      natural_key = _getNaturalKey(model)
+      self.key = [ model._meta.get_field(i) for i in natural_key ] if natural_key else None
+
+    # A converter for each column. Foreign keys are resolved per batch.
+    self.converters = []
+    for i in fields:
+      if isinstance(i, RelatedField):
+        self.converters.append(None)
+      else:
+        formfield = i.formfield(localize=True)
+        self.converters.append(formfield.clean if formfield else i.to_python)
+
+
+  def rowKey(self, row):
+    key = tuple(
+      row[self.index[i.name]] if i.name in self.index else None
+      for i in self.key
+      )
+    return None if len(key) == 1 and key[0] is None else key
+
+
+  def load(self, batch):
+    # Step 1: Convert and validate the columns
+    invalid = set()
+    for col, field in enumerate(self.fields):
+      convert = self.converters[col]
+      if not convert:
+        continue
+      for rownumber, row in batch:
+        value = row[col]
+        try:
+          row[col] = convert(value)
+          if row[col] not in EMPTY_VALUES:
+            field.run_validators(row[col])
+        except forms.ValidationError as e:
+          invalid.add(rownumber)
+          for error in e.messages:
+            self.errors += 1
+            yield (ERROR, rownumber, field.name, value, error)
+
+    # Step 2: Look up the foreign keys with a single query per column
+    related = {}
+    for col, field in enumerate(self.fields):
+      if self.converters[col]:
+        continue
+      target = field.target_field
+      keys = set()
+      for rownumber, row in batch:
+        value = row[col]
+        if value in EMPTY_VALUES:
+          row[col] = None
+          if not field.null:
+            invalid.add(rownumber)
+            self.errors += 1
+            #. Translators: Translation included with Django
+            yield (ERROR, rownumber, field.name, value, force_text(_('This field is required.')))
+          continue
+        try:
+          row[col] = target.to_python(value)
+          keys.add(row[col])
+        except forms.ValidationError:
+          row[col] = None
+          invalid.add(rownumber)
+          self.errors += 1
+          #. Translators: Translation included with Django
+          yield (ERROR, rownumber, field.name, value, force_text(_('Select a valid choice. That choice is not one of the available choices.')))
+      remote = field.remote_field.model
+      related[col] = {
+        getattr(obj, target.attname): obj
+        for obj in remote._default_manager.using(self.database).filter(**{'%s__in' % target.name: keys})
+        } if keys else {}
+      if remote._meta.concrete_model == self.model._meta.concrete_model and self.model._meta.pk.name in self.index:
+        # Self-referencing key: records in the same batch are valid too
+        selfkeys = set(
+          row[self.index[self.model._meta.pk.name]]
+          for rownumber, row in batch if rownumber not in invalid
+          )
+      else:
+        selfkeys = ()
+      for rownumber, row in batch:
+        if row[col] is not None and row[col] not in related[col] and row[col] not in selfkeys:
+          invalid.add(rownumber)
+          self.errors += 1
+          #. Translators: Translation included with Django
+          yield (ERROR, rownumber, field.name, row[col], force_text(_('Select a valid choice. That choice is not one of the available choices.')))
+
+    # Step 3: Find the existing records
+    rows = [ (rownumber, row) for rownumber, row in batch if rownumber not in invalid ]
+    existing = {}
+    duplicates = set()
+    if self.key:
+      keys = set(i[0] for i in (self.rowKey(row) for rownumber, row in rows) if i)
+      if keys:
+        for obj in self.model.objects.using(self.database).filter(**{'%s__in' % self.key[0].name: keys}):
+          key = tuple(getattr(obj, i.attname) for i in self.key)
+          if key in existing:
+            duplicates.add(key)
+          else:
+            existing[key] = obj
+
+    # Step 4: Update the existing records and create new ones
+    pending = {}
+    original = {}
+    inserts = []
+    updates = {}
+    oldowners = set()
+    changed = 0
+    # Last data row and number of changed data rows of every record
+    rowinfo = {}
+    for rownumber, row in rows:
+      try:
+        key = self.rowKey(row) if self.key else None
+        if key in duplicates:
+          self.errors += 1
+          yield (ERROR, rownumber, None, None, force_text(_('Key fields not unique')))
+          continue
+        if key in existing:
+          obj = existing[key]
+          if obj.pk not in original:
+            original[obj.pk] = { i.attname: getattr(obj, i.attname) for i in self.concrete_fields }
+        elif key in pending:
+          obj = pending[key]
+        else:
+          obj = self.model()
+        for col, field in enumerate(self.fields):
+          value = row[col]
+          if field.primary_key and self.autokey:
+            continue
+          elif col in related:
+            if value is None or value in related[col]:
+              setattr(obj, field.name, related[col].get(value, None))
+            else:
+              setattr(obj, field.attname, value)
+          else:
+            setattr(obj, field.name, value)
+        obj.presave()
+        if key in existing:
+          modified = [
+            i.attname for i in self.concrete_fields
+            if getattr(obj, i.attname) != original[obj.pk][i.attname]
+            ]
+          if not modified:
+            continue
+          self.updatefields.update(modified)
+          updates[obj.pk] = obj
+          changed += 1
+          rowinfo[id(obj)] = [rownumber, rowinfo.get(id(obj), [None, 0])[1] + 1]
+        elif key in pending:
+          changed += 1
+          rowinfo[id(obj)] = [rownumber, rowinfo[id(obj)][1] + 1]
+        else:
+          inserts.append(obj)
+          rowinfo[id(obj)] = [rownumber, 0]
+          if key:
+            pending[key] = obj
+        obj.lastmodified = self.timestamp
+        if self.hierarchy and (key not in existing or 'owner_id' in modified):
+          # Trigger recalculation of the hierarchy for new and moved nodes
+          obj.lft = None
+          obj.rght = None
+          obj.lvl = None
+          if key in existing and original[obj.pk]['owner_id']:
+            oldowners.add(original[obj.pk]['owner_id'])
+      except Exception as e:
+        self.errors += 1
+        yield (ERROR, rownumber, None, None, "Exception during upload: %s" % e)
+
+    # Step 5: Save the batch
+    try:
+      with transaction.atomic(using=self.database):
+        if inserts:
+          if self.autokey:
+            self.assignKeys(inserts)
+          self.model.objects.using(self.database).bulk_create(inserts, batch_size=1000)
+        if updates:
+          self.update(updates.values())
+        if oldowners:
+          # The previous owners of moved nodes may have become leaf nodes
+          self.model.markChildless(self.database, oldowners)
+      self.added += len(inserts)
+      self.changed += changed
+    except Exception:
+      # A single invalid record rolls back the complete batch. The records
+      # are saved again one by one to report the errors against their row.
+      new = set(id(obj) for obj in inserts)
+      for obj in inserts + list(updates.values()):
+        rownumber, rowschanged = rowinfo[id(obj)]
+        try:
+          with transaction.atomic(using=self.database):
+            obj.save(using=self.database, force_insert=id(obj) in new)
+          if id(obj) in new:
+            self.added += 1
+          self.changed += rowschanged
+        except Exception as e:
+          self.errors += 1
+          yield (ERROR, rownumber, None, None, "Exception during upload: %s" % e)
+
+
+  def assignKeys(self, objs):
+    if self.nextid is None:
+      with connections[self.database].cursor() as cursor:
+        cursor.execute(
+          "select coalesce(max(%s), 0) from %s"
+          % (self.model._meta.pk.column, self.model._meta.db_table)
+          )
+        self.nextid = cursor.fetchone()[0] + 1
+    for obj in objs:
+      if obj.pk is None:
+        obj.pk = self.nextid
+        self.nextid += 1
+
+
+  def update(self, objs):
+    table = self.model._meta.db_table
+    pk = self.model._meta.pk
+    fields = [ i for i in self.concrete_fields if i.attname in self.updatefields ]
+    if self.hierarchy:
+      fields.extend(i for i in self.concrete_fields if i.attname in ('lft', 'rght', 'lvl') and i not in fields)
+    fields.extend(i for i in self.concrete_fields if i.attname == 'lastmodified' and i not in fields)
+    connection = connections[self.database]
+    with connection.cursor() as cursor:
+      cursor.execute(
+        "create temporary table tmp_bulkload on commit drop as select %s from %s limit 0"
+        % (','.join([pk.column] + [ i.column for i in fields ]), table)
+        )
+      copyRows(
+        cursor, 'tmp_bulkload', [pk.column] + [ i.column for i in fields ],
+        (
+          [ pk.get_db_prep_save(obj.pk, connection) ]
+          + [ i.get_db_prep_save(getattr(obj, i.attname), connection) for i in fields ]
+          for obj in objs
+        ))
+      cursor.execute(
+        "update %s set %s from tmp_bulkload where %s.%s = tmp_bulkload.%s"
+        % (
+          table, ', '.join([ "%s = tmp_bulkload.%s" % (i.column, i.column) for i in fields ]),
+          table, pk.column, pk.column
+          ))
+      cursor.execute("drop table tmp_bulkload")
+
+
+  def finish(self):
+    if self.nextid is not None:
+      # Keep the sequence of the key in sync with the keys we assigned
+      with connections[self.database].cursor() as cursor:
+        cursor.execute(
+          "select setval(pg_get_serial_sequence(%%s, %%s), (select max(%s) from %s))"
+          % (self.model._meta.pk.column, self.model._meta.db_table),
+          (self.model._meta.db_table, self.model._meta.pk.column)
+          )
+
+
 class BulkForeignKeyFormField(forms.fields.Field):
+  '''
+  A form field for foreign keys, optimized for uploading big data files.
+
+  The referenced records are kept in a cache with the least recently used
+  keys. The prefetch method loads all keys of the next chunk of data rows
+  that aren't cached yet with a single query. The cached records only have
+  their primary key loaded, plus the fields passed in the fields argument:
+  the presave methods of some models read fields of the referenced records,
+  eg a manufacturing order takes the item and location of its operation.
+  Other fields are retrieved only when they are accessed.
+  The form field is copied for every form instance, but all copies share
+  the same cache and statistics.
+  '''
 
   def __init__(self, using=DEFAULT_DB_ALIAS, field=None, required=None,
-               label=None, help_text='', *args, **kwargs):
+               label=None, help_text='', cachesize=100000, fields=(), *args, **kwargs):
     forms.fields.Field.__init__(
       self, *args,
       required=required if required is not None else not field.null,
       label=label, help_text=help_text, **kwargs
       )
-
-    # Build a cache with the list of values - as long as it reasonable fits in memory
     self.model = field.remote_field.model
+    self.target = field.target_field
     field.remote_field.parent_link = True  # A trick to disable the model validation on foreign keys!
-    if field.remote_field.model._default_manager.all().using(using).count() > 20000:
-      self.queryset = field.remote_field.model._default_manager.all().using(using)
-      self.cache = None
-    else:
-      self.queryset = None
-      self.cache = { obj.pk: obj for obj in field.remote_field.model._default_manager.all().using(using) }
+    self.queryset = self.model._default_manager.all().using(using).only(self.target.name, *fields)
+    self.cachesize = cachesize
+    self.cache = OrderedDict()
+    self.notfound = set()
+    self.stats = {'hits': 0, 'misses': 0, 'queries': 0}
+
+
+  def add(self, obj):
+    '''
+    Adds a record to the cache.
+    '''
+    key = getattr(obj, self.target.attname)
+    self.notfound.discard(key)
+    self.cache[key] = obj
+    self.cache.move_to_end(key)
+    if len(self.cache) > self.cachesize:
+      self.cache.popitem(last=False)
+
+
+  def prefetch(self, values):
+    '''
+    Loads the keys that aren't in the cache yet with a single query.
+    '''
+    self.notfound.clear()
+    keys = set()
+    for value in values:
+      if value in EMPTY_VALUES:
+        continue
+      try:
+        key = self.target.to_python(value)
+      except forms.ValidationError:
+        continue
+      if key not in self.cache:
+        keys.add(key)
+    if not keys:
+      return
+    self.stats['queries'] += 1
+    for obj in self.queryset.filter(**{'%s__in' % self.target.name: keys}):
+      keys.discard(getattr(obj, self.target.attname))
+      self.add(obj)
+    self.notfound.update(keys)
 
 
   def to_python(self, value):
     if value in EMPTY_VALUES:
       return None
-    if self.cache is not None:
-      try:
-        return self.cache[value]
-      except KeyError:
-        #. Translators: Translation included with Django
-        raise forms.ValidationError(_('Select a valid choice. That choice is not one of the available choices.'))
-    else:
+    try:
+      key = self.target.to_python(value)
+    except forms.ValidationError:
+      key = None
+    if key in self.cache:
+      self.stats['hits'] += 1
+      self.cache.move_to_end(key)
+      return self.cache[key]
+    self.stats['misses'] += 1
+    if key is not None and key not in self.notfound:
       try:
-        return self.queryset.get(pk=value)
+        self.stats['queries'] += 1
+        obj = self.queryset.get(**{self.target.name: key})
+        self.add(obj)
+        return obj
       except self.model.DoesNotExist:
-        #. Translators: Translation included with Django
-        raise forms.ValidationError(_('Select a valid choice. That choice is not one of the available choices.'))
+        pass
+    #. Translators: Translation included with Django
+    raise forms.ValidationError(_('Select a valid choice. That choice is not one of the available choices.'))
 
 
   def has_changed(self, initial, data):
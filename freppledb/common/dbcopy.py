@@ -0,0 +1,135 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+r'''
+Streaming helpers to load rows into PostgreSQL with the COPY command.
+
+Rows are python tuples. They are encoded in the PostgreSQL text COPY format
+in chunks while the COPY statement is reading from the stream, so the data
+is never spooled to a temporary file or fully materialized in memory.
+'''
+
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+
+
+# Characters that need escaping in the text COPY format
+_escape_table = str.maketrans({
+  '\\': '\\\\',
+  '\t': '\\t',
+  '\n': '\\n',
+  '\r': '\\r',
+  })
+
+
+def _encodeString(value):
+  return value.translate(_escape_table)
+
+
+def _encodeBoolean(value):
+  return 't' if value else 'f'
+
+
+def _encodeInterval(value):
+  return '%.6f seconds' % value.total_seconds()
+
+
+_encoders = {
+  str: _encodeString,
+  int: str,
+  float: repr,
+  bool: _encodeBoolean,
+  Decimal: str,
+  datetime: str,
+  date: str,
+  time: str,
+  timedelta: _encodeInterval,
+  }
+
+
+def encodeValue(value):
+  '''
+  Encode a single python value as a field in the text COPY format.
+
+  None is mapped to NULL. Numbers are passed without rounding: the column
+  type of the target table takes care of the precision.
+  '''
+  if value is None:
+    return '\\N'
+  try:
+    return _encoders[value.__class__](value)
+  except KeyError:
+    return _encodeString(str(value))
+
+
+def encodeRow(row):
+  '''
+  Encode a tuple as a line in the text COPY format.
+  '''
+  return '\t'.join(map(encodeValue, row)) + '\n'
+
+
+class CopyStream:
+  '''
+  A read-only file-like object that encodes rows from an iterable on demand.
+
+  The database driver calls the read method with the size of the chunks it
+  sends to the server. Every call pulls just enough rows from the iterable
+  to fill up the chunk.
+  '''
+  def __init__(self, rows):
+    self.rows = iter(rows)
+    self.buffer = []
+    self.buffersize = 0
+    self.count = 0
+    self.exhausted = False
+
+  def read(self, size=-1):
+    while not self.exhausted and (size < 0 or self.buffersize < size):
+      try:
+        line = encodeRow(next(self.rows))
+      except StopIteration:
+        self.exhausted = True
+        break
+      self.buffer.append(line)
+      self.buffersize += len(line)
+      self.count += 1
+    data = ''.join(self.buffer)
+    if size < 0 or len(data) <= size:
+      self.buffer = []
+      self.buffersize = 0
+      return data
+    self.buffer = [data[size:]]
+    self.buffersize = len(self.buffer[0])
+    return data[:size]
+
+  def readline(self, size=-1):
+    return self.read(size)
+
+
+def copyRows(cursor, table, columns, rows, size=65536):
+  '''
+  Stream the rows into a table with the COPY command.
+
+  Returns the number of rows that were sent.
+  '''
+  stream = CopyStream(rows)
+  cursor.copy_expert(
+    "copy %s (%s) from stdin" % (table, ','.join(columns)),
+    stream, size
+    )
+  return stream.count
@@ -14,8 +14,12 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+from copy import deepcopy
 from datetime import datetime
+import json
 import logging
+from threading import Lock
+from time import time
 
 from django.conf import settings
 from django.contrib.admin.utils import quote
@@ -25,7 +29,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import PermissionDenied
 from django.db import models, DEFAULT_DB_ALIAS, connections, transaction
 from django.db.models import Q
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch.dispatcher import receiver
 from django.urls import NoReverseMatch, reverse
 from django.utils import timezone
@@ -39,6 +43,15 @@ logger = logging.getLogger(__name__)
 
 
 class HierarchyModel(models.Model):
+  '''
+  Abstract base class for entities organized in a tree.
+
+  The tree is stored as a nested set in the fields lft, rght and lvl.
+  A node with a null value in its lft field needs to get its place in the
+  hierarchy (re)computed: the rebuildHierarchy method will number such nodes
+  together with their subtree. Only the nodes that are added or moved to
+  another owner are marked, so the other nodes keep their numbering.
+  '''
   lft = models.PositiveIntegerField(db_index=True, editable=False, null=True, blank=True)
   rght = models.PositiveIntegerField(null=True, editable=False, blank=True)
   lvl = models.PositiveIntegerField(null=True, editable=False, blank=True)
@@ -49,38 +62,66 @@ class HierarchyModel(models.Model):
                             related_name='xchildren', help_text=_('Hierarchical parent'),
                             on_delete=models.CASCADE)
 
+  @classmethod
+  def from_db(cls, db, field_names, values):
+    instance = super(HierarchyModel, cls).from_db(db, field_names, values)
+    # Remember the owner as loaded from the database, to detect moves
+    if 'owner_id' in instance.__dict__:
+      instance._loaded_owner = instance.owner_id
+    return instance
+
   def save(self, *args, **kwargs):
-    # Trigger recalculation of the hieracrhy.
-    # TODO this triggers the recalculation in too many cases, including a lot
-    # of changes which don't require it. Alternative solution is to use the
-    # pre-save signal which has more information.
-    self.lft = None
-    self.rght = None
-    self.lvl = None
+    # Trigger recalculation of the hierarchy for new nodes and for nodes that
+    # moved to another owner.
+    moved = self._state.adding or not hasattr(self, '_loaded_owner') \
+      or self._loaded_owner != self.owner_id
+    if moved:
+      self.lft = None
+      self.rght = None
+      self.lvl = None
+    old_owner = getattr(self, '_loaded_owner', None)
 
     # Call the real save() method
     super(HierarchyModel, self).save(*args, **kwargs)
 
+    if moved and old_owner and old_owner != self.owner_id:
+      # The previous owner may have become a leaf node
+      self.__class__.markChildless(self._state.db, [old_owner])
+    self._loaded_owner = self.owner_id
+
   def delete(self, *args, **kwargs):
-    try:
-      # Update an arbitrary other object to trigger recalculation of the hierarchy
-      obj = self.__class__.objects.using(self._state.db).exclude(pk=self.pk)[0]
-      obj.lft = None
-      obj.rght = None
-      obj.lvl = None
-      obj.save(
-        update_fields=['lft', 'rght', 'lvl'],
-        using=self._state.db
-        )
-    except:
-      # Failure can happen when eg we delete the last record
-      pass
+    owner = self.owner_id
+    db = self._state.db
+
     # Call the real delete() method
-    super(HierarchyModel, self).delete(*args, **kwargs)
+    result = super(HierarchyModel, self).delete(*args, **kwargs)
+
+    # The remaining nodes keep a valid numbering, except for the owner when
+    # it has become a leaf node.
+    if owner:
+      self.__class__.markChildless(db, [owner])
+    return result
 
   class Meta:
     abstract = True
 
+  @classmethod
+  def markChildless(cls, database, names):
+    '''
+    Triggers the recalculation of the nodes in the list that don't have
+    any children any longer.
+    '''
+    table = connections[database].ops.quote_name(cls._meta.db_table)
+    with connections[database].cursor() as cursor:
+      cursor.execute(
+        '''
+        update %s as node set lft = null, rght = null, lvl = null
+        where node.name = any(%%s) and node.rght > node.lft + 1
+          and not exists (select 1 from %s as child where child.owner_id = node.name)
+        ''' % (table, table),
+        (list(names),)
+        )
+
   @classmethod
   def rebuildHierarchy(cls, database=DEFAULT_DB_ALIAS):
 
@@ -89,44 +130,158 @@ class HierarchyModel(models.Model):
     if len(cls.objects.using(database).filter(lft__isnull=True)[:1]) == 0:
       return
 
-    nodes = {}
-    children = {}
-    updates = []
+    table = connections[database].ops.quote_name(cls._meta.db_table)
+    with transaction.atomic(using=database):
+      with connections[database].cursor() as cursor:
+        # Concurrent rebuilds of the same hierarchy wait for each other
+        cursor.execute("lock table %s in share row exclusive mode" % table)
+        cursor.execute(
+          "select count(*), count(*) filter (where lft is null), coalesce(max(rght), 0) from %s"
+          % table
+          )
+        total, dirty, maxright = cursor.fetchone()
+        if not dirty:
+          # Another process completed the rebuild while we were waiting
+          return
+        # Renumber the complete tree when a big part of the nodes changed or
+        # when the numbering has too many gaps left by deleted nodes.
+        if dirty * 10 > total or maxright > 8 * total or not cls._rebuildChanged(cursor, table):
+          cls._rebuildAll(cursor, table)
 
-    def tagChildren(me, left, level):
-      right = left + 1
-      # Get all children of this node
-      for i in children.get(me, []):
-        # Recursive execution of this function for each child of this node
-        right = tagChildren(i, right, level + 1)
+  @staticmethod
+  def _tagTree(children, root, left, level, updates):
+    '''
+    Numbers the subtree of a node with a depth-first traversal.
+    A tuple (name, lft, rght, lvl) is appended to the updates list for
+    every node, and the first unused number is returned.
+    '''
+    stack = [(root, level, None)]
+    while stack:
+      node, lvl, lft = stack.pop()
+      if lft is not None:
+        # All children of this node are numbered now
+        updates.append((node, lft, left, lvl))
+        left += 1
+        continue
+      stack.append((node, lvl, left))
+      left += 1
+      for child in sorted(children.get(node, ()), reverse=True):
+        stack.append((child, lvl + 1, None))
+    return left
 
-      # After processing the children of this node now know its left and right values
-      updates.append( (left, right, level, me) )
+  @staticmethod
+  def _writeTree(cursor, table, updates):
+    if updates:
+      cursor.execute(
+        '''
+        update %s as node set lft = data.lft, rght = data.rght, lvl = data.lvl
+        from unnest(%%s::varchar[], %%s::integer[], %%s::integer[], %%s::integer[])
+          as data(name, lft, rght, lvl)
+        where node.name = data.name
+        ''' % table,
+        ([i[0] for i in updates], [i[1] for i in updates], [i[2] for i in updates], [i[3] for i in updates])
+        )
 
-      # Remove from node list (to mark as processed)
-      del nodes[me]
+  @classmethod
+  def _rebuildChanged(cls, cursor, table):
+    '''
+    Inserts the subtrees of the changed nodes in the existing numbering.
 
-      # Return the right value of this node + 1
-      return right + 1
+    Returns False when the hierarchy can't be updated incrementally, eg
+    because of loops in it.
+    '''
+    # Collect the subtree below every changed node
+    cursor.execute(
+      '''
+      with recursive subtree(root, name, owner, path) as (
+        select name, name, owner_id, array[name::text]
+        from %s
+        where lft is null
+        union all
+        select subtree.root, child.name, child.owner_id, subtree.path || child.name::text
+        from subtree
+        inner join %s as child
+          on child.owner_id = subtree.name
+        where not child.name = any(subtree.path)
+        )
+      select root, name, owner from subtree
+      ''' % (table, table)
+      )
+    subtrees = {}
+    owners = {}
+    covered = set()
+    for root, name, owner in cursor.fetchall():
+      if root == name:
+        if owner == name:
+          # Data error: the full rebuild reports it
+          return False
+        owners[root] = owner
+      else:
+        covered.add(name)
+        subtrees.setdefault(root, {}).setdefault(owner, []).append(name)
+
+    # Changed nodes within the subtree of another changed node are numbered
+    # together with it.
+    for root in sorted(i for i in owners if i not in covered):
+      owner = owners[root]
+      children = subtrees.get(root, {})
+      size = 2 * (1 + sum(len(i) for i in children.values()))
+      if owner:
+        cursor.execute("select lft, rght, lvl from %s where name = %%s" % table, (owner,))
+        parent = cursor.fetchone()
+        if not parent or parent[0] is None:
+          return False
+        # Make room at the end of the owner's interval
+        left = parent[1]
+        level = parent[2] + 1
+        cursor.execute(
+          "update %s set rght = rght + %%s where rght >= %%s" % table,
+          (size, left)
+          )
+        cursor.execute(
+          "update %s set lft = lft + %%s where lft > %%s" % table,
+          (size, left)
+          )
+      else:
+        # A new top-level node is appended after all existing nodes
+        cursor.execute("select coalesce(max(rght), 0) + 1 from %s" % table)
+        left = cursor.fetchone()[0]
+        level = 0
+      updates = []
+      cls._tagTree(children, root, left, level, updates)
+      cls._writeTree(cursor, table, updates)
+
+    # Nodes in a loop never get numbered
+    cursor.execute("select 1 from %s where lft is null limit 1" % table)
+    return cursor.fetchone() is None
+
+  @classmethod
+  def _rebuildAll(cls, cursor, table):
+    '''
+    Numbers all nodes in the hierarchy.
+    '''
+    nodes = {}
+    children = {}
+    updates = []
 
     # Load all nodes in memory
-    for i in cls.objects.using(database).values('name', 'owner'):
-      if i['name'] == i['owner']:
-        logging.error("Data error: '%s' points to itself as owner" % i['name'])
-        nodes[i['name']] = None
+    cursor.execute("select name, owner_id from %s" % table)
+    for name, owner in cursor.fetchall():
+      if name == owner:
+        logging.error("Data error: '%s' points to itself as owner" % name)
+        nodes[name] = None
       else:
-        nodes[i['name']] = i['owner']
-        if i['owner']:
-          if not i['owner'] in children:
-            children[i['owner']] = set()
-          children[i['owner']].add(i['name'])
-    keys = sorted(nodes.items())
+        nodes[name] = owner
+        if owner:
+          children.setdefault(owner, set()).add(name)
 
     # Loop over nodes without parent
     cnt = 1
-    for i, j in keys:
+    for i, j in sorted(nodes.items()):
       if j is None:
-        cnt = tagChildren(i, cnt, 0)
+        cnt = cls._tagTree(children, i, cnt, 0, updates)
+    for i in updates:
+      del nodes[i[0]]
 
     if nodes:
       # If the nodes dictionary isn't empty, it is an indication of an
@@ -137,32 +292,24 @@ class HierarchyModel(models.Model):
       updated = True
       while updated:
         updated = False
-        for i in bad.keys():
-          ok = True
-          for j, k in bad.items():
-            if k == i:
-              ok = False
-              break
-          if ok:
+        owners = set(bad.values())
+        for i in list(bad.keys()):
+          if i not in owners:
             # If none of the bad keys points to me as a parent, I am unguilty
             del bad[i]
             updated = True
       logging.error("Data error: Hierarchy loops among %s" % sorted(bad.keys()))
-      for i, j in sorted(bad.items()):
-        nodes[i] = None
 
-      # Continue loop over nodes without parent
-      keys = sorted(nodes.items())
-      for i, j in keys:
+      # Cut the loops by treating their members as top-level nodes
+      for i, j in bad.items():
+        children[j].discard(i)
+        nodes[i] = None
+      for i, j in sorted(nodes.items()):
         if j is None:
-          cnt = tagChildren(i, cnt, 0)
+          cnt = cls._tagTree(children, i, cnt, 0, updates)
 
     # Write all results to the database
-    with transaction.atomic(using=database):
-      connections[database].cursor().executemany(
-        'update %s set lft=%%s, rght=%%s, lvl=%%s where name = %%s' % connections[database].ops.quote_name(cls._meta.db_table),
-        updates
-        )
+    cls._writeTree(cursor, table, updates)
 
 
 class MultiDBManager(models.Manager):
@@ -207,13 +354,29 @@ class AuditModel(models.Model):
 
   objects = MultiDBManager()  # The default manager.
 
+  # Fields of referenced records read by the presave method, per foreign key.
+  # The data loader reads these fields together with the keys of the
+  # referenced records.
+  presaveRelated = {}
+
   def save(self, *args, **kwargs):
     # Update the field with every change
     self.lastmodified = datetime.now()
 
+    # Compute derived fields
+    self.presave()
+
     # Call the real save() method
     super(AuditModel, self).save(*args, **kwargs)
 
+  def presave(self):
+    '''
+    Hook for subclasses to compute derived fields before a record is saved.
+    The bulk mode of the data loader doesn't call the save method, but it
+    does call this method.
+    '''
+    pass
+
   class Meta:
     abstract = True
 
@@ -233,13 +396,65 @@ class Parameter(AuditModel):
     verbose_name = _('parameter')
     verbose_name_plural = _('parameters')
 
+  # Process-wide cache of the parameters of each database.
+  # Every entry is a tuple with the parameter values, a checksum of the
+  # table contents and the time the checksum was last verified.
+  # The cache entry of a database is dropped when a parameter is saved or
+  # deleted in this process. Changes made by other processes or with plain SQL
+  # are picked up by comparing the checksum, which happens at most once
+  # every cacheInterval seconds.
+  _cache = {}
+  _cachelock = Lock()
+  cacheInterval = 1
+
   @staticmethod
   def getValue(key, database=DEFAULT_DB_ALIAS, default=None):
     try:
-      return Parameter.objects.using(database).get(pk=key).value
+      values = Parameter.getValues(database)
+      return values[key] if key in values else default
     except:
       return default
 
+  @staticmethod
+  def getValues(database=DEFAULT_DB_ALIAS):
+    '''
+    Returns a dictionary with the values of all parameters in a database.
+    '''
+    if connections[database].in_atomic_block:
+      # Transactions see their own uncommitted changes, which must not leak
+      # into the cache
+      return {
+        i[0]: i[1]
+        for i in Parameter.objects.using(database).values_list('name', 'value')
+        }
+    entry = Parameter._cache.get(database, None)
+    now = time()
+    if entry and now - entry[2] < Parameter.cacheInterval:
+      return entry[0]
+    with Parameter._cachelock, connections[database].cursor() as cursor:
+      cursor.execute('''
+        select md5(coalesce(string_agg(name || '=' || coalesce(value, ''), chr(10) order by name), ''))
+        from common_parameter
+        ''')
+      checksum = cursor.fetchone()[0]
+      if not entry or entry[1] != checksum:
+        cursor.execute("select name, value from common_parameter")
+        entry = ({ i[0]: i[1] for i in cursor.fetchall() }, checksum, now)
+      else:
+        entry = (entry[0], checksum, now)
+      Parameter._cache[database] = entry
+      return entry[0]
+
+  @staticmethod
+  def clearCache(database=None):
+    '''
+    Removes the cached parameters of a database, or of all databases.
+    '''
+    if database:
+      Parameter._cache.pop(database, None)
+    else:
+      Parameter._cache.clear()
+
 
 class Scenario(models.Model):
   scenarioStatus = (
@@ -450,12 +665,7 @@ class User(AbstractUser):
 
   def getPreference(self, prop, default=None, database=DEFAULT_DB_ALIAS):
     try:
-      result = None
-      for p in UserPreference.objects.all().using(database).filter(property=prop).filter(Q(user__isnull=True) | Q(user=self.id)).order_by('-user').only('user', 'value'):
-        if result:
-          result.update(p.value)
-        else:
-          result = p.value
+      result = UserPreference.getValue(self.id, prop, database)
       return result if result else default
     except ValueError:
       logger.error("Invalid preference '%s' of user '%s'" % (prop, self.username))
@@ -465,35 +675,36 @@ class User(AbstractUser):
 
 
   def setPreference(self, prop, val, database=DEFAULT_DB_ALIAS):
-    if val is None:
-      if prop in settings.GLOBAL_PREFERENCES and self.is_superuser:
-        # Delete global preferences
-        UserPreference.objects.all().using(database).get_or_create(user__isnull=True,property=prop).delete()
-      # Delete user preferences
-      try:
-        self.preferences.using(database).get(property=prop).delete()
-      except UserPreference.DoesNotExist:
-        # No such preferences exists now
-        pass
-    else:
-      if prop in settings.GLOBAL_PREFERENCES:
+    with connections[database].cursor() as cursor:
+      if val is None:
+        if prop in settings.GLOBAL_PREFERENCES and self.is_superuser:
+          # Delete global preferences
+          cursor.execute(
+            "delete from common_preference where user_id is null and property = %s",
+            (prop,)
+            )
+          UserPreference.updateCache(database, None, prop, None)
+        # Delete user preferences
+        cursor.execute(
+          "delete from common_preference where user_id = %s and property = %s",
+          (self.id, prop)
+          )
+        UserPreference.updateCache(database, self.id, prop, None)
+      elif prop in settings.GLOBAL_PREFERENCES:
         val_global = { k: v for k, v in val.items() if k in settings.GLOBAL_PREFERENCES[prop] }
         val_user = { k: v for k, v in val.items() if not k in settings.GLOBAL_PREFERENCES[prop] }
         if val_global and self.is_superuser:
           # A superuser can save global preferences for this property
-          pref = UserPreference.objects.all().using(database).get_or_create(user__isnull=True, property=prop)[0]
-          pref.value = val_global
-          pref.save(update_fields=['value'], using=database)
+          UserPreference.saveValue(cursor, None, prop, val_global)
+          UserPreference.updateCache(database, None, prop, val_global)
         if val_user:
           # Everyone can save his personal preferences for this property
-          pref = UserPreference.objects.all().using(database).get_or_create(user=self, property=prop)[0]
-          pref.value = val_user
-          pref.save(update_fields=['value'], using=database)
+          UserPreference.saveValue(cursor, self.id, prop, val_user)
+          UserPreference.updateCache(database, self.id, prop, val_user)
       else:
         # No global preferences configured for this property
-        pref = UserPreference.objects.all().using(database).get_or_create(user=self, property=prop)[0]
-        pref.value = val
-        pref.save(update_fields=['value'], using=database)
+        UserPreference.saveValue(cursor, self.id, prop, val)
+        UserPreference.updateCache(database, self.id, prop, val)
 
 
   def getMaxLoglevel(self, database=DEFAULT_DB_ALIAS):
@@ -518,10 +729,126 @@ class UserPreference(models.Model):
     on_delete=models.CASCADE)
   property = models.CharField(max_length=100, blank=False, null=False)
   value = JSONBField(max_length=1000, blank=False, null=False)
+  lastmodified = models.DateTimeField(_('last modified'), editable=False, auto_now=True)
+
+  # Process-wide cache of the preferences of each database.
+  # Every entry holds the preferences per user (the global preferences are
+  # stored with user None), a version of the records of every user and the
+  # time the versions were last verified. The version of a user is the
+  # number of records and their last modification.
+  # All versions are verified with a single query, at most once every
+  # cacheInterval seconds. Users with a changed version are dropped from the
+  # cache, which keeps it coherent with other processes.
+  _cache = {}
+  _cachelock = Lock()
+  cacheInterval = 1
 
   def natural_key(self):
     return (self.user, self.property)
 
+  @staticmethod
+  def getValue(user, prop, database=DEFAULT_DB_ALIAS):
+    '''
+    Returns the preference of a user, merged with the global preference.
+    '''
+    if connections[database].in_atomic_block:
+      # Transactions see their own uncommitted changes, which must not leak
+      # into the cache
+      result = None
+      for p in UserPreference.objects.all().using(database).filter(property=prop).filter(Q(user__isnull=True) | Q(user=user)).order_by('-user').only('user', 'value'):
+        if result:
+          result.update(p.value)
+        else:
+          result = p.value
+      return result
+    with UserPreference._cachelock:
+      val_global = UserPreference.getCachedValues(None, database).get(prop, None)
+      val_user = UserPreference.getCachedValues(user, database).get(prop, None)
+      if val_global and val_user:
+        result = deepcopy(val_global)
+        result.update(val_user)
+        return result
+      else:
+        # Callers are free to change the result
+        return deepcopy(val_global or val_user)
+
+  @staticmethod
+  def getCachedValues(user, database):
+    '''
+    Returns a dictionary with the cached preferences of a user.
+    The caller must hold the cache lock.
+    '''
+    now = time()
+    entry = UserPreference._cache.get(database, None)
+    if not entry:
+      entry = { 'users': {}, 'versions': {}, 'checked': 0 }
+      UserPreference._cache[database] = entry
+    with connections[database].cursor() as cursor:
+      if now - entry['checked'] >= UserPreference.cacheInterval:
+        cursor.execute('''
+          select user_id, count(*), max(lastmodified)
+          from common_preference
+          group by user_id
+          ''')
+        versions = { i[0]: (i[1], i[2]) for i in cursor.fetchall() }
+        for u in list(entry['users'].keys()):
+          if versions.get(u, None) != entry['versions'].get(u, None):
+            del entry['users'][u]
+        entry['versions'] = versions
+        entry['checked'] = now
+      if user not in entry['users']:
+        if user is None:
+          cursor.execute("select property, value from common_preference where user_id is null")
+        else:
+          cursor.execute("select property, value from common_preference where user_id = %s", (user,))
+        entry['users'][user] = { i[0]: i[1] for i in cursor.fetchall() }
+      return entry['users'][user]
+
+  @staticmethod
+  def updateCache(database, user, prop, value):
+    '''
+    Writes a changed preference through to the cache.
+    A value None removes the preference.
+    '''
+    with UserPreference._cachelock:
+      if connections[database].in_atomic_block:
+        # The change can still be rolled back
+        UserPreference._cache.pop(database, None)
+        return
+      entry = UserPreference._cache.get(database, None)
+      if not entry or user not in entry['users']:
+        return
+      if value is None:
+        entry['users'][user].pop(prop, None)
+      else:
+        entry['users'][user][prop] = deepcopy(value)
+
+  @staticmethod
+  def saveValue(cursor, user, prop, value):
+    '''
+    Inserts or updates a preference with a single statement.
+    '''
+    value = json.dumps(value, separators=(',', ':'))
+    if user is None:
+      # The unique constraint doesn't apply to null users
+      cursor.execute('''
+        update common_preference set value = %s, lastmodified = now()
+        where user_id is null and property = %s
+        ''', (value, prop))
+      if cursor.rowcount:
+        return
+      cursor.execute('''
+        insert into common_preference (user_id, property, value, lastmodified)
+        values (null, %s, %s, now())
+        ''', (prop, value))
+    else:
+      cursor.execute('''
+        insert into common_preference (user_id, property, value, lastmodified)
+        values (%s, %s, %s, now())
+        on conflict (user_id, property)
+        do update set value = excluded.value, lastmodified = excluded.lastmodified
+        ''', (user, prop, value))
+
   class Meta:
     db_table = "common_preference"
     unique_together = (('user', 'property'),)
@@ -534,6 +861,12 @@ def delete_user(sender, instance, **kwargs):
   raise PermissionDenied
 
 
+@receiver(post_save, sender=Parameter)
+@receiver(post_delete, sender=Parameter)
+def changed_parameter(sender, instance, using, **kwargs):
+  Parameter.clearCache(using)
+
+
 class Comment(models.Model):
   id = models.AutoField(_('identifier'), primary_key=True)
   content_type = models.ForeignKey(
@@ -34,11 +34,13 @@ import csv
 from datetime import date, datetime, timedelta, time
 from decimal import Decimal
 import functools
+import hashlib
 from logging import ERROR, WARNING, DEBUG
 import math
 import operator
 import json
 import re
+from threading import Lock
 from io import StringIO, BytesIO
 import urllib
 from openpyxl import load_workbook, Workbook
@@ -46,7 +48,7 @@ from openpyxl.utils import get_column_letter
 from openpyxl.writer.write_only import WriteOnlyCell
 from openpyxl.styles import NamedStyle, PatternFill
 
-from django.db.models import Model
+from django.db.models import Model, Q
 from django.apps import apps
 from django.contrib.auth.models import Group
 from django.contrib.auth import get_permission_codename
@@ -79,7 +81,7 @@ from django.views.generic.base import View
 
 from freppledb.boot import getAttributeFields
 from freppledb.common.models import User, Comment, Parameter, BucketDetail, Bucket, HierarchyModel
-from freppledb.common.dataload import parseExcelWorksheet, parseCSVdata
+from freppledb.common.dataload import parseExcelWorksheet, parseCSVdata, EncodedCSVReader
 from freppledb.admin import data_site
 
 
@@ -130,7 +132,7 @@ def getHorizon(request, future_only=False):
   # Pick up the current date
   try:
     current = datetime.strptime(
-      Parameter.objects.using(request.database).get(name="currentdate").value,
+      Parameter.getValue("currentdate", request.database),
       "%Y-%m-%d %H:%M:%S"
       )
   except:
@@ -390,44 +392,6 @@ def getBOM(encoding):
     return ''
 
 
-class EncodedCSVReader:
-  """
-  A CSV reader which will iterate over lines in the CSV data buffer.
-  The reader will scan the BOM header in the data to detect the right encoding.
-  """
-  def __init__(self, datafile, **kwds):
-    # Read the file into memory
-    # TODO Huge file uploads can overwhelm your system!
-    data = datafile.read()
-    # Detect the encoding of the data by scanning the BOM.
-    # Skip the BOM header if it is found.
-    if data.startswith(codecs.BOM_UTF32_BE):
-      self.reader = StringIO(data.decode('utf_32_be'))
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF32_LE):
-      self.reader = StringIO(data.decode('utf_32_le'))
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF16_BE):
-      self.reader = StringIO(data.decode('utf_16_be'))
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF16_LE):
-      self.reader = StringIO(data.decode('utf_16_le'))
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF8):
-      self.reader = StringIO(data.decode('utf_8'))
-      self.reader.read(1)
-    else:
-      # No BOM header found. We assume the data is encoded in the default CSV character set.
-      self.reader = StringIO(data.decode(settings.CSV_CHARSET))
-    self.csvreader = csv.reader(self.reader, **kwds)
-
-  def __next__(self):
-    return next(self.csvreader)
-
-  def __iter__(self):
-    return self
-
-
 class GridReport(View):
   '''
   The base class for all jqgrid views.
@@ -460,6 +424,16 @@ class GridReport(View):
   # A model class from which we can inherit information.
   model = None
 
+  # Number of seconds the record count of a filtered report is cached.
+  # A request with the argument "exactcount" always counts the records.
+  countCacheInterval = 30
+
+  # Cache of the record counts shared by all reports, keyed on the database
+  # and the SQL of the query
+  _countcache = {}
+  _cachelock = Lock()
+  cacheSize = 1000
+
   # Allow editing in this report or not
   editable = True
 
@@ -1004,6 +978,141 @@ class GridReport(View):
       return "%s asc" % sort
 
 
+  @classmethod
+  def _getCount(reportclass, request, query):
+    '''
+    Returns the number of records of a query. The count is cached for
+    countCacheInterval seconds, unless the request asks for an exact count.
+    '''
+    try:
+      sql, params = query.query.sql_with_params()
+      key = (request.database, sql, repr(params))
+    except Exception:
+      # Empty result sets raise an exception
+      return query.count()
+    now = datetime.now()
+    if 'exactcount' not in request.GET:
+      entry = GridReport._countcache.get(key, None)
+      if entry and now - entry[1] < timedelta(seconds=reportclass.countCacheInterval):
+        return entry[0]
+    recs = query.count()
+    with GridReport._cachelock:
+      if len(GridReport._countcache) >= GridReport.cacheSize:
+        GridReport._countcache.clear()
+      GridReport._countcache[key] = (recs, now)
+    return recs
+
+
+  @classmethod
+  def clearCountCache(reportclass):
+    with GridReport._cachelock:
+      GridReport._countcache.clear()
+
+
+  @classmethod
+  def _getKeyset(reportclass, query):
+    '''
+    Returns the sort key of a query as a list of tuples with the field
+    name, its attribute name and a flag for descending order. The primary
+    key is added to make the sort key unique.
+    Keyset pagination is only possible when all sort fields are non-null
+    fields of the model. None is returned otherwise.
+    '''
+    if query.query.extra_order_by or not query.query.default_ordering:
+      return None
+    ordering = list(query.query.order_by) or list(query.model._meta.ordering)
+    keyset = []
+    for o in ordering:
+      if not isinstance(o, str) or o == '?':
+        return None
+      desc = o.startswith('-')
+      name = o.lstrip('-')
+      if name == 'pk':
+        name = query.model._meta.pk.name
+      try:
+        field = query.model._meta.get_field(name)
+      except Exception:
+        # Fields of related models, extra select fields and annotations
+        return None
+      if not field.concrete or field.null:
+        return None
+      if field.is_relation:
+        # A foreign key is only sorted on its value when the related model
+        # is sorted on its primary key
+        related = field.related_model._meta
+        if related.ordering and related.ordering != [related.pk.name]:
+          return None
+      keyset.append( (name, field.attname, desc) )
+    pk = query.model._meta.pk
+    if not any(i[1] == pk.attname for i in keyset):
+      keyset.append( (pk.name, pk.attname, keyset[-1][2] if keyset else False) )
+    return keyset
+
+
+  @classmethod
+  def _getBoundary(reportclass, request, query, keyset, digest, page):
+    '''
+    Returns the sort key of the last record of the previous page, as sent
+    back by the client in the "lastkey" argument. None is returned when the
+    argument is missing or belongs to another query or page.
+    '''
+    try:
+      lastkey = json.loads(request.GET['lastkey'])
+      if lastkey['query'] != digest or lastkey['page'] != page - 1 or len(lastkey['key']) != len(keyset):
+        return None
+      return [
+        query.model._meta.get_field(i[0]).to_python(v)
+        for i, v in zip(keyset, lastkey['key'])
+        ]
+    except Exception:
+      return None
+
+
+  @classmethod
+  def _getPage(reportclass, request, query, keyset, fields, page):
+    '''
+    Retrieves a page of records. When the client sends the sort key of the
+    last record of the previous page the page is selected with a condition
+    on that key, which is as fast for the last page as for the first.
+    Otherwise, the page is selected with an offset.
+    The sort key of the last record of the page is stored in the attribute
+    "lastkey" of the request, to be returned to the client.
+    '''
+    query = query.order_by(*[ ('-%s' % i[1]) if i[2] else i[1] for i in keyset ])
+    try:
+      sql, params = query.query.sql_with_params()
+    except Exception:
+      return []
+    digest = hashlib.md5(repr((request.database, sql, params, request.pagesize)).encode('utf-8')).hexdigest()
+    first = (page - 1) * request.pagesize
+    boundary = reportclass._getBoundary(request, query, keyset, digest, page) if page > 1 else None
+    if boundary:
+      # Records sorted after the boundary on the first field, or equal on
+      # the first field and sorted after it on the next fields
+      condition = None
+      for idx in range(len(keyset) - 1, -1, -1):
+        attname, desc = keyset[idx][1:]
+        after = Q(**{"%s__%s" % (attname, 'lt' if desc else 'gt'): boundary[idx]})
+        if condition is None:
+          condition = after
+        else:
+          condition = after | (Q(**{attname: boundary[idx]}) & condition)
+      query = query.filter(condition)
+      first = 0
+    # The rows include the first record of the next page, like the offset
+    # based retrieval always did
+    extra = [ i[1] for i in keyset if i[1] not in fields ]
+    rows = query[first:first + request.pagesize + 1].values(*(fields + extra))
+    for cnt, row in enumerate(rows):
+      if cnt == request.pagesize - 1:
+        request.lastkey = {
+          'query': digest,
+          'page': page,
+          'key': [ row[i[1]] for i in keyset ]
+          }
+      yield row
+
+
   @classmethod
   def _generate_json_data(reportclass, request, *args, **kwargs):
     page = 'page' in request.GET and int(request.GET['page']) or 1
@@ -1012,13 +1121,14 @@ class GridReport(View):
       query = reportclass.filter_items(request, reportclass.basequeryset(request, *args, **kwargs), False).using(request.database)
     else:
       query = reportclass.filter_items(request, reportclass.basequeryset).using(request.database)
-    recs = query.count()
+    recs = reportclass._getCount(request, query)
     total_pages = math.ceil(float(recs) / request.pagesize)
     if page > total_pages:
       page = total_pages
     if page < 1:
       page = 1
     query = reportclass._apply_sort(request, query)
+    keyset = None if hasattr(reportclass, 'query') else reportclass._getKeyset(query)
 
     yield '{"total":%d,\n' % total_pages
     yield '"page":%d,\n' % page
@@ -1034,7 +1144,13 @@ class GridReport(View):
 
     # GridReport
     fields = [ i.field_name for i in reportclass.rows if i.field_name ]
-    for i in hasattr(reportclass, 'query') and reportclass.query(request, query[cnt - 1:cnt + request.pagesize]) or query[cnt - 1:cnt + request.pagesize].values(*fields):
+    if keyset:
+      rows = reportclass._getPage(request, query, keyset, fields, page)
+    elif hasattr(reportclass, 'query'):
+      rows = reportclass.query(request, query[cnt - 1:cnt + request.pagesize])
+    else:
+      rows = query[cnt - 1:cnt + request.pagesize].values(*fields)
+    for i in rows:
       if first:
         r = [ '{' ]
         first = False
@@ -1060,11 +1176,16 @@ class GridReport(View):
           r.append(', "%s":%s' % (f.name, s))
       r.append('}')
       yield ''.join(r)
-    yield '\n]}\n'
+    if getattr(request, 'lastkey', None):
+      yield '\n],"lastkey":%s}\n' % json.dumps(request.lastkey, default=str)
+    else:
+      yield '\n]}\n'
 
 
   @classmethod
   def post(reportclass, request, *args, **kwargs):
+    # Record counts cached before the changes are no longer valid
+    reportclass.clearCountCache()
     if len(request.FILES) > 0:
       # Note: the detection of the type of uploaded file depends on the
       # browser setting the right mime type of the file.
@@ -1465,7 +1586,7 @@ class GridReport(View):
             firsterror = True
             yield '<tr style="text-align: center"><th colspan="5">%s</td></th>' % filename
             data = EncodedCSVReader(file, delimiter=delimiter)
-            for error in parseCSVdata(reportclass.model, data, user=request.user, database=request.database, ping=True):
+            for error in parseCSVdata(reportclass.model, data, user=request.user, database=request.database, ping=True, bulk='bulk' in request.POST):
               if error[0] == DEBUG:
                 # Yield some result so we can detect disconnect clients and interrupt the upload
                 yield ' '
@@ -1563,7 +1684,7 @@ class GridReport(View):
           for ws_name in wb.sheetnames:
             rowprefix = '' if numsheets == 1 else "%s " % ws_name
             ws = wb[ws_name]
-            for error in parseExcelWorksheet(reportclass.model, ws, user=request.user, database=request.database, ping=True):
+            for error in parseExcelWorksheet(reportclass.model, ws, user=request.user, database=request.database, ping=True, bulk='bulk' in request.POST):
               if error[0] == DEBUG:
                 # Yield some result so we can detect disconnect clients and interrupt the upload
                 yield ' '
@@ -1888,9 +2009,9 @@ class GridPivot(GridReport):
     else:
       page = 'page' in request.GET and int(request.GET['page']) or 1
       if isinstance(reportclass.basequeryset, collections.Callable):
-        recs = reportclass.filter_items(request, reportclass.basequeryset(request, *args, **kwargs), False).using(request.database).count()
+        recs = reportclass._getCount(request, reportclass.filter_items(request, reportclass.basequeryset(request, *args, **kwargs), False).using(request.database))
       else:
-        recs = reportclass.filter_items(request, reportclass.basequeryset).using(request.database).count()
+        recs = reportclass._getCount(request, reportclass.filter_items(request, reportclass.basequeryset).using(request.database))
       total_pages = math.ceil(float(recs) / request.pagesize)
       if page > total_pages:
         page = total_pages
@@ -2474,6 +2474,8 @@ function import_show(title,paragraph,multiple,fxhr)
               gettext('The first row should contain the field names.') + '<br><br>' +
               '<input type="checkbox" autocomplete="off" name="erase" value="yes"/>&nbsp;&nbsp;'+
               gettext('First delete all existing records AND ALL RELATED TABLES') + '<br><br>' +
+              '<input type="checkbox" autocomplete="off" name="bulk" value="yes"/>&nbsp;&nbsp;'+
+              gettext('Load the data in bulk mode, which is faster for big data files') + '<br><br>' +
             '</p>';
     if (isDragnDropUploadCapable()) {
       modalcontent += ''+
@@ -15,13 +15,19 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import codecs
+import gzip
+from io import BytesIO
 import os
 import os.path
 
 from django.core import management
+from django.db import connection, transaction
 from django.http.response import StreamingHttpResponse
-from django.test import TestCase, TransactionTestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 
+from freppledb.common.dataload import EncodedCSVReader
+from freppledb.common.dbcopy import CopyStream, encodeRow
 from freppledb.common.models import User
 import freppledb.common as common
 import freppledb.input as input
@@ -45,6 +51,71 @@ class DataLoadTest(TestCase):
     self.fail("Didn't find expected number of parameters")
 
 
+class ParameterCacheTest(TransactionTestCase):
+
+  def test_invalidation(self):
+    param = common.models.Parameter.objects.get_or_create(pk='cache.test')[0]
+    param.value = 'first'
+    param.save()
+    self.assertEqual(common.models.Parameter.getValues()['cache.test'], 'first')
+    param.value = 'second'
+    param.save()
+    self.assertEqual(common.models.Parameter.getValues()['cache.test'], 'second')
+    param.delete()
+    self.assertNotIn('cache.test', common.models.Parameter.getValues())
+
+  def test_transaction(self):
+    common.models.Parameter.objects.create(name='cache.test', value='committed')
+    self.assertEqual(common.models.Parameter.getValues()['cache.test'], 'committed')
+    # A transaction sees its own changes, but they aren't cached
+    with transaction.atomic():
+      with connection.cursor() as cursor:
+        cursor.execute("update common_parameter set value = 'uncommitted' where name = 'cache.test'")
+      self.assertEqual(common.models.Parameter.getValues()['cache.test'], 'uncommitted')
+      self.assertEqual(common.models.Parameter.getValue('cache.test'), 'uncommitted')
+      transaction.set_rollback(True)
+    self.assertEqual(common.models.Parameter.getValues()['cache.test'], 'committed')
+    self.assertEqual(common.models.Parameter.getValue('cache.test'), 'committed')
+
+
+class CopyStreamTest(SimpleTestCase):
+
+  def test_encode_row(self):
+    self.assertEqual(
+      encodeRow(('a\tb\\c', None, 1, 2.5, True)),
+      'a\\tb\\\\c\t\\N\t1\t2.5\tt\n'
+      )
+
+  def test_chunked_read(self):
+    rows = [('row %s' % i, i) for i in range(100)]
+    stream = CopyStream(rows)
+    chunks = []
+    while True:
+      data = stream.read(64)
+      if not data:
+        break
+      self.assertLessEqual(len(data), 64)
+      chunks.append(data)
+    self.assertEqual(''.join(chunks), ''.join(encodeRow(r) for r in rows))
+    self.assertEqual(stream.count, 100)
+
+
+class EncodedCSVReaderTest(SimpleTestCase):
+
+  def test_bom(self):
+    data = BytesIO(codecs.BOM_UTF16_LE + 'name;description\r\nitem;"two\nlines"\r\n'.encode('utf_16_le'))
+    self.assertEqual(
+      list(EncodedCSVReader(data, delimiter=';')),
+      [['name', 'description'], ['item', 'two\nlines']]
+      )
+
+  def test_gzip(self):
+    data = BytesIO(gzip.compress(codecs.BOM_UTF8 + 'name,cost\nitem,1.5\n'.encode('utf_8')))
+    reader = EncodedCSVReader(data, chunksize=16)
+    self.assertEqual(list(reader), [['name', 'cost'], ['item', '1.5']])
+    self.assertEqual(reader.bytesread, len(data.getvalue()))
+
+
 class UserPreferenceTest(TestCase):
 
   def test_get_set_preferences(self):
@@ -54,6 +125,50 @@ class UserPreferenceTest(TestCase):
     user.setPreference('test', {'a': 1, 'b': 'c'})
     after = user.getPreference('test')
     self.assertEqual(after, {'a': 1, 'b': 'c'})
+    user.setPreference('test', {'a': 2})
+    self.assertEqual(user.getPreference('test'), {'a': 2})
+    user.setPreference('test', None)
+    self.assertIsNone(user.getPreference('test'))
+
+
+class UserPreferenceCacheTest(TransactionTestCase):
+
+  def setUp(self):
+    # The cache isn't verified against the database during the test, unless
+    # the test asks for it
+    common.models.UserPreference._cache.clear()
+    self.cacheInterval = common.models.UserPreference.cacheInterval
+    common.models.UserPreference.cacheInterval = 3600
+
+  def tearDown(self):
+    common.models.UserPreference.cacheInterval = self.cacheInterval
+    common.models.UserPreference._cache.clear()
+
+  def test_cache(self):
+    user = User.objects.all().get(username='admin')
+    user.setPreference('test', {'a': 1})
+
+    # The second read of a preference is served from the cache
+    self.assertEqual(user.getPreference('test'), {'a': 1})
+    with self.assertNumQueries(0):
+      self.assertEqual(user.getPreference('test'), {'a': 1})
+
+    # Changes are written through to the cache
+    user.setPreference('test', {'a': 2})
+    with self.assertNumQueries(0):
+      self.assertEqual(user.getPreference('test'), {'a': 2})
+
+    # Changes made outside of this process are picked up when the versions
+    # are verified
+    with connection.cursor() as cursor:
+      cursor.execute('''
+        update common_preference
+        set value = '{"a": 3}', lastmodified = lastmodified + interval '1 second'
+        where user_id = %s and property = 'test'
+        ''', (user.id,))
+    self.assertEqual(user.getPreference('test'), {'a': 2})
+    common.models.UserPreference.cacheInterval = 0
+    self.assertEqual(user.getPreference('test'), {'a': 3})
 
 
 class ExcelTest(TransactionTestCase):
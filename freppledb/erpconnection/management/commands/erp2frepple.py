@@ -18,6 +18,7 @@
 import csv
 from datetime import datetime
 import os
+from time import time, process_time
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
@@ -27,7 +28,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from freppledb import VERSION
 from freppledb.common.models import User
-from freppledb.execute.models import Task
+from freppledb.execute.models import Task, TaskStep
 
 from ...utils import getERPconnection
 
@@ -136,73 +137,30 @@ class Command(BaseCommand):
 
       # Extract all files
       try:
-        self.extractLocation()
-        self.task.status = '6%'
-        self.task.save(using=self.database)
-
-        self.extractCustomer()
-        self.task.status = '12%'
-        self.task.save(using=self.database)
-
-        self.extractItem()
-        self.task.status = '18%'
-        self.task.save(using=self.database)
-
-        self.extractSupplier()
-        self.task.status = '24%'
-        self.task.save(using=self.database)
-
-        self.extractResource()
-        self.task.status = '30%'
-        self.task.save(using=self.database)
-
-        self.extractSalesOrder()
-        self.task.status = '36%'
-        self.task.save(using=self.database)
-
-        self.extractOperation()
-        self.task.status = '42%'
-        self.task.save(using=self.database)
-
-        self.extractSuboperation()
-        self.task.status = '48%'
-        self.task.save(using=self.database)
-
-        self.extractOperationResource()
-        self.task.status = '54%'
-        self.task.save(using=self.database)
-
-        self.extractOperationMaterial()
-        self.task.status = '60%'
-        self.task.save(using=self.database)
-
-        self.extractItemSupplier()
-        self.task.status = '66%'
-        self.task.save(using=self.database)
-
-        self.extractCalendar()
-        self.task.status = '72%'
-        self.task.save(using=self.database)
-
-        self.extractCalendarBucket()
-        self.task.status = '78%'
-        self.task.save(using=self.database)
-
-        self.extractBuffer()
-        self.task.status = '84%'
-        self.task.save(using=self.database)
-
-        self.extractItemSupplier()
-        self.task.status = '90%'
-        self.task.save(using=self.database)
-
-        self.extractCalendar()
-        self.task.status = '96%'
-        self.task.save(using=self.database)
-
-        self.extractCalendarBucket()
-        self.task.status = '100%'
-        self.task.save(using=self.database)
+        extracts = [
+          self.extractLocation, self.extractCustomer, self.extractItem,
+          self.extractSupplier, self.extractResource, self.extractSalesOrder,
+          self.extractOperation, self.extractSuboperation,
+          self.extractOperationResource, self.extractOperationMaterial,
+          self.extractItemSupplier, self.extractCalendar,
+          self.extractCalendarBucket, self.extractBuffer
+          ]
+        steps = []
+        for idx, extract in enumerate(extracts):
+          started = datetime.now()
+          wallclock = time()
+          cputime = process_time()
+          extract()
+          steps.append(TaskStep(
+            task=self.task, sequence=idx + 1, description=extract.__name__,
+            weight=1, started=started, wallclock=time() - wallclock,
+            cputime=process_time() - cputime, memory=TaskStep.getPeakMemory()
+            ))
+          self.task.setProgress(
+            status='%d%%' % int(100.0 * (idx + 1) / len(extracts)),
+            using=self.database
+            )
+        TaskStep.objects.using(self.database).bulk_create(steps)
 
         self.task.status = 'Done'
 
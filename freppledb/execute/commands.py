@@ -15,11 +15,11 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import logging
 
-from django.db import DEFAULT_DB_ALIAS
+from django.db import connections, DEFAULT_DB_ALIAS
 from django.utils.translation import ugettext_lazy as _
 
 from freppledb.common.commands import PlanTaskRegistry, PlanTask
@@ -36,7 +36,7 @@ class MakePlanFeasible(PlanTask):
 
   @classmethod
   def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
-    if 'supply' in os.environ:
+    if 'supply' in os.environ and 'simulation' not in os.environ:
       return 1
     else:
       return -1
@@ -71,7 +71,7 @@ class SupplyPlanning(PlanTask):
 
   @classmethod
   def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
-    if 'supply' in os.environ:
+    if 'supply' in os.environ and 'simulation' not in os.environ:
       return 1
     else:
       return -1
@@ -145,6 +145,121 @@ class SupplyPlanning(PlanTask):
     frepple.printsize()
 
 
+@PlanTaskRegistry.register
+class SimulationLoop(PlanTask):
+  '''
+  Runs a complete simulation with the model kept in memory.
+
+  The simulation command launches this task when it runs with the inprocess
+  option. The model is loaded only once. At the start of every bucket the
+  model in memory is synchronized with the records the simulation changed
+  in the database, and the plan is regenerated and exported in delta mode.
+  '''
+
+  description = "Simulate"
+  sequence = 150
+
+  @classmethod
+  def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+    if 'simulation' in os.environ:
+      return 10
+    else:
+      return -1
+
+  @classmethod
+  def run(cls, database=DEFAULT_DB_ALIAS, **kwargs):
+    from freppledb.execute.management.commands.simulation import Simulator, load_class
+
+    horizon = int(os.environ.get('simulation_horizon', '60'))
+    step = int(os.environ.get('simulation_step', '1'))
+    verbosity = int(os.environ.get('simulation_verbosity', '1'))
+    if os.environ.get('simulation_class', None):
+      simulator = load_class(os.environ['simulation_class'])(database=database, verbosity=verbosity)
+    else:
+      simulator = Simulator(database=database, verbosity=verbosity)
+    simulator.buckets = 1
+
+    # Plans are generated with the model in memory rather than by launching
+    # a new planning engine process
+    simulator.generate_plan = lambda strt, nd: cls.replan(database, strt)
+
+    # Changes in the database after the model was loaded are synchronized
+    cls.synchronized = datetime.now()
+
+    param = Parameter.objects.all().using(database).get_or_create(name='currentdate')[0]
+    try:
+      curdate = datetime.strptime(param.value, "%Y-%m-%d %H:%M:%S").date()
+    except:
+      curdate = datetime.now().date()
+    bckt_list = [ curdate + timedelta(days=i) for i in range(0, horizon + 1, step) ]
+
+    for idx in range(1, len(bckt_list)):
+      strt = bckt_list[idx - 1]
+      nd = bckt_list[idx]
+      if cls.task:
+        cls.task.message = 'Simulating bucket from %s to %s' % (strt, nd)
+        cls.task.save(using=database)
+      logger.info("Start simulating bucket from %s to %s (%s out of %s)" % (strt, nd, idx, len(bckt_list)))
+      simulator.buckets += 1
+      param.value = strt.strftime("%Y-%m-%d %H:%M:%S")
+      param.save(using=database)
+      simulator.simulate_bucket(strt, nd)
+
+    simulator.show_metrics()
+
+  @classmethod
+  def replan(cls, database, strt):
+    import frepple
+    from freppledb.execute.export_database_plan import export
+
+    frepple.settings.current = datetime(strt.year, strt.month, strt.day)
+    cls.synchronize(database)
+
+    # Erase the proposed operationplans, and plan again
+    frepple.erase(False)
+    SupplyPlanning.run(database=database)
+    export(database=database, delta=True).run()
+    cls.synchronized = datetime.now()
+
+  @classmethod
+  def synchronize(cls, database):
+    '''
+    Applies the changes of the simulation to the model in memory.
+    All records written since the last synchronization are picked up: they
+    are the inventory changes, the new and closed demands and the orders
+    that were confirmed or closed.
+    The changed records are read with the same load tasks as a complete
+    plan. The load tasks skip closed records, which are removed here.
+    '''
+    import frepple
+    from freppledb.input.commands import loadBuffers, loadDemand, loadOperationPlans
+
+    with connections[database].cursor() as cursor:
+      cursor.execute('''
+        select name from demand
+        where lastmodified >= %s and status not in ('open', 'quote')
+        ''', (cls.synchronized,))
+      for i in cursor.fetchall():
+        try:
+          frepple.demand(name=i[0], action='R')
+        except Exception as e:
+          logger.error("**** %s ****" % e)
+      cursor.execute('''
+        select id, type from operationplan
+        where lastmodified >= %s and owner_id is null
+          and type in ('PO', 'MO', 'DO') and status = 'closed'
+        ''', (cls.synchronized,))
+      for i in cursor.fetchall():
+        try:
+          frepple.operationplan(id=i[0], ordertype=i[1], action='R')
+        except Exception as e:
+          logger.error("**** %s ****" % e)
+
+    loadBuffers.runChanged(database, 'buffer', cls.synchronized)
+    loadDemand.runChanged(database, 'demand', cls.synchronized)
+    loadOperationPlans.runChanged(database, 'operationplan', cls.synchronized)
+
+
 @PlanTaskRegistry.register
 class ExportStatic(PlanTask):
 
@@ -170,7 +285,7 @@ class ExportPlan(PlanTask):
 
   @classmethod
   def getWeight(cls, database=DEFAULT_DB_ALIAS, **kwargs):
-    if 'supply' in os.environ:
+    if 'supply' in os.environ and 'simulation' not in os.environ:
       return 1
     else:
       return -1
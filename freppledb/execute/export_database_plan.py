@@ -28,15 +28,20 @@ import json
 import os
 import logging
 from psycopg2.extensions import adapt
+from queue import Queue, Empty
 from subprocess import Popen, PIPE
 import sys
-import tempfile
 from time import time
 from threading import Thread
+from zlib import crc32
 
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
 from django.conf import settings
 
+from freppledb.common.dbcopy import copyRows
+from freppledb.common.models import Parameter
+from freppledb.output.models import InventorySummary, ResourceBucketSummary
+
 import frepple
 
 logger = logging.getLogger(__name__)
@@ -61,9 +66,36 @@ class DatabasePipe(Thread):
       pass
 
 
+class DatabaseWorker(Thread):
+  '''
+  An auxiliary class that executes export steps from a shared queue over its
+  own PostgreSQL connection, until the queue is empty.
+  '''
+  def __init__(self, owner, queue):
+    self.owner = owner
+    self.queue = queue
+    self.errors = []
+    super(DatabaseWorker, self).__init__()
+
+  def run(self):
+    try:
+      while True:
+        try:
+          f, args = self.queue.get_nowait()
+        except Empty:
+          break
+        try:
+          f(self.owner, *args)
+        except Exception as e:
+          logger.error("Error during export: %s" % e)
+          self.errors.append(e)
+    finally:
+      connections[self.owner.database].close()
+
+
 class export:
 
-  def __init__(self, cluster=-1, verbosity=1, database=None):
+  def __init__(self, cluster=-1, verbosity=1, database=None, workers=None, delta=None):
     self.cluster = cluster
     self.verbosity = verbosity
     if database:
@@ -75,6 +107,92 @@ class export:
         self.database = DEFAULT_DB_ALIAS
     self.encoding = 'UTF8'
     self.timestamp = str(datetime.now())
+    self.buckets = None
+    # Number of parallel connections used for the export.
+    # The value can be passed as an argument, as an environment variable
+    # (runplan --env=exportworkers=8) or as a parameter.
+    if workers is None:
+      workers = os.environ.get('exportworkers', None) or Parameter.getValue('export.workers', self.database, '4')
+    try:
+      self.workers = max(int(workers), 1)
+    except ValueError:
+      self.workers = 4
+    # In delta mode only new and changed records are written to the plan tables.
+    # The value can be passed as an argument, as an environment variable
+    # (runplan --env=exportdelta=true) or as a parameter.
+    if delta is None:
+      delta = os.environ.get('exportdelta', None) or Parameter.getValue('export.delta', self.database, 'false')
+    if isinstance(delta, str):
+      delta = delta.lower() == 'true'
+    # A delta export is always computed on the complete model
+    self.delta = delta and cluster == -1
+    # Identifiers of all exported operationplans
+    self.exported = set()
+
+
+  def inPartition(self, obj, partition):
+    '''
+    Verifies whether an object belongs to the cluster and partition being
+    exported. Objects are assigned to a partition based on their cluster.
+    '''
+    if self.cluster != -1 and self.cluster != obj.cluster:
+      return False
+    return partition is None or obj.cluster % self.workers == partition
+
+
+  def inResourcePartition(self, res, partition):
+    '''
+    Verifies whether a resource belongs to the cluster and partition being
+    exported. Resources are assigned to a partition based on a hash of their name.
+    '''
+    if self.cluster != -1 and self.cluster != res.cluster:
+      return False
+    return partition is None or crc32(res.name.encode('utf-8')) % self.workers == partition
+
+
+  def partitionLabel(self, partition):
+    if partition is None:
+      return ''
+    else:
+      return ' (partition %d of %d)' % (partition + 1, self.workers)
+
+
+  def mergeDelta(self, cursor, table, staging, columns, scope, lastmodified=True):
+    '''
+    Synchronizes a plan table with the content of a staging table.
+
+    Every record is identified by a fingerprint of its exported columns. Records
+    in the scope of the export that don't appear in the staging table are
+    deleted, and only new or changed records from the staging table are inserted.
+    The scope is a SQL condition on the plan table.
+    '''
+    def fingerprint(alias):
+      return "md5(row(%s)::text)" % ','.join([ "%s.%s" % (alias, c) for c in columns ])
+
+    cursor.execute(
+      "create temporary table %s_fp as select distinct %s as fp from %s"
+      % (staging, fingerprint(staging), staging)
+      )
+    cursor.execute('''
+      delete from %s
+      where %s
+      and not exists (select 1 from %s_fp where %s_fp.fp = %s)
+      ''' % (table, scope, staging, staging, fingerprint(table)))
+    deleted = cursor.rowcount
+    cursor.execute('''
+      insert into %s (%s%s)
+      select %s%s
+      from %s
+      where not exists (select 1 from %s where %s and %s = %s)
+      ''' % (
+        table, ','.join(columns), ',lastmodified' if lastmodified else '',
+        ','.join(columns), ',%s' if lastmodified else '',
+        staging, table, scope, fingerprint(table), fingerprint(staging)
+        ), (self.timestamp,) if lastmodified else None)
+    inserted = cursor.rowcount
+    cursor.execute("drop table %s_fp" % staging)
+    if self.verbosity:
+      logger.info("Delta export of %s: %d records deleted, %d records inserted" % (table, deleted, inserted))
 
 
   def getPegging(self, opplan):
@@ -92,9 +210,7 @@ class export:
     if opplan.setupend != opplan.start:
       pln["setup"] = opplan.setup
       pln["setupend"] = opplan.setupend.strftime("%Y-%m-%d %H:%M:%S")
-    # We need to double any backslash to assure that the string remains
-    # valid when passing it through postgresql (which eats them away)
-    return json.dumps(pln).replace("\\", "\\\\")
+    return json.dumps(pln)
 
 
   def truncate(self):
@@ -102,9 +218,12 @@ class export:
     if self.verbosity:
       logger.info("Emptying database plan tables...")
     starttime = time()
-    if self.cluster == -1:
+    if self.delta:
+      # Delta export: the other tables are synchronized during the export
+      cursor.execute("truncate table out_problem, out_constraint, out_inventoryplan, out_resourcebucketplan")
+    elif self.cluster == -1:
       # Complete export for the complete model
-      cursor.execute("truncate table out_problem, out_resourceplan, out_constraint")
+      cursor.execute("truncate table out_problem, out_resourceplan, out_constraint, out_inventoryplan, out_resourcebucketplan, out_pegging")
       cursor.execute('''
         update operationplan
           set owner_id = null
@@ -145,6 +264,7 @@ class export:
         if i.cluster == self.cluster:
           cursor.execute(("insert into cluster_keys (name) values (%s);\n" % adapt(i.name).getquoted().decode(self.encoding)))
       cursor.execute("delete from out_constraint where demand in (select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id)")
+      cursor.execute("delete from out_pegging where demand in (select demand.name from demand inner join cluster_keys on cluster_keys.name = demand.item_id)")
       cursor.execute('''
         delete from operationplanmaterial
         using cluster_keys
@@ -215,6 +335,9 @@ class export:
       cursor.execute("delete from out_problem using cluster_keys where entity = 'operation' and owner = cluster_keys.name")
       cursor.execute("delete from operationplan using cluster_keys where (status='proposed' or status is null) and operationplan.name = cluster_keys.name")
       cursor.execute("drop table cluster_keys")
+      # The inventory profile and the resource rollup are always recomputed
+      # for all buffers and resources
+      cursor.execute("truncate table out_inventoryplan, out_resourcebucketplan")
     if self.verbosity:
       logger.info("Emptied plan tables in %.2f seconds" % (time() - starttime))
 
@@ -223,8 +346,8 @@ class export:
     if self.verbosity:
       logger.info("Exporting problems...")
     starttime = time()
-    cursor = connections[self.database].cursor()
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+
+    def getProblems():
       for i in frepple.problems():
         if isinstance(i.owner, frepple.operationplan):
           owner = i.owner.operation
@@ -232,18 +355,17 @@ class export:
           owner = i.owner
         if self.cluster != -1 and owner.cluster != self.cluster:
           continue
-        print(("%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-           i.entity, i.name, owner.name,
-           i.description, str(i.start), str(i.end),
-           round(i.weight, 8)
-        )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-      tmp,
-      'out_problem',
-      columns=('entity','name','owner', 'description', 'startdate', 'enddate', 'weight')
+        yield (
+          i.entity, i.name, owner.name,
+          i.description, i.start, i.end, i.weight
+          )
+
+    cursor = connections[self.database].cursor()
+    copyRows(
+      cursor, 'out_problem',
+      ('entity', 'name', 'owner', 'description', 'startdate', 'enddate', 'weight'),
+      getProblems()
       )
-      tmp.close()
     if self.verbosity:
       logger.info('Exported problems in %.2f seconds' % (time() - starttime))
 
@@ -252,34 +374,33 @@ class export:
     if self.verbosity:
       logger.info("Exporting constraints...")
     starttime = time()
-    cursor = connections[self.database].cursor()
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+
+    def getConstraints():
       for d in frepple.demands():
         if self.cluster != -1 and self.cluster != d.cluster:
           continue
         for i in d.constraints:
-          print(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-             d.name, i.entity, i.name,
-             isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name,
-             i.description, str(i.start), str(i.end),
-             round(i.weight, 8)
-           )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'out_constraint',
-        columns=('demand','entity','name','owner','description','startdate','enddate','weight')
-        )
-      tmp.close()
+          yield (
+            d.name, i.entity, i.name,
+            isinstance(i.owner, frepple.operationplan) and i.owner.operation.name or i.owner.name,
+            i.description, i.start, i.end, i.weight
+            )
+
+    cursor = connections[self.database].cursor()
+    copyRows(
+      cursor, 'out_constraint',
+      ('demand', 'entity', 'name', 'owner', 'description', 'startdate', 'enddate', 'weight'),
+      getConstraints()
+      )
     if self.verbosity:
       logger.info('Exported constraints in %.2f seconds' % (time() - starttime))
 
 
-  def exportOperationplans(self):
+  def exportOperationplans(self, partition=None):
 
     def getOperationPlans():
       for i in frepple.operations():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if not self.inPartition(i, partition):
           continue
         for j in i.operationplans:
           delay = j.delay
@@ -288,71 +409,71 @@ class export:
           if isinstance(i, frepple.operation_inventory):
             # Export inventory
             yield (
-              i.name, 'STCK', j.status, j.reference or '\\N', round(j.quantity, 8),
-              str(j.start), str(j.end), round(j.criticality, 8), j.delay,
-              self.getPegging(j), j.source or '\\N', self.timestamp,
-              '\\N', j.owner.id if j.owner and not j.owner.operation.hidden else '\\N',
-              j.operation.buffer.item.name, j.operation.buffer.location.name, '\\N', '\\N', '\\N',
-              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else '\\N',
-              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else '\\N',
+              i.name, 'STCK', j.status, j.reference or None, j.quantity,
+              j.start, j.end, j.criticality, j.delay,
+              self.getPegging(j), j.source or None, self.timestamp,
+              None, j.owner.id if j.owner and not j.owner.operation.hidden else None,
+              j.operation.buffer.item.name, j.operation.buffer.location.name, None, None, None,
+              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else None,
+              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else None,
               color, j.id
               )
           elif isinstance(i, frepple.operation_itemdistribution):
             # Export DO
             yield (
-              i.name, 'DO', j.status, j.reference or '\\N', round(j.quantity, 8),
-              str(j.start), str(j.end), round(j.criticality, 8), j.delay,
-              self.getPegging(j), j.source or '\\N', self.timestamp,
-              '\\N', j.owner.id if j.owner and not j.owner.operation.hidden else '\\N',
+              i.name, 'DO', j.status, j.reference or None, j.quantity,
+              j.start, j.end, j.criticality, j.delay,
+              self.getPegging(j), j.source or None, self.timestamp,
+              None, j.owner.id if j.owner and not j.owner.operation.hidden else None,
               j.operation.destination.item.name if j.operation.destination else j.operation.origin.item.name,
-              j.operation.destination.location.name if j.operation.destination else '\\N',
-              j.operation.origin.location.name if j.operation.origin else '\\N',
-              '\\N', '\\N',
-              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else '\\N',
-              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else '\\N',
+              j.operation.destination.location.name if j.operation.destination else None,
+              j.operation.origin.location.name if j.operation.origin else None,
+              None, None,
+              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else None,
+              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else None,
               color, j.id
               )
           elif isinstance(i, frepple.operation_itemsupplier):
             # Export PO
             yield (
-              i.name, 'PO', j.status, j.reference or '\\N', round(j.quantity, 8),
-              str(j.start), str(j.end), round(j.criticality, 8), j.delay,
-              self.getPegging(j), j.source or '\\N', self.timestamp,
-              '\\N', j.owner.id if j.owner and not j.owner.operation.hidden else '\\N',
-              j.operation.buffer.item.name, '\\N', '\\N',
+              i.name, 'PO', j.status, j.reference or None, j.quantity,
+              j.start, j.end, j.criticality, j.delay,
+              self.getPegging(j), j.source or None, self.timestamp,
+              None, j.owner.id if j.owner and not j.owner.operation.hidden else None,
+              j.operation.buffer.item.name, None, None,
               j.operation.buffer.location.name, j.operation.itemsupplier.supplier.name,
-              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else '\\N',
-              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else '\\N',
+              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else None,
+              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else None,
               color, j.id
               )
           elif not i.hidden:
             # Export MO
             yield (
-              i.name, 'MO', j.status, j.reference or '\\N', round(j.quantity, 8),
-              str(j.start), str(j.end), round(j.criticality, 8), j.delay,
-              self.getPegging(j), j.source or '\\N', self.timestamp,
-              i.name, j.owner.id if j.owner and not j.owner.operation.hidden else '\\N',
-              i.item.name if i.item else '\\N', '\\N', '\\N',
-              i.location.name if i.location else '\\N', '\\N',
-              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else '\\N',
-              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else '\\N',
+              i.name, 'MO', j.status, j.reference or None, j.quantity,
+              j.start, j.end, j.criticality, j.delay,
+              self.getPegging(j), j.source or None, self.timestamp,
+              i.name, j.owner.id if j.owner and not j.owner.operation.hidden else None,
+              i.item.name if i.item else None, None, None,
+              i.location.name if i.location else None, None,
+              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else None,
+              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else None,
               color, j.id
               )
           elif j.demand or (j.owner and j.owner.demand):
             # Export shipments (with automatically created delivery operations)
             yield (
-              i.name, 'DLVR', j.status, j.reference or '\\N', round(j.quantity, 8),
-              str(j.start), str(j.end), round(j.criticality, 8), j.delay,
-              self.getPegging(j), j.source or '\\N', self.timestamp,
-              '\\N', j.owner.id if j.owner and not j.owner.operation.hidden else '\\N',
-              j.operation.buffer.item.name, '\\N', '\\N', j.operation.buffer.location.name, '\\N',
-              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else '\\N',
-              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else '\\N',
+              i.name, 'DLVR', j.status, j.reference or None, j.quantity,
+              j.start, j.end, j.criticality, j.delay,
+              self.getPegging(j), j.source or None, self.timestamp,
+              None, j.owner.id if j.owner and not j.owner.operation.hidden else None,
+              j.operation.buffer.item.name, None, None, j.operation.buffer.location.name, None,
+              j.demand.name if j.demand else j.owner.demand.name if j.owner and j.owner.demand else None,
+              j.demand.due if j.demand else j.owner.demand.due if j.owner and j.owner.demand else None,
               color, j.id
               )
 
     if self.verbosity:
-      logger.info("Exporting operationplans...")
+      logger.info("Exporting operationplans%s..." % self.partitionLabel(partition))
     starttime = time()
     cursor = connections[self.database].cursor()
 
@@ -368,7 +489,7 @@ class export:
         enddate timestamp with time zone,
         criticality numeric(20,8),
         delay numeric,
-        plan json,
+        plan jsonb,
         source character varying(300),
         lastmodified timestamp with time zone NOT NULL,
         operation_id character varying(300),
@@ -384,12 +505,22 @@ class export:
         id integer NOT NULL
       );
       ''')
-    with tempfile.TemporaryFile(mode="w+t",encoding='utf-8') as tmp:
+
+    def trackOperationPlans():
       for p in getOperationPlans():
-        print("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % p, file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(file=tmp,table='tmp_operationplan')
-      tmp.close()
+        self.exported.add(p[-1])
+        yield p
+
+    copyRows(
+      cursor, 'tmp_operationplan',
+      (
+        'name', 'type', 'status', 'reference', 'quantity', 'startdate', 'enddate',
+        'criticality', 'delay', 'plan', 'source', 'lastmodified', 'operation_id',
+        'owner_id', 'item_id', 'destination_id', 'origin_id', 'location_id',
+        'supplier_id', 'demand_id', 'due', 'color', 'id'
+        ),
+      trackOperationPlans()
+      )
 
     # Merge temp table into the actual table
     cursor.execute('''
@@ -403,23 +534,23 @@ class export:
         location_id=tmp.location_id, supplier_id=tmp.supplier_id, demand_id=tmp.demand_id,
         due=tmp.due, color=tmp.color
       from tmp_operationplan as tmp
-      where operationplan.id = tmp.id;
+      where operationplan.id = tmp.id
+      and (
+        operationplan.name, operationplan.type, operationplan.status, operationplan.reference,
+        operationplan.quantity, operationplan.startdate, operationplan.enddate,
+        operationplan.criticality, operationplan.delay, operationplan.plan, operationplan.source,
+        operationplan.operation_id, operationplan.owner_id, operationplan.item_id,
+        operationplan.destination_id, operationplan.origin_id, operationplan.location_id,
+        operationplan.supplier_id, operationplan.demand_id, operationplan.due, operationplan.color
+        ) is distinct from (
+        tmp.name, tmp.type, tmp.status, tmp.reference,
+        tmp.quantity, tmp.startdate, tmp.enddate,
+        tmp.criticality, tmp.delay * interval '1 second', tmp.plan, tmp.source,
+        tmp.operation_id, tmp.owner_id, tmp.item_id,
+        tmp.destination_id, tmp.origin_id, tmp.location_id,
+        tmp.supplier_id, tmp.demand_id, tmp.due, tmp.color
+        );
       ''')
-    cursor.execute('''
-      with cte as (select id from operationplan where status in ('confirmed','approved') and type = 'MO' and
-      not exists (select 1 from tmp_operationplan where id = operationplan.id))
-      delete from operationplanmaterial where exists (select 1 from cte where cte.id = operationplan_id)
-    ''')
-    cursor.execute('''
-      with cte as (select id from operationplan where status in ('confirmed','approved') and type = 'MO' and
-      not exists (select 1 from tmp_operationplan where id = operationplan.id))
-      delete from operationplanresource where exists (select 1 from cte where cte.id = operationplan_id)
-    ''')
-    cursor.execute('''
-      delete from operationplan where status in ('confirmed','approved') and type = 'MO' and
-      not exists (select 1 from tmp_operationplan where id = operationplan.id)
-    ''')
-
     cursor.execute('''
       insert into operationplan
         (name,type,status,reference,quantity,startdate,enddate,
@@ -441,6 +572,59 @@ class export:
         where operationplan.id = tmp_operationplan.id
         );
       ''')
+    cursor.execute("drop table tmp_operationplan")
+
+    if partition is None:
+      self.finishOperationplans()
+    if self.verbosity:
+      logger.info('Exported operationplans%s in %.2f seconds' % (self.partitionLabel(partition), time() - starttime))
+
+
+  def finishOperationplans(self):
+    '''
+    Completes the export of the operationplans of all partitions.
+    '''
+    cursor = connections[self.database].cursor()
+
+    # Collect the operationplans that weren't exported.
+    # These are the confirmed and approved manufacturing orders. In a delta
+    # export this also includes the proposed operationplans.
+    cursor.execute("create temporary table tmp_exported (id integer primary key)")
+    copyRows(cursor, 'tmp_exported', ('id',), ((i,) for i in self.exported))
+    cursor.execute('''
+      create temporary table tmp_stale as
+      select id from operationplan
+      where (
+        (status in ('confirmed','approved') and type = 'MO')
+        %s
+        )
+      and not exists (select 1 from tmp_exported where tmp_exported.id = operationplan.id)
+      ''' % (
+        "or status = 'proposed' or status is null or type = 'STCK'" if self.delta else ''
+      ))
+    cursor.execute('''
+      update operationplan
+        set owner_id = null
+        where owner_id in (select id from tmp_stale)
+      ''')
+    cursor.execute('''
+      delete from operationplanmaterial
+      using tmp_stale
+      where operationplanmaterial.operationplan_id = tmp_stale.id
+      ''')
+    cursor.execute('''
+      delete from operationplanresource
+      using tmp_stale
+      where operationplanresource.operationplan_id = tmp_stale.id
+      ''')
+    cursor.execute('''
+      delete from operationplan
+      using tmp_stale
+      where operationplan.id = tmp_stale.id
+      ''')
+    if self.delta and self.verbosity:
+      logger.info("Delta export of operationplan: %d records deleted" % cursor.rowcount)
+    cursor.execute("drop table tmp_stale, tmp_exported")
 
     #update demand table specific fields
     cursor.execute('''
@@ -456,6 +640,8 @@ class export:
           deliverydate = cte.deliverydate
         from cte
         where cte.demand_id = demand.name
+        and (demand.delay, demand.plannedquantity, demand.deliverydate)
+          is distinct from (cte.delay, cte.plannedquantity, cte.deliverydate)
       ''')
     cursor.execute('''
       update demand
@@ -473,66 +659,126 @@ class export:
       where status in ('open','quote') and plannedquantity is null
       ''')
 
-    if self.verbosity:
-      logger.info('Exported operationplans in %.2f seconds' % (time() - starttime))
 
+  def exportOperationPlanMaterials(self, partition=None):
 
-  def exportOperationPlanMaterials(self):
-    if self.verbosity:
-      logger.info("Exporting operationplan materials...")
-    starttime = time()
-    cursor = connections[self.database].cursor()
-    currentTime = self.timestamp
-    updates = []
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+    def getFlowplans():
       for i in frepple.buffers():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if not self.inPartition(i, partition):
           continue
         for j in i.flowplans:
-          #if the record is confirmed, it is already in the table.
           if not j.operationplan.id:
             print(
               "Warning: skip exporting uninitialized operationplan",
               j.operationplan.operation.name, j.operationplan.quantity, j.operationplan.start, j.operationplan.end
               )
           elif j.status == 'confirmed':
-            updates.append('''
-            update operationplanmaterial
-            set onhand=%s, flowdate='%s'
-            where status = 'confirmed' and item_id = %s
-              and location_id = %s and operationplan_id = %s;
-            ''' % (round(j.onhand, 8), str(j.date), adapt(j.buffer.item.name),
-                   adapt(j.buffer.location.name), j.operationplan.id ))
+            # A confirmed record is already in the table: only onhand and date are updated
+            confirmed.append((
+              j.operationplan.id, j.buffer.item.name, j.buffer.location.name, j.onhand, j.date
+              ))
           else:
-            print(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-               j.operationplan.id, j.buffer.item.name, j.buffer.location.name,
-               round(j.quantity, 8),
-               str(j.date), round(j.onhand, 8), round(j.minimum, 8), round(j.period_of_cover, 8), j.status, currentTime
-               )), file=tmp)
-
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'operationplanmaterial',
-        columns=('operationplan_id', 'item_id', 'location_id', 'quantity', 'flowdate', 'onhand', 
-                 'minimum', 'periodofcover', 'status', 'lastmodified')
-        )
-      tmp.close()
-    if len(updates) > 0:
-      cursor.execute('\n'.join(updates))
-    if self.verbosity:
-      logger.info('Exported operationplan materials in %.2f seconds' % (time() - starttime))
-
+            yield (
+              j.operationplan.id, j.buffer.item.name, j.buffer.location.name,
+              j.quantity, j.date, j.onhand, j.minimum, j.period_of_cover,
+              j.status, self.timestamp
+              )
 
-  def exportOperationPlanResources(self):
     if self.verbosity:
-      logger.info("Exporting operationplan resources...")
+      logger.info("Exporting operationplan materials%s..." % self.partitionLabel(partition))
     starttime = time()
     cursor = connections[self.database].cursor()
-    currentTime = self.timestamp
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+    confirmed = []
+    if self.delta:
+      cursor.execute('''
+        create temporary table tmp_opplanmat (
+          operationplan_id integer,
+          item_id character varying(300),
+          location_id character varying(300),
+          quantity numeric(20,8),
+          flowdate timestamp with time zone,
+          onhand numeric(20,8),
+          minimum numeric(20,8),
+          periodofcover numeric(20,8),
+          status character varying(20),
+          lastmodified timestamp with time zone
+          )
+        ''')
+      cursor.execute('''
+        create temporary table tmp_opplanmat_scope (
+          item_id character varying(300),
+          location_id character varying(300)
+          )
+        ''')
+      copyRows(
+        cursor, 'tmp_opplanmat_scope', ('item_id', 'location_id'),
+        (
+          (i.item.name, i.location.name)
+          for i in frepple.buffers()
+          if self.inPartition(i, partition)
+        ))
+    copyRows(
+      cursor, 'tmp_opplanmat' if self.delta else 'operationplanmaterial',
+      (
+        'operationplan_id', 'item_id', 'location_id', 'quantity', 'flowdate',
+        'onhand', 'minimum', 'periodofcover', 'status', 'lastmodified'
+        ),
+      getFlowplans()
+      )
+    if self.delta:
+      self.mergeDelta(
+        cursor, 'operationplanmaterial', 'tmp_opplanmat',
+        (
+          'operationplan_id', 'item_id', 'location_id', 'quantity', 'flowdate',
+          'onhand', 'minimum', 'periodofcover', 'status'
+          ),
+        '''
+        (operationplanmaterial.status = 'proposed' or operationplanmaterial.status is null)
+        and exists (
+          select 1 from tmp_opplanmat_scope
+          where tmp_opplanmat_scope.item_id = operationplanmaterial.item_id
+          and tmp_opplanmat_scope.location_id = operationplanmaterial.location_id
+          )
+        '''
+        )
+      cursor.execute("drop table tmp_opplanmat, tmp_opplanmat_scope")
+    if confirmed:
+      # Merge the confirmed records through a staging table
+      cursor.execute('''
+        create temporary table tmp_operationplanmaterial (
+          operationplan_id integer,
+          item_id character varying(300),
+          location_id character varying(300),
+          onhand numeric(20,8),
+          flowdate timestamp with time zone
+          )
+        ''')
+      copyRows(
+        cursor, 'tmp_operationplanmaterial',
+        ('operationplan_id', 'item_id', 'location_id', 'onhand', 'flowdate'),
+        confirmed
+        )
+      cursor.execute('''
+        update operationplanmaterial
+        set onhand = tmp.onhand, flowdate = tmp.flowdate
+        from tmp_operationplanmaterial as tmp
+        where operationplanmaterial.status = 'confirmed'
+          and operationplanmaterial.operationplan_id = tmp.operationplan_id
+          and operationplanmaterial.item_id = tmp.item_id
+          and operationplanmaterial.location_id = tmp.location_id
+          and (operationplanmaterial.onhand, operationplanmaterial.flowdate)
+            is distinct from (tmp.onhand, tmp.flowdate)
+        ''')
+      cursor.execute("drop table tmp_operationplanmaterial")
+    if self.verbosity:
+      logger.info('Exported operationplan materials%s in %.2f seconds' % (self.partitionLabel(partition), time() - starttime))
+
+
+  def exportOperationPlanResources(self, partition=None):
+
+    def getLoadplans():
       for i in frepple.resources():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if not self.inResourcePartition(i, partition):
           continue
         for j in i.loadplans:
           if j.quantity >= 0:
@@ -543,28 +789,63 @@ class export:
               j.operationplan.operation.name, j.operationplan.quantity, j.operationplan.start, j.operationplan.end
               )
           else:
-            print(("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-              j.operationplan.id, j.resource.name,
-              round(-j.quantity, 8),
-              str(j.startdate), str(j.enddate),
-              j.setup and j.setup or "\\N", j.status, currentTime
-              )), file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'operationplanresource',
-        columns=('operationplan_id', 'resource_id', 'quantity', 'startdate', 'enddate', 'setup', 'status', 'lastmodified')
-        )
-      tmp.close()
-    if self.verbosity:
-      logger.info('Exported operationplan resources in %.2f seconds' % (time() - starttime))
-
+            yield (
+              j.operationplan.id, j.resource.name, -j.quantity,
+              j.startdate, j.enddate, j.setup or None, j.status, self.timestamp
+              )
 
-  def exportResourceplans(self):
     if self.verbosity:
-      logger.info("Exporting resourceplans...")
+      logger.info("Exporting operationplan resources%s..." % self.partitionLabel(partition))
     starttime = time()
     cursor = connections[self.database].cursor()
+    if self.delta:
+      cursor.execute('''
+        create temporary table tmp_opplanres (
+          operationplan_id integer,
+          resource_id character varying(300),
+          quantity numeric(20,8),
+          startdate timestamp with time zone,
+          enddate timestamp with time zone,
+          setup character varying(300),
+          status character varying(20),
+          lastmodified timestamp with time zone
+          )
+        ''')
+      self.createResourceScope(cursor, 'tmp_opplanres_scope', partition)
+    copyRows(
+      cursor, 'tmp_opplanres' if self.delta else 'operationplanresource',
+      ('operationplan_id', 'resource_id', 'quantity', 'startdate', 'enddate', 'setup', 'status', 'lastmodified'),
+      getLoadplans()
+      )
+    if self.delta:
+      self.mergeDelta(
+        cursor, 'operationplanresource', 'tmp_opplanres',
+        ('operationplan_id', 'resource_id', 'quantity', 'startdate', 'enddate', 'setup', 'status'),
+        '''
+        (operationplanresource.status = 'proposed' or operationplanresource.status is null)
+        and operationplanresource.resource_id in (select name from tmp_opplanres_scope)
+        '''
+        )
+      cursor.execute("drop table tmp_opplanres, tmp_opplanres_scope")
+    if self.verbosity:
+      logger.info('Exported operationplan resources%s in %.2f seconds' % (self.partitionLabel(partition), time() - starttime))
+
+
+  def createResourceScope(self, cursor, table, partition):
+    '''
+    Creates a temporary table with the names of the resources in a partition.
+    '''
+    cursor.execute("create temporary table %s (name character varying(300))" % table)
+    copyRows(
+      cursor, table, ('name',),
+      ( (i.name,) for i in frepple.resources() if self.inResourcePartition(i, partition) )
+      )
+
+
+  def getResourceplanBuckets(self):
+    '''
+    Returns the list of daily buckets in which the resource plans are reported.
+    '''
     # Determine start and end date of the reporting horizon
     # The start date is computed as 5 weeks before the start of the earliest loadplan in
     # the entire plan.
@@ -595,38 +876,125 @@ class export:
     while startdate < enddate:
       buckets.append(startdate)
       startdate += timedelta(days=1)
+    return buckets
+
+
+  def exportResourceplans(self, partition=None):
+    if self.verbosity:
+      logger.info("Exporting resourceplans%s..." % self.partitionLabel(partition))
+    starttime = time()
+    cursor = connections[self.database].cursor()
+    # All partitions need to use the same horizon
+    buckets = self.buckets or self.getResourceplanBuckets()
 
     # Loop over all reporting buckets of all resources
-    with tempfile.TemporaryFile(mode="w+t", encoding='utf-8') as tmp:
+    def getResourcePlans():
       for i in frepple.resources():
+        if not self.inResourcePartition(i, partition):
+          continue
         for j in i.plan(buckets):
-          print(("%s\t%s\t%s\t%s\t%s\t%s\t%s" % (
-           i.name, str(j['start']),
-           round(j['available'], 8),
-           round(j['unavailable'], 8),
-           round(j['setup'], 8),
-           round(j['load'], 8),
-           round(j['free'], 8)
-           )),file=tmp)
-      tmp.seek(0)
-      cursor.copy_from(
-        tmp,
-        'out_resourceplan',
-        columns=('resource','startdate','available','unavailable','setup','load','free')
+          yield (
+            i.name, j['start'], j['available'], j['unavailable'],
+            j['setup'], j['load'], j['free']
+            )
+
+    if self.delta:
+      cursor.execute('''
+        create temporary table tmp_resourceplan (
+          resource character varying(300),
+          startdate timestamp with time zone,
+          available numeric(20,8),
+          unavailable numeric(20,8),
+          setup numeric(20,8),
+          load numeric(20,8),
+          free numeric(20,8)
+          )
+        ''')
+      self.createResourceScope(cursor, 'tmp_resourceplan_scope', partition)
+    copyRows(
+      cursor, 'tmp_resourceplan' if self.delta else 'out_resourceplan',
+      ('resource', 'startdate', 'available', 'unavailable', 'setup', 'load', 'free'),
+      getResourcePlans()
+      )
+    if self.delta:
+      self.mergeDelta(
+        cursor, 'out_resourceplan', 'tmp_resourceplan',
+        ('resource', 'startdate', 'available', 'unavailable', 'setup', 'load', 'free'),
+        "out_resourceplan.resource in (select name from tmp_resourceplan_scope)",
+        lastmodified=False
         )
-      tmp.close()
+      cursor.execute("drop table tmp_resourceplan, tmp_resourceplan_scope")
+
+    if self.verbosity:
+      logger.info('Exported resourceplans%s in %.2f seconds' % (self.partitionLabel(partition), time() - starttime))
 
-    #update owner records with sum of children quantities
 
+  def getBucketGranularities(self):
+    '''
+    Returns the list of bucket granularities defined in the database.
+    '''
+    cursor = connections[self.database].cursor()
+    cursor.execute("select distinct bucket_id from common_bucketdetail")
+    return [ i[0] for i in cursor.fetchall() ]
+
+
+  def exportResourceplanBuckets(self, granularity):
+    '''
+    Rolls up the exported resource plans in the buckets of a granularity.
+    '''
+    if self.verbosity:
+      logger.info("Exporting resource utilization in %s buckets..." % granularity)
+    starttime = time()
+    cursor = connections[self.database].cursor()
+    ResourceBucketSummary.build(cursor, granularity)
     if self.verbosity:
-      logger.info('Exported resourceplans in %.2f seconds' % (time() - starttime))
+      logger.info('Exported resource utilization in %s buckets in %.2f seconds' % (granularity, time() - starttime))
 
 
-  def exportPegging(self):
+  def getInventoryplanBuckets(self):
+    '''
+    Returns the list of bucket granularities for which the inventory profile
+    is computed.
+    '''
+    granularities = self.getBucketGranularities()
+    selected = [
+      i.strip()
+      for i in Parameter.getValue('export.inventorybuckets', self.database, '').split(',')
+      if i.strip()
+      ]
+    if selected:
+      granularities = [ i for i in granularities if i in selected ]
+    return granularities
+
+
+  def exportInventoryplans(self, granularity):
+    '''
+    Computes the inventory profile of all buffers in the buckets of a
+    granularity. The first bucket starts at the current date, which is
+    also the start of the default horizon of the inventory report.
+    '''
+    if self.verbosity:
+      logger.info("Exporting inventory profile in %s buckets..." % granularity)
+    starttime = time()
+    cursor = connections[self.database].cursor()
+    current = frepple.settings.current
+    start = datetime(current.year, current.month, current.day)
+    cursor.execute("select max(flowdate) from operationplanmaterial")
+    end = cursor.fetchone()[0] or start
+    InventorySummary.build(
+      cursor, (granularity,), start, end + timedelta(days=30), self.timestamp
+      )
+    if self.verbosity:
+      logger.info('Exported inventory profile in %s buckets in %.2f seconds' % (granularity, time() - starttime))
+
+
+  def exportPegging(self, partition=None):
+    # The flat pegging records are collected while the plans are encoded
+    pegging = []
 
     def getDemandPlan():
       for i in frepple.demands():
-        if self.cluster != -1 and self.cluster != i.cluster:
+        if not self.inPartition(i, partition):
           continue
         if i.hidden or not isinstance(i, frepple.demand_default):
           continue
@@ -637,53 +1005,117 @@ class export:
             'opplan': j.operationplan.id,
             'quantity': j.quantity
             })
-        yield (json.dumps({'pegging': peg}), i.name)
+          pegging.append((i.name, j.operationplan.id, j.level, round(j.quantity, 8)))
+        yield (i.name, json.dumps({'pegging': peg}))
 
-    logger.info("Exporting demand pegging...")
+    logger.info("Exporting demand pegging%s..." % self.partitionLabel(partition))
     starttime = time()
     with transaction.atomic(using=self.database, savepoint=False):
       cursor = connections[self.database].cursor()
-      cursor.executemany(
-        "update demand set plan=%s where name=%s",
-        [ i for i in getDemandPlan() ]
+      # Stage all pegging information and merge it with a single statement
+      cursor.execute('''
+        create temporary table tmp_demandplan (
+          name character varying(300),
+          plan jsonb
+          )
+        ''')
+      copyRows(cursor, 'tmp_demandplan', ('name', 'plan'), getDemandPlan())
+      if self.delta:
+        # Only rewrite the pegging of demands with a changed plan, or with
+        # pegging records that don't match their plan
+        cursor.execute('''
+          select tmp.name
+          from tmp_demandplan as tmp
+          inner join demand
+            on demand.name = tmp.name
+          where demand.plan is distinct from tmp.plan
+          or exists (select 1 from out_pegging where out_pegging.demand = tmp.name)
+            <> (jsonb_array_length(tmp.plan->'pegging') > 0)
+          ''')
+        changed = set(i[0] for i in cursor.fetchall())
+        cursor.execute('''
+          delete from out_pegging
+          where demand = any(%s)
+          ''', (list(changed),))
+        pegging = [ i for i in pegging if i[0] in changed ]
+        if self.cluster == -1 and not partition:
+          # Remove the pegging of demands that are no longer planned
+          cursor.execute('''
+            delete from out_pegging
+            where demand not in (select unnest(%s::varchar[]))
+            ''', ([
+              i.name for i in frepple.demands()
+              if not i.hidden and isinstance(i, frepple.demand_default)
+              ],))
+      copyRows(
+        cursor, 'out_pegging', ('demand', 'operationplan_id', 'level', 'quantity'),
+        pegging
         )
-    logger.info('Exported demand pegging in %.2f seconds' % (time() - starttime))
+      cursor.execute('''
+        update demand
+        set plan = tmp.plan
+        from tmp_demandplan as tmp
+        where demand.name = tmp.name
+        and demand.plan is distinct from tmp.plan
+        ''')
+      cursor.execute("drop table tmp_demandplan")
+    logger.info('Exported demand pegging%s in %.2f seconds' % (self.partitionLabel(partition), time() - starttime))
+
+
 
 
+  def runParallel(self, *steps):
+    '''
+    Executes a list of export steps over a pool of database connections.
+    Each step is a tuple with a function and its arguments.
+    '''
+    queue = Queue()
+    for step in steps:
+      queue.put(step)
+    workers = [ DatabaseWorker(self, queue) for i in range(min(self.workers, len(steps))) ]
+    for w in workers:
+      w.start()
+    for w in workers:
+      w.join()
+    for w in workers:
+      if w.errors:
+        raise w.errors[0]
 
 
   def run(self):
     '''
     This function exports the data from the frePPLe memory into the database.
-    The export runs in parallel over 2 connections to PostgreSQL.
+    The export runs in parallel over a configurable number of connections to
+    PostgreSQL. The large tables are split in as many partitions.
     '''
     # Truncate
     task = DatabasePipe(self, export.truncate)
     task.start()
     task.join()
 
-    # Export process
-    tasks = (
-       DatabasePipe(
-         self,
-         export.exportResourceplans,
-         export.exportProblems,
-         export.exportConstraints
-         ),
-      DatabasePipe(
-        self,
-        export.exportOperationplans,
-         export.exportOperationPlanMaterials,
-         export.exportOperationPlanResources,
-         export.exportPegging
-        ),
+    # Export operationplans and all tables that don't depend on them
+    partitions = range(self.workers)
+    self.buckets = self.getResourceplanBuckets()
+    self.runParallel(
+      *[ (export.exportOperationplans, (p,)) for p in partitions ],
+      *[ (export.exportResourceplans, (p,)) for p in partitions ],
+      (export.exportProblems, ()),
+      (export.exportConstraints, ())
+      )
+    self.finishOperationplans()
+
+    # Export the details of the operationplans and the resource rollup
+    self.runParallel(
+      *[ (export.exportResourceplanBuckets, (g,)) for g in self.getBucketGranularities() ],
+      *[ (export.exportOperationPlanMaterials, (p,)) for p in partitions ],
+      *[ (export.exportOperationPlanResources, (p,)) for p in partitions ],
+      *[ (export.exportPegging, (p,)) for p in partitions ]
+      )
+
+    # Aggregate the inventory profile from the exported details
+    self.runParallel(
+      *[ (export.exportInventoryplans, (g,)) for g in self.getInventoryplanBuckets() ]
       )
-    # Start all threads
-    for i in tasks:
-      i.start()
-    # Wait for all threads to finish
-    for i in tasks:
-      i.join()
 
     # Report on the output
     if self.verbosity:
@@ -691,9 +1123,12 @@ class export:
       cursor.execute('''
         select 'out_problem', count(*) from out_problem
         union select 'out_constraint', count(*) from out_constraint
+        union select 'out_pegging', count(*) from out_pegging
         union select 'operationplanmaterial', count(*) from operationplanmaterial
         union select 'operationplanresource', count(*) from operationplanresource
         union select 'out_resourceplan', count(*) from out_resourceplan
+        union select 'out_resourcebucketplan', count(*) from out_resourcebucketplan
+        union select 'out_inventoryplan', count(*) from out_inventoryplan
         union select 'operationplan', count(*) from operationplan
         order by 1
         ''')
@@ -733,7 +1168,11 @@ class export:
       self.exportOperationPlanMaterials()
       self.exportOperationPlanResources()
       self.exportResourceplans()
+      for g in self.getBucketGranularities():
+        self.exportResourceplanBuckets(g)
       self.exportPegging()
+      for g in self.getInventoryplanBuckets():
+        self.exportInventoryplans(g)
     except:
       logger.error('An error occured during the sequential export')
 
@@ -742,10 +1181,13 @@ class export:
       cursor.execute('''
         select 'out_problem', count(*) from out_problem
         union select 'out_constraint', count(*) from out_constraint
+        union select 'out_pegging', count(*) from out_pegging
         union select 'operationplan', count(*) from operationplan
         union select 'operationplanmaterial', count(*) from operationplanmaterial
         union select 'operationplanresource', count(*) from operationplanresource
         union select 'out_resourceplan', count(*) from out_resourceplan
+        union select 'out_resourcebucketplan', count(*) from out_resourcebucketplan
+        union select 'out_inventoryplan', count(*) from out_inventoryplan
         order by 1
         ''')
       for table, recs in cursor.fetchall():
@@ -34,12 +34,23 @@ import traceback
 from django.db import connections, transaction, DEFAULT_DB_ALIAS
 from django.conf import settings
 
+from freppledb.common.dbcopy import copyRows
+from freppledb.common.models import Parameter
+
 import frepple
 
 
+def seconds(value):
+  '''
+  Converts a duration in seconds to a timedelta that can be stored in an
+  interval field.
+  '''
+  return None if value is None else datetime.timedelta(seconds=value)
+
+
 class exportStaticModel(object):
 
-  def __init__(self, database=None, source=None):
+  def __init__(self, database=None, source=None, verbosity=1):
     if database:
       self.database = database
     elif 'FREPPLE_DATABASE' in os.environ:
@@ -47,44 +58,87 @@ class exportStaticModel(object):
     else:
       self.database = DEFAULT_DB_ALIAS
     self.source = source
+    self.verbosity = verbosity
+
+  def upsert(self, cursor, table, columns, rows, key=('name',), owner=False):
+    '''
+    Bulk insert or update records in a table.
+
+    The rows are streamed into a temporary table with the COPY command, and
+    merged into the table with set-based statements. The lastmodified field is
+    set by this method, and shouldn't be passed in the rows.
+
+    When the owner argument is true, the last field of each row is the name
+    of the owner. The owner fields are updated in a second statement, once all
+    records exist.
+    '''
+    tmp = 'tmp_%s' % table
+    fields = columns + ('owner_id',) if owner else columns
+    cursor.execute(
+      "create temporary table %s on commit drop as select %s from %s limit 0"
+      % (tmp, ','.join(fields), table)
+      )
+    copyRows(cursor, tmp, fields, rows)
+    updates = ', '.join([ '%s=excluded.%s' % (c, c) for c in columns if c not in key ])
+    if key == ('name',):
+      # Merge on the primary key
+      cursor.execute('''
+        insert into %s (%s,lastmodified)
+        select %s,%%s from %s
+        on conflict (name) do update set %s%slastmodified=excluded.lastmodified
+        ''' % (table, ','.join(columns), ','.join(columns), tmp, updates, ', ' if updates else ''),
+        (self.timestamp,)
+        )
+    else:
+      # Merge on a key that can contain null values
+      match = ' and '.join([ '%s.%s is not distinct from %s.%s' % (table, c, tmp, c) for c in key ])
+      cursor.execute('''
+        update %s
+        set %s%slastmodified=%%s
+        from %s
+        where %s
+        ''' % (
+          table, updates.replace('excluded.', '%s.' % tmp),
+          ', ' if updates else '', tmp, match
+          ),
+        (self.timestamp,)
+        )
+      cursor.execute('''
+        insert into %s (%s,lastmodified)
+        select %s,%%s from %s
+        where not exists (select 1 from %s where %s)
+        ''' % (table, ','.join(columns), ','.join(columns), tmp, table, match),
+        (self.timestamp,)
+        )
+    if owner:
+      cursor.execute('''
+        update %s
+        set owner_id = %s.owner_id
+        from %s
+        where %s.name = %s.name
+        and %s.owner_id is not null
+        and %s.owner_id is distinct from %s.owner_id
+        ''' % (table, tmp, tmp, table, tmp, tmp, table, tmp))
+
 
   def exportLocations(self, cursor):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting locations...")
       starttime = time()
-      cursor.execute("SELECT name FROM location")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into location \
-        (name,description,available_id,category,subcategory,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s)",
-        [
+      self.upsert(
+        cursor, 'location',
+        ('name', 'description', 'available_id', 'category', 'subcategory', 'source'),
+        (
           (
             i.name, i.description, i.available and i.available.name or None,
-            i.category, i.subcategory, i.source, self.timestamp
+            i.category, i.subcategory, i.source,
+            i.owner.name if i.owner else None
           )
           for i in frepple.locations()
-          if i.name not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update location \
-         set description=%s, available_id=%s, category=%s, subcategory=%s, source=%s, lastmodified=%s \
-         where name=%s",
-        [
-          (
-            i.description, i.available and i.available.name or None,
-            i.category, i.subcategory, i.source, self.timestamp, i.name
-          )
-          for i in frepple.locations()
-          if i.name in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update location set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
-          for i in frepple.locations()
-          if i.owner and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        owner=True
+        )
       print('Exported locations in %.2f seconds' % (time() - starttime))
 
 
@@ -92,32 +146,14 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting calendars...")
       starttime = time()
-      cursor.execute("SELECT name FROM calendar")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into calendar \
-        (name,defaultvalue,source,lastmodified) \
-        values(%s,%s,%s,%s)",
-        [
-          (
-            i.name, round(i.default, 8), i.source,
-            self.timestamp
-          )
+      self.upsert(
+        cursor, 'calendar',
+        ('name', 'defaultvalue', 'source'),
+        (
+          (i.name, i.default, i.source)
           for i in frepple.calendars()
-          if i.name not in primary_keys and not i.hidden and (not self.source or self.source == i.source and not i.source == 'common_bucket')
-        ])
-      cursor.executemany(
-        "update calendar \
-         set defaultvalue=%s, source=%s, lastmodified=%s \
-         where name=%s",
-        [
-          (
-            round(i.default, 8), i.source, self.timestamp,
-            i.name
-          )
-          for i in frepple.calendars()
-          if i.name in primary_keys and not i.hidden and (not self.source or self.source == i.source and not i.source == 'common_bucket')
-        ])
+          if not i.hidden and (not self.source or self.source == i.source and not i.source == 'common_bucket')
+        ))
       print('Exported calendars in %.2f seconds' % (time() - starttime))
 
 
@@ -153,16 +189,17 @@ class exportStaticModel(object):
       else:
         cursor.execute("delete from calendarbucket")
 
-      cursor.executemany(
-        "insert into calendarbucket \
-        (calendar_id,startdate,enddate,id,priority,value, \
-        sunday,monday,tuesday,wednesday,thursday,friday,saturday, \
-        starttime,endtime,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
+      copyRows(
+        cursor, 'calendarbucket',
+        (
+          'calendar_id', 'startdate', 'enddate', 'id', 'priority', 'value',
+          'sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+          'starttime', 'endtime', 'source', 'lastmodified'
+          ),
+        (
           (
-            i[0].calendar.name, str(i[0].start), str(i[0].end), i[1], i[0].priority,
-            round(i[0].value, 8),
+            i[0].calendar.name, i[0].start, i[0].end, i[1], i[0].priority,
+            i[0].value,
             (i[0].days & 1) and True or False, (i[0].days & 2) and True or False,
             (i[0].days & 4) and True or False, (i[0].days & 8) and True or False,
             (i[0].days & 16) and True or False, (i[0].days & 32) and True or False,
@@ -171,7 +208,7 @@ class exportStaticModel(object):
             i[0].source, self.timestamp
           )
           for i in buckets()
-        ])
+        ))
       print('Exported calendar buckets in %.2f seconds' % (time() - starttime))
 
 
@@ -181,64 +218,32 @@ class exportStaticModel(object):
       starttime = time()
       default_start = datetime.datetime(1971, 1, 1)
       default_end = datetime.datetime(2030, 12, 31)
-      cursor.execute("SELECT name FROM operation")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into operation \
-        (name,fence,posttime,sizeminimum,sizemultiple,sizemaximum,type, \
-        duration,duration_per,location_id,cost,search,description,category, \
-        subcategory,source,item_id,priority,effective_start,effective_end, \
-        lastmodified) \
-        values(%s,%s * interval '1 second',%s * interval '1 second',%s,%s, \
-        %s,%s,%s * interval '1 second',%s * interval '1 second',%s,%s,%s, \
-        %s,%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
+      self.upsert(
+        cursor, 'operation',
+        (
+          'name', 'fence', 'posttime', 'sizeminimum', 'sizemultiple', 'sizemaximum',
+          'type', 'duration', 'duration_per', 'location_id', 'cost', 'search',
+          'description', 'category', 'subcategory', 'source', 'item_id', 'priority',
+          'effective_start', 'effective_end'
+          ),
+        (
           (
-            i.name, i.fence, i.posttime, round(i.size_minimum, 8),
-            round(i.size_multiple, 8),
-            i.size_maximum < 9999999999999 and round(i.size_maximum, 8) or None,
+            i.name, seconds(i.fence), seconds(i.posttime), i.size_minimum,
+            i.size_multiple,
+            i.size_maximum < 9999999999999 and i.size_maximum or None,
             i.__class__.__name__[10:],
-            isinstance(i, (frepple.operation_fixed_time, frepple.operation_time_per)) and i.duration or None,
-            isinstance(i, frepple.operation_time_per) and i.duration_per or None,
-            i.location and i.location.name or None, round(i.cost, 8),
+            seconds(isinstance(i, (frepple.operation_fixed_time, frepple.operation_time_per)) and i.duration or None),
+            seconds(isinstance(i, frepple.operation_time_per) and i.duration_per or None),
+            i.location and i.location.name or None, i.cost,
             isinstance(i, frepple.operation_alternate) and i.search or None,
             i.description, i.category, i.subcategory, i.source,
             i.item.name if i.item else None, i.priority if i.priority != 1 else None,
             i.effective_start if i.effective_start != default_start else None,
-            i.effective_end if i.effective_end != default_end else None,
-            self.timestamp
-          )
-          for i in frepple.operations()
-          if i.name not in primary_keys and not i.hidden and not isinstance(i, frepple.operation_itemsupplier) and i.name != 'setup operation' and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update operation \
-        set fence=%s * interval '1 second', posttime=%s* interval '1 second', \
-        sizeminimum=%s, sizemultiple=%s, sizemaximum=%s, type=%s, \
-        duration=%s * interval '1 second', duration_per=%s * interval '1 second', \
-        location_id=%s, cost=%s, search=%s, description=%s, \
-        category=%s, subcategory=%s, source=%s, lastmodified=%s, \
-        item_id=%s, priority=%s, effective_start=%s, effective_end=%s \
-        where name=%s",
-        [
-          (
-            i.fence, i.posttime, round(i.size_minimum, 8),
-            round(i.size_multiple, 8),
-            i.size_maximum < 9999999999999 and round(i.size_maximum, 8) or None,
-            i.__class__.__name__[10:],
-            isinstance(i, (frepple.operation_fixed_time, frepple.operation_time_per)) and i.duration or None,
-            isinstance(i, frepple.operation_time_per) and i.duration_per or None,
-            i.location and i.location.name or None, round(i.cost, 8),
-            isinstance(i, frepple.operation_alternate) and i.search or None,
-            i.description, i.category, i.subcategory, i.source, self.timestamp,
-            i.item.name if i.item else None, i.priority,
-            i.effective_start if i.effective_start != default_start else None,
-            i.effective_end if i.effective_end != default_end else None,
-            i.name
+            i.effective_end if i.effective_end != default_end else None
           )
           for i in frepple.operations()
-          if i.name in primary_keys and not i.hidden and not isinstance(i, frepple.operation_itemsupplier) and i.name != 'setup operation' and (not self.source or self.source == i.source)
-        ])
+          if not i.hidden and not isinstance(i, frepple.operation_itemsupplier) and i.name != 'setup operation' and (not self.source or self.source == i.source)
+        ))
       print('Exported operations in %.2f seconds' % (time() - starttime))
 
 
@@ -246,8 +251,6 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting suboperations...")
       starttime = time()
-      cursor.execute("SELECT operation_id, suboperation_id FROM suboperation")
-      primary_keys = set([ i for i in cursor.fetchall() ])
 
       def subops():
         for i in frepple.operations():
@@ -255,24 +258,16 @@ class exportStaticModel(object):
             for j in i.suboperations:
               yield j
 
-      cursor.executemany(
-        "insert into suboperation \
-        (operation_id,suboperation_id,priority,effective_start,effective_end,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s)",
-        [
-          (i.owner.name, i.operation.name, i.priority, i.effective_start, i.effective_end, i.source, self.timestamp)
+      self.upsert(
+        cursor, 'suboperation',
+        ('operation_id', 'suboperation_id', 'priority', 'effective_start', 'effective_end', 'source'),
+        (
+          (i.owner.name, i.operation.name, i.priority, i.effective_start, i.effective_end, i.source)
           for i in subops()
-          if (i.owner.name, i.operation.name) not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update suboperation \
-         set priority=%s, effective_start=%s, effective_end=%s, source=%s, lastmodified=%s \
-         where operation_id=%s and suboperation_id=%s",
-        [
-          (i.priority, i.effective_start, i.effective_end, i.source, self.timestamp, i.owner.name, i.operation.name)
-          for i in subops()
-          if (i.owner.name, i.operation.name) in primary_keys and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        key=('operation_id', 'suboperation_id')
+        )
       print('Exported suboperations in %.2f seconds' % (time() - starttime))
 
 
@@ -283,8 +278,6 @@ class exportStaticModel(object):
 
       print("Exporting operation materials...")
       starttime = time()
-      cursor.execute("SELECT operation_id, item_id, effective_start FROM operationmaterial")
-      primary_keys = set([ (i[0], i[1], i[2] if i[2] else default_start) for i in cursor.fetchall() ])
 
       def flows(source):
         for o in frepple.operations():
@@ -295,59 +288,26 @@ class exportStaticModel(object):
               continue
             if not source or source == i.source:
               yield i
-              
-      cursor.executemany(
-        "insert into operationmaterial \
-        (operation_id,item_id,quantity,type,effective_start,effective_end,\
-        name,priority,search,source,transferbatch,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
+
+      self.upsert(
+        cursor, 'operationmaterial',
+        (
+          'operation_id', 'item_id', 'quantity', 'type', 'effective_start', 'effective_end',
+          'name', 'priority', 'search', 'source', 'transferbatch'
+          ),
+        (
           (
-            i.operation.name, i.buffer.item.name, round(i.quantity, 8),
+            i.operation.name, i.buffer.item.name, i.quantity,
             i.type[5:],
             i.effective_start if i.effective_start != default_start else None,
             i.effective_end if i.effective_end != default_end else None, i.name,
             i.priority, i.search != 'PRIORITY' and i.search or None, i.source,
-            round(i.transferbatch, 8) if isinstance(i, frepple.flow_transfer_batch) else None,
-            self.timestamp
-          )
-          for i in flows(self.source)
-          if (i.operation.name, i.item.name, i.effective_start) not in primary_keys
-        ])
-      cursor.executemany(
-        "update operationmaterial \
-        set quantity=%s, type=%s, effective_end=%s, name=%s, \
-        priority=%s, search=%s, source=%s, transferbatch=%s, lastmodified=%s \
-        where operation_id=%s and item_id=%s and effective_start=%s",
-        [
-          (
-            round(i.quantity, 8),
-            i.type[5:], i.effective_end if i.effective_end != default_end else None,
-            i.name, i.priority, i.search != 'PRIORITY' and i.search or None, i.source,
-            round(i.transferbatch, 8) if isinstance(i, frepple.flow_transfer_batch) else None,
-            self.timestamp, i.operation.name, i.item.name, i.effective_start
+            i.transferbatch if isinstance(i, frepple.flow_transfer_batch) else None
           )
           for i in flows(self.source)
-          if (i.operation.name, i.item.name, i.effective_start) in primary_keys \
-            and i.effective_start != default_start
-        ])
-      cursor.executemany(
-        "update operationmaterial \
-        set quantity=%s, type=%s, effective_end=%s, name=%s, \
-        priority=%s, search=%s, source=%s, transferbatch=%s, lastmodified=%s \
-        where operation_id=%s and item_id=%s and effective_start is null",
-        [
-          (
-            round(i.quantity, 8),
-            i.type[5:], i.effective_end if i.effective_end != default_end else None,
-            i.name, i.priority, i.search != 'PRIORITY' and i.search or None, i.source,
-            round(i.transferbatch, 8) if isinstance(i, frepple.flow_transfer_batch) else None,
-            self.timestamp, i.operation.name, i.buffer.item.name
-          )
-          for i in flows(self.source)
-          if (i.operation.name, i.item.name, i.effective_start) in primary_keys \
-            and i.effective_start == default_start
-        ])
+        ),
+        key=('operation_id', 'item_id', 'effective_start')
+        )
       print('Exported operation materials in %.2f seconds' % (time() - starttime))
 
 
@@ -355,8 +315,6 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting operation resources...")
       starttime = time()
-      cursor.execute("SELECT operation_id, resource_id, effective_start FROM operationresource")
-      primary_keys = set([ i for i in cursor.fetchall() ])
 
       def loads(source):
         for o in frepple.operations():
@@ -368,36 +326,23 @@ class exportStaticModel(object):
             if not source or source == i.source:
               yield i
 
-      cursor.executemany(
-        "insert into operationresource \
-        (operation_id,resource_id,quantity,setup,effective_start, \
-        effective_end,name,priority,search,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
-          (
-            i.operation.name, i.resource.name, round(i.quantity, 8),
-            i.setup, str(i.effective_start), i.effective_end,
-            i.name, i.priority, i.search != 'PRIORITY' and i.search or None,
-            i.source, self.timestamp
-          )
-          for i in loads(self.source)
-          if (i.operation.name, i.resource.name, i.effective_start) not in primary_keys
-        ])
-      cursor.executemany(
-        "update operationresource \
-        set quantity=%s, setup=%s, effective_start=%s, effective_end=%s, \
-        name=%s, priority=%s, search=%s, source=%s, lastmodified=%s \
-        where operation_id=%s and resource_id=%s",
-        [
+      self.upsert(
+        cursor, 'operationresource',
+        (
+          'operation_id', 'resource_id', 'quantity', 'setup', 'effective_start',
+          'effective_end', 'name', 'priority', 'search', 'source'
+          ),
+        (
           (
-            round(i.quantity, 8),
-            i.setup, str(i.effective_start), str(i.effective_end),
+            i.operation.name, i.resource.name, i.quantity,
+            i.setup, i.effective_start, i.effective_end,
             i.name, i.priority, i.search != 'PRIORITY' and i.search or None,
-            i.source, self.timestamp, i.operation.name, i.resource.name,
+            i.source
           )
           for i in loads(self.source)
-          if (i.operation.name, i.resource.name, i.effective_start) in primary_keys
-        ])
+        ),
+        key=('operation_id', 'resource_id', 'effective_start')
+        )
       print('Exported operation resources in %.2f seconds' % (time() - starttime))
 
 
@@ -405,51 +350,28 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting buffers...")
       starttime = time()
-      cursor.execute("SELECT name FROM buffer")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into buffer \
-        (name,description,location_id,item_id,onhand,minimum,minimum_calendar_id, \
-        type,min_interval,category,subcategory,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s,%s,%s * interval '1 second',%s,%s,%s,%s)",
-        [
+      self.upsert(
+        cursor, 'buffer',
+        (
+          'name', 'description', 'location_id', 'item_id', 'onhand', 'minimum',
+          'minimum_calendar_id', 'type', 'min_interval', 'category', 'subcategory', 'source'
+          ),
+        (
           (
             i.name, i.description, i.location and i.location.name or None,
             i.item and i.item.name or None,
-            round(i.onhand, 8), round(i.minimum, 8),
-            i.minimum_calendar and i.minimum_calendar.name or None,
-            i.__class__.__name__[7:], i.mininterval,
-            i.category, i.subcategory, i.source, self.timestamp
-          )
-          for i in frepple.buffers()
-          if i.name not in primary_keys and not i.hidden and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update buffer \
-         set description=%s, location_id=%s, item_id=%s, onhand=%s, \
-         minimum=%s, minimum_calendar_id=%s, type=%s, \
-         min_interval=%s * interval '1 second', category=%s, \
-         subcategory=%s, source=%s, lastmodified=%s \
-         where name=%s",
-        [
-          (
-            i.description, i.location and i.location.name or None, i.item and i.item.name or None,
-            round(i.onhand, 8), round(i.minimum, 8),
+            i.onhand, i.minimum,
             i.minimum_calendar and i.minimum_calendar.name or None,
             i.__class__.__name__[7:],
-            (i.mininterval!=-1) and i.mininterval or None,
-            i.category, i.subcategory, i.source, self.timestamp, i.name
+            seconds((i.mininterval != -1) and i.mininterval or None),
+            i.category, i.subcategory, i.source,
+            i.owner.name if i.owner else None
           )
           for i in frepple.buffers()
-          if i.name in primary_keys and not i.hidden and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update buffer set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
-          for i in frepple.buffers()
-          if i.owner and not i.hidden
-        ])
+          if not i.hidden and (not self.source or self.source == i.source)
+        ),
+        owner=True
+        )
       print('Exported buffers in %.2f seconds' % (time() - starttime))
 
 
@@ -457,33 +379,19 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting customers...")
       starttime = time()
-      cursor.execute("SELECT name FROM customer")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into customer \
-        (name,description,category,subcategory,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s)",
-        [
-          (i.name, i.description, i.category, i.subcategory, i.source, self.timestamp)
-          for i in frepple.customers()
-          if i.name not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update customer \
-         set description=%s, category=%s, subcategory=%s, source=%s, lastmodified=%s \
-         where name=%s",
-        [
-          (i.description, i.category, i.subcategory, i.source, self.timestamp, i.name)
-          for i in frepple.customers()
-          if i.name in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update customer set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
+      self.upsert(
+        cursor, 'customer',
+        ('name', 'description', 'category', 'subcategory', 'source'),
+        (
+          (
+            i.name, i.description, i.category, i.subcategory, i.source,
+            i.owner.name if i.owner else None
+          )
           for i in frepple.customers()
-          if i.owner and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        owner=True
+        )
       print('Exported customers in %.2f seconds' % (time() - starttime))
 
 
@@ -491,33 +399,19 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting suppliers...")
       starttime = time()
-      cursor.execute("SELECT name FROM supplier")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into supplier \
-        (name,description,category,subcategory,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s)",
-        [
-          (i.name, i.description, i.category, i.subcategory, i.source, self.timestamp)
-          for i in frepple.suppliers()
-          if i.name not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update supplier \
-         set description=%s, category=%s, subcategory=%s, source=%s, lastmodified=%s \
-         where name=%s",
-        [
-          (i.description, i.category, i.subcategory, i.source, self.timestamp, i.name)
-          for i in frepple.suppliers()
-          if i.name in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update supplier set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
+      self.upsert(
+        cursor, 'supplier',
+        ('name', 'description', 'category', 'subcategory', 'source'),
+        (
+          (
+            i.name, i.description, i.category, i.subcategory, i.source,
+            i.owner.name if i.owner else None
+          )
           for i in frepple.suppliers()
-          if i.owner and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        owner=True
+        )
       print('Exported suppliers in %.2f seconds' % (time() - starttime))
 
 
@@ -534,92 +428,26 @@ class exportStaticModel(object):
       starttime = time()
       default_start = datetime.datetime(1971, 1, 1)
       default_end = datetime.datetime(2030, 12, 31)
-      cursor.execute("SELECT supplier_id, item_id, location_id, effective_start FROM itemsupplier")
-      primary_keys = set([ (i[0], i[1], i[2], i[3] if i[3] else default_start) for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into itemsupplier \
-        (supplier_id,item_id,location_id,leadtime,sizeminimum,sizemultiple, \
-         cost,priority,effective_start,effective_end,resource_id,resource_qty,source,lastmodified) \
-        values(%s,%s,%s,%s * interval '1 second',%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
-          (i.supplier.name, i.item.name, i.location.name if i.location else None,
-           i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_start if i.effective_start != default_start else None,
-           i.effective_end if i.effective_end != default_end else None,
-           i.resource.name if i.resource else None, i.resource_qty,
-           i.source, self.timestamp)
-          for i in itemsuppliers()
-          if (i.supplier.name, i.item.name, i.location.name if i.location else None, i.effective_start) not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update itemsupplier \
-         set leadtime=%s * interval '1 second', sizeminimum=%s, sizemultiple=%s, \
-         cost=%s, priority=%s, effective_end=%s, \
-         source=%s, lastmodified=%s \
-         where supplier_id=%s and item_id=%s and location_id=%s and effective_start=%s",
-        [
-          (i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp,
-           i.supplier.name, i.item.name, i.location.name if i.location else None,
-           i.effective_start)
-          for i in itemsuppliers()
-          if (i.supplier.name, i.item.name, i.location.name if i.location else None, i.effective_start) in primary_keys \
-            and i.location is not None \
-            and i.effective_start != default_start \
-            and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update itemsupplier \
-         set leadtime=%s * interval '1 second', sizeminimum=%s, sizemultiple=%s, \
-         cost=%s, priority=%s, effective_end=%s, \
-         source=%s, lastmodified=%s \
-         where supplier_id=%s and item_id=%s and location_id=%s and effective_start is null",
-        [
-          (i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp,
-           i.supplier.name, i.item.name, i.location.name if i.location else None)
-          for i in itemsuppliers()
-          if (i.supplier.name, i.item.name, i.location.name if i.location else None, i.effective_start) in primary_keys \
-            and i.location is not None \
-            and i.effective_start == default_start \
-            and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update itemsupplier \
-         set leadtime=%s * interval '1 second', sizeminimum=%s, sizemultiple=%s, \
-         cost=%s, priority=%s, effective_end=%s, \
-         source=%s, lastmodified=%s \
-         where supplier_id=%s and item_id=%s and location_id is null and effective_start=%s",
-        [
-          (i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp,
-           i.supplier.name, i.item.name, i.effective_start)
-          for i in itemsuppliers()
-          if (i.supplier.name, i.item.name, i.location.name if i.location else None, i.effective_start) in primary_keys \
-            and i.location is None \
-            and i.effective_start != default_start \
-            and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update itemsupplier \
-         set leadtime=%s * interval '1 second', sizeminimum=%s, sizemultiple=%s, \
-         cost=%s, priority=%s, effective_end=%s, \
-         source=%s, lastmodified=%s \
-         where supplier_id=%s and item_id=%s and location_id is null and effective_start is null",
-        [
-          (i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp,
-           i.supplier.name, i.item.name)
+      self.upsert(
+        cursor, 'itemsupplier',
+        (
+          'supplier_id', 'item_id', 'location_id', 'leadtime', 'sizeminimum', 'sizemultiple',
+          'cost', 'priority', 'effective_start', 'effective_end', 'resource_id', 'resource_qty', 'source'
+          ),
+        (
+          (
+            i.supplier.name, i.item.name, i.location.name if i.location else None,
+            seconds(i.leadtime), i.size_minimum, i.size_multiple, i.cost, i.priority,
+            i.effective_start if i.effective_start != default_start else None,
+            i.effective_end if i.effective_end != default_end else None,
+            i.resource.name if i.resource else None, i.resource_qty,
+            i.source
+          )
           for i in itemsuppliers()
-          if (i.supplier.name, i.item.name, None, i.effective_start) in primary_keys \
-            and i.location is None \
-            and i.effective_start == default_start \
-            and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        key=('supplier_id', 'item_id', 'location_id', 'effective_start')
+        )
       print('Exported item suppliers in %.2f seconds' % (time() - starttime))
 
 
@@ -636,51 +464,25 @@ class exportStaticModel(object):
       starttime = time()
       default_start = datetime.datetime(1971, 1, 1)
       default_end = datetime.datetime(2030, 12, 31)
-      cursor.execute("SELECT origin_id, item_id, location_id, effective_start FROM itemdistribution")
-      primary_keys = set([ (i[0], i[1], i[2], i[3] if i[3] else default_start) for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into itemdistribution \
-        (origin_id,item_id,location_id,leadtime,sizeminimum,sizemultiple, \
-         cost,priority,effective_start,effective_end,source,lastmodified) \
-        values(%s,%s,%s,%s * interval '1 second',%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
-          (i.origin.name, i.item.name, i.destination.name if i.destination else None,
-           i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_start if i.effective_start != default_start else None,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp)
-          for i in itemdistributions()
-          if (i.origin.name, i.item.name, i.destination.name if i.destination else None, i.effective_start) not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update itemdistribution \
-         set leadtime=%s * interval '1 second', sizeminimum=%s, \
-         sizemultiple=%s, cost=%s, priority=%s, effective_end=%s, \
-         source=%s, lastmodified=%s \
-         where origin_id=%s and item_id=%s and location_id=%s and effective_start=%s",
-        [
-          (i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp, i.origin.name, i.item.name,
-           i.destination.name if i.destination else None,
-           i.effective_start)
-          for i in itemdistributions()
-          if (i.origin.name, i.item.name, i.destination.name if i.destination else None, i.effective_start) in primary_keys and i.effective_start != default_start and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update itemdistribution \
-         set leadtime=%s * interval '1 second', sizeminimum=%s, sizemultiple=%s, \
-         cost=%s, priority=%s, effective_end=%s, \
-         source=%s, lastmodified=%s \
-         where origin_id=%s and item_id=%s and location_id=%s and effective_start is null",
-        [
-          (i.leadtime, i.size_minimum, i.size_multiple, i.cost, i.priority,
-           i.effective_end if i.effective_end != default_end else None,
-           i.source, self.timestamp, i.origin.name, i.item.name,
-           i.destination.name if i.destination else None)
+      self.upsert(
+        cursor, 'itemdistribution',
+        (
+          'origin_id', 'item_id', 'location_id', 'leadtime', 'sizeminimum', 'sizemultiple',
+          'cost', 'priority', 'effective_start', 'effective_end', 'source'
+          ),
+        (
+          (
+            i.origin.name, i.item.name, i.destination.name if i.destination else None,
+            seconds(i.leadtime), i.size_minimum, i.size_multiple, i.cost, i.priority,
+            i.effective_start if i.effective_start != default_start else None,
+            i.effective_end if i.effective_end != default_end else None,
+            i.source
+          )
           for i in itemdistributions()
-          if (i.origin.name, i.item.name, i.destination.name if i.destination else None, i.effective_start) in primary_keys and i.effective_start == default_start and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        key=('origin_id', 'item_id', 'location_id', 'effective_start')
+        )
       print('Exported item distributions in %.2f seconds' % (time() - starttime))
 
 
@@ -688,51 +490,27 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting demands...")
       starttime = time()
-      cursor.execute("SELECT name FROM demand")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into demand \
-        (name,due,quantity,priority,item_id,location_id,operation_id,customer_id, \
-         minshipment,maxlateness,category,subcategory,source,lastmodified,status) \
-        values(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s * interval '1 second',%s,%s,%s,%s,%s)",
-        [
-          (
-            i.name, str(i.due), round(i.quantity, 8), i.priority, i.item.name,
-            i.location.name if i.location else None, i.operation.name if i.operation and not i.operation.hidden else None,
-            i.customer.name if i.customer else None,
-            round(i.minshipment, 8), i.maxlateness,
-            i.category, i.subcategory, i.source, self.timestamp, i.status
-          )
-          for i in frepple.demands()
-          if i.name not in primary_keys and isinstance(i, frepple.demand_default) and not i.hidden and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update demand \
-         set due=%s, quantity=%s, priority=%s, item_id=%s, location_id=%s, \
-         operation_id=%s, customer_id=%s, minshipment=%s, maxlateness=%s * interval '1 second', \
-         category=%s, subcategory=%s, source=%s, lastmodified=%s, status=%s \
-         where name=%s",
-        [
+      self.upsert(
+        cursor, 'demand',
+        (
+          'name', 'due', 'quantity', 'priority', 'item_id', 'location_id', 'operation_id',
+          'customer_id', 'minshipment', 'maxlateness', 'category', 'subcategory', 'source', 'status'
+          ),
+        (
           (
-            str(i.due), round(i.quantity, 8), i.priority,
-            i.item.name, i.location.name if i.location else None,
+            i.name, i.due, i.quantity, i.priority, i.item.name,
+            i.location.name if i.location else None,
             i.operation.name if i.operation and not i.operation.hidden else None,
             i.customer.name if i.customer else None,
-            round(i.minshipment, 8),
-            i.maxlateness,
-            i.category, i.subcategory, i.source, self.timestamp,
-            i.status, i.name
+            i.minshipment, seconds(i.maxlateness),
+            i.category, i.subcategory, i.source, i.status,
+            i.owner.name if i.owner else None
           )
           for i in frepple.demands()
-          if i.name in primary_keys and isinstance(i, frepple.demand_default) and not i.hidden and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update demand set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
-          for i in frepple.demands()
-          if i.owner and isinstance(i, frepple.demand_default) and (not self.source or self.source == i.source)
-        ])
+          if isinstance(i, frepple.demand_default) and not i.hidden and (not self.source or self.source == i.source)
+        ),
+        owner=True
+        )
       print('Exported demands in %.2f seconds' % (time() - starttime))
 
 
@@ -740,56 +518,30 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting resources...")
       starttime = time()
-      cursor.execute("select name from resource")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into resource \
-        (name,description,maximum,maximum_calendar_id,location_id,type,cost, \
-         maxearly,setup,setupmatrix_id,category,subcategory,efficiency, \
-         available_id,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s,%s * interval '1 second',%s,%s,%s,%s,%s,%s,%s,%s)",
-        [
+      self.upsert(
+        cursor, 'resource',
+        (
+          'name', 'description', 'maximum', 'maximum_calendar_id', 'location_id', 'type',
+          'cost', 'maxearly', 'setup', 'setupmatrix_id', 'category', 'subcategory',
+          'efficiency', 'available_id', 'source'
+          ),
+        (
           (
             i.name, i.description, i.maximum,
             i.maximum_calendar.name if i.maximum_calendar else None,
             i.location and i.location.name or None, i.__class__.__name__[9:],
-            round(i.cost, 8), i.maxearly,
+            i.cost, seconds(i.maxearly),
             i.setup, i.setupmatrix and i.setupmatrix.name or None,
             i.category, i.subcategory, i.efficiency,
             i.available.name if i.available else None,
-            i.source, self.timestamp
+            i.source,
+            i.owner.name if i.owner else None
           )
           for i in frepple.resources()
-          if i.name not in primary_keys and not i.hidden and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update resource \
-        set description=%s, maximum=%s, maximum_calendar_id=%s, location_id=%s, \
-        type=%s, cost=%s, maxearly=%s * interval '1 second', setup=%s, setupmatrix_id=%s, \
-        category=%s, subcategory=%s, efficiency=%s, available_id=%s, \
-        source=%s, lastmodified=%s \
-        where name=%s",
-        [
-          (
-            i.description, i.maximum,
-            i.maximum_calendar and i.maximum_calendar.name or None,
-            i.location and i.location.name or None, i.__class__.__name__[9:],
-            round(i.cost, 8), round(i.maxearly, 8),
-            i.setup, i.setupmatrix and i.setupmatrix.name or None,
-            i.category, i.subcategory, round(i.efficiency, 8),
-            i.available.name if i.available else None,
-            i.source, self.timestamp, i.name
-          )
-          for i in frepple.resources()
-          if i.name in primary_keys and not i.hidden and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update resource set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
-          for i in frepple.resources()
-          if i.owner and not i.hidden and (not self.source or self.source == i.source)
-        ])
+          if not i.hidden and (not self.source or self.source == i.source)
+        ),
+        owner=True
+        )
       print('Exported resources in %.2f seconds' % (time() - starttime))
 
 
@@ -797,22 +549,14 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting skills...")
       starttime = time()
-      cursor.execute("SELECT name FROM skill")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into skill (name,source,lastmodified) values(%s,%s,%s)",
-        [
-          ( i.name, i.source, self.timestamp )
-          for i in frepple.skills()
-          if i.name not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update skill set source=%s, lastmodified=%s where name=%s",
-        [
-          (i.source, self.timestamp, i.name)
+      self.upsert(
+        cursor, 'skill',
+        ('name', 'source'),
+        (
+          (i.name, i.source)
           for i in frepple.skills()
-          if i.name in primary_keys and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ))
       print('Exported skills in %.2f seconds' % (time() - starttime))
 
 
@@ -820,30 +564,21 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting resource skills...")
       starttime = time()
-      cursor.execute("SELECT resource_id, skill_id FROM resourceskill")  # todo resource&skill are not necesarily unique
-      primary_keys = set([ i for i in cursor.fetchall() ])
 
       def res_skills():
         for s in frepple.skills():
           for r in s.resourceskills:
-            yield (r.effective_start, r.effective_end, r.priority, r.source, self.timestamp, r.resource.name, s.name)
+            yield (r.resource.name, s.name, r.effective_start, r.effective_end, r.priority, r.source)
 
-      cursor.executemany(
-        "insert into resourceskill \
-        (effective_start,effective_end,priority,source,lastmodified,resource_id,skill_id) \
-        values(%s,%s,%s,%s,%s,%s,%s)",
-        [
+      self.upsert(
+        cursor, 'resourceskill',
+        ('resource_id', 'skill_id', 'effective_start', 'effective_end', 'priority', 'source'),
+        (
           i for i in res_skills()
-          if (i[5],i[6]) not in primary_keys and (not self.source or self.source == i[3])
-        ])
-      cursor.executemany(
-        "update resourceskill \
-        set effective_start=%s, effective_end=%s, priority=%s, source=%s, lastmodified=%s \
-        where resource_id=%s and skill_id=%s",
-        [
-          i for i in res_skills()
-          if (i[5],i[6]) in primary_keys and (not self.source or self.source == i[3])
-        ])
+          if not self.source or self.source == i[5]
+        ),
+        key=('resource_id', 'skill_id')
+        )
       print('Exported resource skills in %.2f seconds' % (time() - starttime))
 
 
@@ -851,26 +586,14 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting setup matrices...")
       starttime = time()
-      cursor.execute("SELECT name FROM setupmatrix")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into setupmatrix \
-        (name,source,lastmodified) \
-        values(%s,%s,%s)",
-        [
-          (i.name, i.source, self.timestamp)
+      self.upsert(
+        cursor, 'setupmatrix',
+        ('name', 'source'),
+        (
+          (i.name, i.source)
           for i in frepple.setupmatrices()
-          if i.name not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update setupmatrix \
-         set source=%s, lastmodified=%s \
-         where name=%s",
-        [
-          (i.source, self.timestamp, i.name)
-          for i in frepple.setupmatrices()
-          if i.name in primary_keys and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ))
       print('Exported setupmatrices in %.2f seconds' % (time() - starttime))
 
 
@@ -878,40 +601,25 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting setup matrix rules...")
       starttime = time()
-      cursor.execute("SELECT setupmatrix_id, priority FROM setuprule")
-      primary_keys = set([ i for i in cursor.fetchall() ])
 
       def matrixrules():
         for m in frepple.setupmatrices():
           for i in m.rules:
             yield m, i
 
-      cursor.executemany(
-        "insert into setuprule \
-        (setupmatrix_id,priority,fromsetup,tosetup,duration,cost,source,lastmodified) \
-        values(%s,%s,%s,%s,%s * interval '1 second',%s,%s,%s)",
-        [
-         (
-           i[0].name, i[1].priority, i[1].fromsetup, i[1].tosetup, i[1].duration,
-           round(i[1].cost, 8),
-           i.source, self.timestamp
-         )
-         for i in matrixrules()
-         if (i[0].name, i[1].priority) not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-         "update setuprule \
-         set fromsetup=%s, tosetup=%s, duration=%s * interval '1 second', \
-         cost=%s, source=%s, lastmodified=%s \
-         where setupmatrix_id=%s and priority=%s",
-        [
+      self.upsert(
+        cursor, 'setuprule',
+        ('setupmatrix_id', 'priority', 'fromsetup', 'tosetup', 'duration', 'cost', 'source'),
+        (
           (
-            i[1].fromsetup, i[1].tosetup, i[1].duration, round(i[1].cost, 8),
-            i.source, self.timestamp, i[0].name, i[1].priority
+            m.name, i.priority, i.fromsetup, i.tosetup, seconds(i.duration),
+            i.cost, m.source
           )
-          for i[1] in matrixrules()
-          if (i[0].name, i[1].priority) in primary_keys and (not self.source or self.source == i.source)
-        ])
+          for m, i in matrixrules()
+          if not self.source or self.source == m.source
+        ),
+        key=('setupmatrix_id', 'priority')
+        )
       print('Exported setup matrix rules in %.2f seconds' % (time() - starttime))
 
 
@@ -919,39 +627,20 @@ class exportStaticModel(object):
     with transaction.atomic(using=self.database, savepoint=False):
       print("Exporting items...")
       starttime = time()
-      cursor.execute("SELECT name FROM item")
-      primary_keys = set([ i[0] for i in cursor.fetchall() ])
-      cursor.executemany(
-        "insert into item \
-        (name,description,cost,category,subcategory,source,lastmodified) \
-        values(%s,%s,%s,%s,%s,%s,%s)",
-        [
-          (
-            i.name, i.description, round(i.cost, 8), i.category,
-            i.subcategory, i.source, self.timestamp
-          )
-          for i in frepple.items()
-          if i.name not in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update item \
-         set description=%s, cost=%s, category=%s, subcategory=%s, source=%s, lastmodified=%s \
-         where name=%s",
-        [
+      self.upsert(
+        cursor, 'item',
+        ('name', 'description', 'cost', 'category', 'subcategory', 'source'),
+        (
           (
-            i.description, round(i.cost, 8), i.category, i.subcategory,
-            i.source, self.timestamp, i.name
+            i.name, i.description, i.cost, i.category,
+            i.subcategory, i.source,
+            i.owner.name if i.owner else None
           )
           for i in frepple.items()
-          if i.name in primary_keys and (not self.source or self.source == i.source)
-        ])
-      cursor.executemany(
-        "update item set owner_id=%s where name=%s",
-        [
-          (i.owner.name, i.name)
-          for i in frepple.items()
-          if i.owner and (not self.source or self.source == i.source)
-        ])
+          if not self.source or self.source == i.source
+        ),
+        owner=True
+        )
       print('Exported items in %.2f seconds' % (time() - starttime))
 
 
@@ -971,6 +660,141 @@ class exportStaticModel(object):
       print('Exported parameters in %.2f seconds' % (time() - starttime))
 
 
+  def deleteRecords(self, cursor, table, sql, args=None):
+    '''
+    Executes a delete statement and reports its timing.
+    '''
+    starttime = time()
+    cursor.execute(sql, args)
+    if self.verbosity:
+      print('Deleted %d stale records from %s in %.2f seconds' % (cursor.rowcount, table, time() - starttime))
+
+
+  def deleteStale(self, table):
+    '''
+    Returns a cleanup step that deletes the records of the source that
+    weren't updated by this export.
+    '''
+    def step(cursor):
+      self.deleteRecords(
+        cursor, table,
+        "delete from %s where source = %%s and lastmodified <> %%s" % table,
+        (self.source, self.timestamp)
+        )
+    return step
+
+
+  def cleanup(self, cursor):
+    '''
+    Deletes the records of the source that weren't updated by this export.
+
+    The tables are cleaned in stages that respect the foreign key dependencies.
+    Within a stage the groups of tables are independent of each other, and
+    they are processed in parallel when multiple workers are configured.
+    The stale operations and operationplans are computed only once, and
+    the groups using them run on the main connection.
+    '''
+    if self.verbosity:
+      print("Cleaning stale records...")
+    starttime = time()
+    try:
+      workers = int(Parameter.getValue('export.workers', self.database, '4'))
+    except ValueError:
+      workers = 1
+
+    # Stage 1: stale key sets, and the operationplans depending on them
+    cursor.execute('''
+      create temporary table stale_operation as
+      select name from operation
+      where source = %s and lastmodified <> %s
+      ''', (self.source, self.timestamp))
+    cursor.execute("alter table stale_operation add primary key (name)")
+    cursor.execute('''
+      create temporary table stale_operationplan as
+      select id from operationplan
+      where source = %s and lastmodified <> %s
+      union
+      select operationplan.id from operationplan
+      inner join stale_operation on operationplan.operation_id = stale_operation.name
+      union
+      select operationplan.id from operationplan
+      inner join demand on operationplan.demand_id = demand.name
+      where demand.source = %s and demand.lastmodified <> %s
+      ''', (self.source, self.timestamp, self.source, self.timestamp))
+    cursor.execute("alter table stale_operationplan add primary key (id)")
+    for table in ('operationplanmaterial', 'operationplanresource'):
+      self.deleteRecords(
+        cursor, table,
+        "delete from %s using stale_operationplan where %s.operationplan_id = stale_operationplan.id" % (table, table)
+        )
+    self.deleteRecords(
+      cursor, 'operationplan',
+      "delete from operationplan using stale_operationplan where operationplan.id = stale_operationplan.id"
+      )
+
+    # Next stages: tables referencing the stale operations first, and
+    # the referenced master data tables last
+    def operation_children(cursor):
+      for table, field in (
+        ('operationmaterial', 'operation_id'), ('suboperation', 'operation_id'),
+        ('suboperation', 'suboperation_id'), ('operationresource', 'operation_id')
+        ):
+        self.deleteRecords(
+          cursor, table,
+          "delete from %s using stale_operation where %s.%s = stale_operation.name" % (table, table, field)
+          )
+
+    stages = [
+      [
+        [ operation_children, self.deleteStale('operationmaterial'), self.deleteStale('suboperation'),
+          self.deleteStale('operationresource') ],
+        [ self.deleteStale('demand'), self.deleteStale('customer') ],
+        [ self.deleteStale('itemsupplier'), self.deleteStale('supplier') ],
+        [ self.deleteStale('itemdistribution') ],
+        [ self.deleteStale('buffer') ],
+        [ self.deleteStale('resourceskill'), self.deleteStale('skill') ],
+        [ self.deleteStale('setuprule') ],
+      ],
+      [
+        [ self.deleteStale('operation') ],
+      ],
+      [
+        [ self.deleteStale('item') ],
+        [ self.deleteStale('resource') ],
+      ],
+      [
+        [ self.deleteStale('location') ],
+        [ self.deleteStale('setupmatrix') ],
+      ],
+      [
+        [ self.deleteStale('calendar') ],
+      ],
+    ]
+    for groups in stages:
+      if workers > 1:
+        tasks = [ DatabaseTask(self, *g) for g in groups[1:] ]
+        for t in tasks:
+          t.start()
+        try:
+          for f in groups[0]:
+            f(cursor)
+        finally:
+          for t in tasks:
+            t.join()
+        # Failures in the threads abort the cleanup as well
+        for t in tasks:
+          if t.errors:
+            raise t.errors[0]
+      else:
+        for g in groups:
+          for f in g:
+            f(cursor)
+
+    cursor.execute("drop table stale_operationplan, stale_operation")
+    if self.verbosity:
+      print('Cleaned stale records in %.2f seconds' % (time() - starttime))
+
+
   def run(self):
     '''
     This function exports the data from the frePPLe memory into the database.
@@ -1038,74 +862,7 @@ class exportStaticModel(object):
 
       # Cleanup unused records
       if self.source:
-        cursor.execute('''
-          delete from operationmaterial
-          where (source = %s and lastmodified <> %s)
-          or operation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-          ''', (self.source, self.timestamp, self.source, self.timestamp))
-        cursor.execute("delete from buffer where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute('''
-          delete from operationplanmaterial
-          where operationplan_id in (select id from operationplan
-                inner join demand on operationplan.demand_id = demand.name
-                where demand.source = %s and demand.lastmodified <> %s
-                )''', (self.source, self.timestamp))
-        cursor.execute('''
-          delete from operationplanresource
-          where operationplan_id in (select id from operationplan
-                inner join demand on operationplan.demand_id = demand.name
-                where demand.source = %s and demand.lastmodified <> %s
-                )''', (self.source, self.timestamp))
-        cursor.execute("delete from operationplan where demand_id in (select name from demand where source = %s and lastmodified <> %s)", (self.source, self.timestamp))
-        cursor.execute("delete from demand where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from itemsupplier where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from itemdistribution where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from item where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute('''
-          delete from operationplanmaterial
-          where operationplan_id in (
-            select operationplan.id
-            from operationplan
-            where (operationplan.source = %s and operationplan.lastmodified <> %s)
-            or operation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-            )
-          ''', (self.source, self.timestamp, self.source, self.timestamp))
-        cursor.execute('''
-          delete from operationplanresource
-          where operationplan_id in (
-            select operationplan.id
-            from operationplan
-            where (operationplan.source = %s and operationplan.lastmodified <> %s)
-            or operation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-            )
-          ''', (self.source, self.timestamp, self.source, self.timestamp))
-        cursor.execute('''
-          delete from operationplan 
-          where (source = %s and lastmodified <> %s)
-          or operation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-          ''', (self.source, self.timestamp, self.source, self.timestamp))
-        cursor.execute('''
-          delete from suboperation 
-          where (source = %s and lastmodified <> %s)
-          or operation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-          or suboperation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-          ''', (self.source, self.timestamp, self.source, self.timestamp, self.source, self.timestamp))
-        cursor.execute('''
-          delete from operationresource
-          where (source = %s and lastmodified <> %s)
-          or operation_id in (select name from operation where operation.source = %s and operation.lastmodified <> %s)
-          ''', (self.source, self.timestamp, self.source, self.timestamp))
-        cursor.execute("delete from resourceskill where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from operation where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from suboperation where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from resource where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from location where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from calendar where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from skill where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from setuprule where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from setupmatrix where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from customer where source = %s and lastmodified <> %s", (self.source, self.timestamp))
-        cursor.execute("delete from supplier where source = %s and lastmodified <> %s", (self.source, self.timestamp))
+        self.cleanup(cursor)
 
       # Close the database connection
       cursor.close()
@@ -1124,6 +881,7 @@ class DatabaseTask(Thread):
     super(DatabaseTask, self).__init__()
     self.export = xprt
     self.functions = f
+    self.errors = []
 
   def run(self):
     # Create a database connection
@@ -1133,8 +891,9 @@ class DatabaseTask(Thread):
     for f in self.functions:
       try:
         f(cursor)
-      except:
+      except Exception as e:
         traceback.print_exc()
+        self.errors.append(e)
 
     # Close the connection
     cursor.close()
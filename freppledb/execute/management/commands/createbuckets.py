@@ -26,6 +26,7 @@ from django.template import Template, RequestContext
 
 from freppledb.common.models import Bucket, BucketDetail
 from freppledb.execute.models import Task
+from freppledb.output.models import ResourceBucketSummary
 from freppledb.common.models import User
 from freppledb import VERSION
 
@@ -233,6 +234,14 @@ class Command(BaseCommand):
           # Next date
           curdate = curdate + timedelta(1)
 
+        # Roll up the exported resource plans in the new buckets
+        with connections[database].cursor() as cursor:
+          cursor.execute(
+            "delete from out_resourcebucketplan where granularity in ('year','quarter','month','week','day')"
+            )
+          for granularity in ('year', 'quarter', 'month', 'week', 'day'):
+            ResourceBucketSummary.build(cursor, granularity)
+
       # Log success
       task.status = 'Done'
       task.finished = datetime.now()
@@ -142,10 +142,15 @@ class Command(BaseCommand):
         tables.add('operationplanmaterial')
         tables.add('operationplanresource')
         tables.add('out_problem')
+        tables.add('out_inventoryplan')
+        tables.add('out_pegging')
       if 'resource' in tables and 'out_resourceplan' not in tables:
         tables.add('out_resourceplan')
+        tables.add('out_resourcebucketplan')
       if 'demand' in tables and 'out_constraint' not in tables:
         tables.add('out_constraint')
+      if 'demand' in tables and 'out_pegging' not in tables:
+        tables.add('out_pegging')
       tables.discard('auth_group_permissions')
       tables.discard('auth_permission')
       tables.discard('auth_group')
@@ -156,6 +161,7 @@ class Command(BaseCommand):
       tables.discard('common_preference')
       tables.discard('django_content_type')
       tables.discard('execute_log')
+      tables.discard('execute_taskstep')
       tables.discard('common_scenario')
 
       # Delete all records from the tables.
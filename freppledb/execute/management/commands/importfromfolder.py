@@ -15,21 +15,21 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import codecs
 from datetime import datetime
 from time import localtime, strftime
-import csv
-import gzip
 from openpyxl import load_workbook
 import os
 import logging
+from queue import Queue
+from threading import Thread
 
 from django.conf import settings
 from django.contrib.auth import get_permission_codename
 from django.contrib.contenttypes.models import ContentType
-from logging import ERROR, WARNING
+from logging import DEBUG, ERROR, WARNING
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connections, DEFAULT_DB_ALIAS, transaction
+from django.db.models import Model
 from django.utils import translation
 from django.utils.formats import get_format
 from django.utils.translation import ugettext_lazy as _
@@ -39,7 +39,7 @@ from freppledb.execute.models import Task
 from freppledb.common.middleware import _thread_locals
 from freppledb.common.report import GridReport, matchesModelName
 from freppledb import VERSION
-from freppledb.common.dataload import parseCSVdata, parseExcelWorksheet
+from freppledb.common.dataload import parseCSVdata, parseExcelWorksheet, EncodedCSVReader
 from freppledb.common.models import User
 from freppledb.common.report import EXCLUDE_FROM_BULK_OPERATIONS
 
@@ -50,7 +50,7 @@ class Command(BaseCommand):
 
   help = '''
     Loads CSV files from the configured FILEUPLOADFOLDER folder into the frePPLe database.
-    The data files should have the extension .csv or .csv.gz, and the file name should
+    The data files should have the extension .csv, .csv.gz or .csv.zst, and the file name should
     start with the name of the data model.
     '''
 
@@ -69,6 +69,14 @@ class Command(BaseCommand):
       '--task', type=int,
       help='Task identifier (generated automatically if not provided)'
       )
+    parser.add_argument(
+      '--mode', default='row', choices=['row', 'bulk'],
+      help='Load the data record by record, or in batches which is faster for big data files'
+      )
+    parser.add_argument(
+      '--jobs', type=int, default=1,
+      help='Number of data files to load in parallel'
+      )
 
 
   def get_version(self):
@@ -88,6 +96,8 @@ class Command(BaseCommand):
         raise CommandError("User '%s' not found" % options['user'] )
     else:
       self.user = None
+    self.bulk = options['mode'] == 'bulk'
+    self.jobs = max(options['jobs'] or 1, 1)
     timestamp = now.strftime("%Y%m%d%H%M%S")
     if self.database == DEFAULT_DB_ALIAS:
       logfile = 'importfromfolder-%s.log' % timestamp
@@ -104,7 +114,6 @@ class Command(BaseCommand):
 
     task = None
     errors = [0, 0]
-    returnederrors = [0, 0]
     try:
       setattr(_thread_locals, 'database', self.database)
       # Initialize the task
@@ -136,7 +145,7 @@ class Command(BaseCommand):
         all_models = [ (ct.model_class(), ct.pk) for ct in ContentType.objects.all() if ct.model_class() ]
         models = []
         for ifile in os.listdir(settings.DATABASES[self.database]['FILEUPLOADFOLDER']):
-          if not ifile.lower().endswith(('.csv', '.csv.gz', '.xlsx')):
+          if not ifile.lower().endswith(('.csv', '.csv.gz', '.csv.zst', '.xlsx')):
             continue
           filename0 = ifile.split('.')[0]
 
@@ -163,26 +172,8 @@ class Command(BaseCommand):
         # Sort the list of models, based on dependencies between models
         models = GridReport.sort_models(models)
 
-        i = 0
         cnt = len(models)
-        for ifile, model, contenttype_id, dependencies in models:
-          task.status = str(int(10 + i / cnt * 80)) + '%'
-          task.message = 'Processing data file %s' % ifile
-          task.save(using=self.database)
-          i += 1
-          filetoparse = os.path.join(os.path.abspath(settings.DATABASES[self.database]['FILEUPLOADFOLDER']), ifile)
-          if ifile.lower().endswith('.xlsx'):
-            logger.info("%s Started processing data in Excel file: %s" % (datetime.now().replace(microsecond=0), ifile))
-            returnederrors = self.loadExcelfile(model, filetoparse)
-            errors[0] += returnederrors[0]
-            errors[1] += returnederrors[1]
-            logger.info("%s Finished processing data in file: %s" % (datetime.now().replace(microsecond=0), ifile))
-          else:
-            logger.info("%s Started processing data in CSV file: %s" % (datetime.now().replace(microsecond=0), ifile))
-            returnederrors = self.loadCSVfile(model, filetoparse)
-            errors[0] += returnederrors[0]
-            errors[1] += returnederrors[1]
-            logger.info("%s Finished processing data in CSV file: %s" % (datetime.now().replace(microsecond=0), ifile))
+        self.loadFiles(models, task, errors)
       else:
         errors[0] += 1
         cnt = 0
@@ -226,14 +217,114 @@ class Command(BaseCommand):
 
 
 
+  def loadFiles(self, models, task, errors):
+    '''
+    Loads the sorted list of data files, running up to self.jobs files in
+    parallel. A file is started when all files it depends on are loaded.
+    Each file is loaded in a separate thread with its own database connection.
+    '''
+    # Build the dependency graph: a file waits for the files before it in the
+    # sorted list that hold data it refers to, or that load into the same
+    # table. Proxy models of the same table can't be loaded at the same time,
+    # because the keys of new records are generated from the highest key in
+    # the table.
+    cnt = len(models)
+    waitfor = [
+      set(
+        i for i in range(j)
+        if models[i][1]._meta.concrete_model == models[j][1]._meta.concrete_model
+        or models[i][1]._meta.db_table == models[j][1]._meta.db_table
+        or self.dependsOn(models[j][1], models[i])
+        )
+      for j in range(cnt)
+      ]
+
+    results = Queue()
+    started = set()
+    finished = set()
+    running = {}
+    while len(finished) < cnt:
+      # Start the files that are ready
+      for j in range(cnt):
+        if len(running) >= self.jobs:
+          break
+        if j not in started and waitfor[j] <= finished:
+          started.add(j)
+          running[j] = models[j][0]
+          Thread(target=self.loadFile, args=(j, models[j][0], models[j][1], results), daemon=True).start()
+
+      # Report progress
+      task.status = str(int(10 + len(finished) / cnt * 80)) + '%'
+      task.message = 'Processing data file %s' % ', '.join(running.values())
+      task.save(using=self.database)
+
+      # Wait for a file to finish
+      j, returnederrors = results.get()
+      del running[j]
+      finished.add(j)
+      errors[0] += returnederrors[0]
+      errors[1] += returnederrors[1]
+
+
+  @staticmethod
+  def dependsOn(model, other):
+    '''
+    Returns true when the model refers to the data in the other file.
+    The exceptions are the same as in GridReport.sort_models.
+    '''
+    if model not in other[3]:
+      return False
+    base = model.__base__
+    if base == Model or base._meta.abstract:
+      base = None
+    other_base = other[1].__base__
+    if other_base == Model or other_base._meta.abstract:
+      other_base = None
+    if base and base == other_base:
+      return False
+    return base != other[1] and other_base != model
+
+
+  def loadFile(self, seq, ifile, model, results):
+    returnederrors = [1, 0]
+    try:
+      setattr(_thread_locals, 'database', self.database)
+      translation.activate(settings.LANGUAGE_CODE)
+      filetoparse = os.path.join(os.path.abspath(settings.DATABASES[self.database]['FILEUPLOADFOLDER']), ifile)
+      if ifile.lower().endswith('.xlsx'):
+        logger.info("%s Started processing data in Excel file: %s" % (datetime.now().replace(microsecond=0), ifile))
+        returnederrors = self.loadExcelfile(model, filetoparse)
+        logger.info("%s Finished processing data in file: %s" % (datetime.now().replace(microsecond=0), ifile))
+      else:
+        logger.info("%s Started processing data in CSV file: %s" % (datetime.now().replace(microsecond=0), ifile))
+        returnederrors = self.loadCSVfile(model, filetoparse)
+        logger.info("%s Finished processing data in CSV file: %s" % (datetime.now().replace(microsecond=0), ifile))
+    except Exception as e:
+      logger.error("%s Error: Failed processing data file %s: %s" % (datetime.now().replace(microsecond=0), ifile, e))
+    finally:
+      setattr(_thread_locals, 'database', None)
+      connections[self.database].close()
+      results.put( (seq, returnederrors) )
+
+
   def loadCSVfile(self, model, file):
     errorcount = 0
     warningcount = 0
-    datafile = EncodedCSVReader(file, delimiter=self.delimiter)
+    datafile = None
+    progress = 0
     try:
+      datafile = EncodedCSVReader(file, delimiter=self.delimiter)
       with transaction.atomic(using=self.database):
-        for error in parseCSVdata(model, datafile, user=self.user, database=self.database):
-          if error[0] == ERROR:
+        for error in parseCSVdata(model, datafile, user=self.user, database=self.database, ping=True, bulk=self.bulk):
+          if error[0] == DEBUG:
+            # Report the progress through the file in steps of 10%
+            pct = datafile.progress()
+            if pct is not None and pct >= progress + 10:
+              progress = pct - pct % 10
+              logger.info('%s Processed %s%% of %s' % (
+                datetime.now().replace(microsecond=0), progress, os.path.basename(file)
+                ))
+          elif error[0] == ERROR:
             logger.error('%s Error: %s%s%s%s' % (
               datetime.now().replace(microsecond=0),
               "Row %s: " % error[1] if error[1] else '',
@@ -261,6 +352,9 @@ class Command(BaseCommand):
               ))
     except:
       logger.error('%s Error: Invalid data format - skipping the file \n' % datetime.now().replace(microsecond=0))
+    finally:
+      if datafile:
+        datafile.close()
     return [errorcount, warningcount]
 
 
@@ -272,7 +366,7 @@ class Command(BaseCommand):
         wb = load_workbook(filename=file, read_only=True, data_only=True)
         for ws_name in wb.sheetnames:
           ws = wb[ws_name]
-          for error in parseExcelWorksheet(model, ws, user=self.user, database=self.database):
+          for error in parseExcelWorksheet(model, ws, user=self.user, database=self.database, bulk=self.bulk):
             if error[0] == ERROR:
               logger.error('%s Error: %s%s%s%s' % (
                 datetime.now().replace(microsecond=0),
@@ -325,7 +419,7 @@ class Command(BaseCommand):
         uploadfolder = settings.DATABASES[request.database]['FILEUPLOADFOLDER']
         if os.path.isdir(uploadfolder):
           for file in os.listdir(uploadfolder):
-            if file.endswith(('.csv', '.csv.gz', '.log', '.xlsx')):
+            if file.endswith(('.csv', '.csv.gz', '.csv.zst', '.log', '.xlsx')):
               filestoupload.append([
                 file,
                 strftime("%Y-%m-%d %H:%M:%S",localtime(os.stat(os.path.join(uploadfolder, file)).st_mtime)),
@@ -344,6 +438,7 @@ class Command(BaseCommand):
               </td>
               <td colspan='5' style="padding-left: 15px;">
                 <p>{% trans "Import CSV or Excel files from the data folder. The file names must match the names of data objects and the first line in the file must contain the field names." %}</p>
+                <p><input type="checkbox" autocomplete="off" name="mode" value="bulk"/>&nbsp;&nbsp;{% trans "Load the data in bulk mode, which is faster for big data files" %}</p>
               </td>
             </tr>
             <tr>
@@ -500,57 +595,10 @@ class Command(BaseCommand):
         _("export"), _("file name"), _("size"), _("changed"), _("Delete all files"),
         _("Delete file"), _("Upload data files"), _("Download file"),
         _("Import CSV or Excel files from the data folder. The file names must match the names of data objects and the first line in the file must contain the field names."),
+        _("Load the data in bulk mode, which is faster for big data files"),
         _("File %s was not deleted"), _('Close'), _("File %s was deleted"), _("All data files were deleted"),
         _("You are about to delete all files"), _("You are about to delete file %s"),
         _("Delete file"), _("Confirm"), _("Cancel")
         )
     else:
       return None
-
-
-class EncodedCSVReader:
-  '''
-  A CSV reader which will iterate over lines in the CSV data buffer.
-  The reader will scan the BOM header in the data to detect the right encoding.
-  '''
-  def __init__(self, datafile, **kwds):
-    # Read the file into memory
-    # TODO Huge file uploads can overwhelm your system!
-
-    # Detect the encoding of the data by scanning the BOM.
-    # Skip the BOM header if it is found.
-
-    if datafile.lower().endswith(".gz"):
-      file_open = gzip.open
-    else:
-      file_open = open
-    self.reader = file_open(datafile, 'rb')
-    data = self.reader.read(5)
-    self.reader.close()
-    if data.startswith(codecs.BOM_UTF32_BE):
-      self.reader = file_open(datafile, "rt", encoding='utf_32_be')
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF32_LE):
-      self.reader = file_open(datafile, "rt", encoding='utf_32_le')
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF16_BE):
-      self.reader = file_open(datafile, "rt", encoding='utf_16_be')
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF16_LE):
-      self.reader = file_open(datafile, "rt", encoding='utf_16_le')
-      self.reader.read(1)
-    elif data.startswith(codecs.BOM_UTF8):
-      self.reader = file_open(datafile, "rt", encoding='utf_8')
-      self.reader.read(1)
-    else:
-      # No BOM header found. We assume the data is encoded in the default CSV character set.
-      self.reader = file_open(datafile, "rt", encoding=settings.CSV_CHARSET)
-
-    # Open the file
-    self.csvreader = csv.reader(self.reader, **kwds)
-
-  def __next__(self):
-    return next(self.csvreader)
-
-  def __iter__(self):
-    return self
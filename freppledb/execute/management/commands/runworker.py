@@ -15,13 +15,13 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from datetime import datetime, timedelta
+from datetime import datetime
 import logging
 import os
+import select
 import shlex
-import time
 import operator
-from threading import Thread
+from threading import Event, Thread
 
 from django.conf import settings
 from django.core import management
@@ -30,37 +30,192 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import DEFAULT_DB_ALIAS, connections
 
 from freppledb import VERSION
-from freppledb.common.models import Parameter
 from freppledb.common.middleware import _thread_locals
-from freppledb.execute.models import Task
+from freppledb.execute.models import Task, TASK_CHANNEL
 
 
 logger = logging.getLogger(__name__)
 
 
-class WorkerAlive(Thread):
-  def __init__(self, database=DEFAULT_DB_ALIAS):
-    self.database = database
+# Key of the PostgreSQL advisory lock held by the worker of a database
+WORKER_LOCK = 20130101
+
+# Tasks that can run at the same time as other tasks.
+# All other tasks, such as generating a plan, run one after the other.
+concurrent_tasks = (
+  'exporttofolder', 'frepple_exporttofolder',
+  'exportworkbook', 'frepple_exportworkbook',
+  'importfromfolder', 'frepple_importfromfolder',
+  'importworkbook', 'frepple_importworkbook',
+  )
+
+
+def checkActive(database=DEFAULT_DB_ALIAS):
+  '''
+  Checks whether a worker is processing the queue of a database.
+
+  The worker holds an advisory lock for as long as it runs. PostgreSQL
+  releases the lock automatically when the worker dies.
+  '''
+  try:
+    with connections[database].cursor() as cursor:
+      cursor.execute('''
+        select exists (
+          select 1 from pg_locks
+          where locktype = 'advisory' and granted
+            and database = (select oid from pg_database where datname = current_database())
+            and classid = 0 and objid = %s and objsubid = 1
+          )
+        ''', (WORKER_LOCK,))
+      return cursor.fetchone()[0]
+  except:
+    return False
+
+
+class TaskListener(Thread):
+  '''
+  Wakes up the worker as soon as a task is added to the queue.
+
+  Tasks are notified on a PostgreSQL channel when they are saved with the
+  status 'Waiting'. When listening fails, the worker falls back to polling
+  the queue.
+  '''
+  def __init__(self, connection, wakeup):
+    self.connection = connection
+    self.wakeup = wakeup
     Thread.__init__(self)
     self.daemon = True
 
   def run(self):
-    while True:
-      p = Parameter.objects.all().using(self.database).get_or_create(pk='Worker alive')[0]
-      p.value = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-      try:
-        p.save(update_fields=['value'])
-      except:
-        pass
-      time.sleep(5)
+    try:
+      with self.connection.cursor() as cursor:
+        cursor.execute("listen %s" % TASK_CHANNEL)
+      while True:
+        if select.select([self.connection], [], [], 60) != ([], [], []):
+          self.connection.poll()
+          if self.connection.notifies:
+            del self.connection.notifies[:]
+            self.wakeup.set()
+    except Exception as e:
+      if not self.connection.closed:
+        logger.warning("Worker falls back to polling the queue: %s" % e)
 
 
-def checkActive(database=DEFAULT_DB_ALIAS):
+class TaskRunner(Thread):
+  '''
+  Executes a task in a thread of its own.
+  '''
+  def __init__(self, task, database, done):
+    self.task = task
+    self.database = database
+    self.done = done
+    Thread.__init__(self)
+
+  def run(self):
+    setattr(_thread_locals, 'database', self.database)
     try:
-      p = Parameter.objects.all().using(database).get(pk='Worker alive')
-      return datetime.now() - datetime.strptime(p.value, "%Y-%m-%d %H:%M:%S") <= timedelta(0, 5)
-    except:
-      return False
+      runTask(self.task, self.database)
+    finally:
+      setattr(_thread_locals, 'database', None)
+      for conn in connections.all():
+        conn.close()
+      self.done.set()
+
+
+def runTask(task, database):
+  try:
+    if 'FREPPLE_TEST' not in os.environ:
+      logger.info("Worker %s for database '%s' starting task %d at %s" % (
+        os.getpid(), settings.DATABASES[database]['NAME'], task.id, datetime.now()
+        ))
+    background = False
+    task.started = datetime.now()
+    # A
+    if task.name in ('frepple_run', 'runplan'):
+      kwargs = {}
+      if task.arguments:
+        for i in shlex.split(task.arguments):
+          j = i.split('=')
+          if len(j) > 1:
+            kwargs[j[0][2:]] = j[1]
+          else:
+            kwargs[j[0][2:]] = True
+      if 'background' in kwargs:
+        background = True
+      management.call_command('runplan', database=database, task=task.id, **kwargs)
+    # C
+    elif task.name in ('frepple_flush', 'empty'):
+      # Erase the database contents
+      kwargs = {}
+      if task.arguments:
+        for i in shlex.split(task.arguments):
+          key, val = i.split('=')
+          kwargs[key[2:]] = val
+      management.call_command('empty', database=database, task=task.id, **kwargs)
+    # D
+    elif task.name == 'loaddata':
+      args = shlex.split(task.arguments)
+      management.call_command('loaddata', *args, verbosity=0, database=database, task=task.id)
+    # E
+    elif task.name in ('frepple_copy', 'scenario_copy'):
+      args = shlex.split(task.arguments)
+      management.call_command('scenario_copy', *args, task=task.id)
+    elif task.name in ('frepple_createbuckets', 'createbuckets'):
+      args = {}
+      if task.arguments:
+        for i in shlex.split(task.arguments):
+          key, val = i.split('=')
+          args[key.strip("--").replace('-', '_')] = val
+      management.call_command('createbuckets', database=database, task=task.id, **args)
+    else:
+      # Verify the command exists
+      exists = False
+      for commandname in get_commands():
+        if commandname == task.name:
+          exists = True
+          break
+
+      # Execute the command
+      if not exists:
+        logger.error('Task %s not recognized' % task.name)
+      else:
+        kwargs = {}
+        if task.arguments:
+          for i in shlex.split(task.arguments):
+            key, val = i.split('=')
+            kwargs[key[2:]] = val
+        management.call_command(task.name, database=database, task=task.id, **kwargs)
+
+    # Read the task again from the database and update.
+    task = Task.objects.all().using(database).get(pk=task.id)
+    if task.status not in ('Done', 'Failed') or not task.finished or not task.started:
+      now = datetime.now()
+      if not task.started:
+        task.started = now
+      if not background:
+        if not task.finished:
+          task.finished = now
+        if task.status not in ('Done', 'Failed'):
+          task.status = 'Done'
+      task.save(using=database)
+    if 'FREPPLE_TEST' not in os.environ:
+      logger.info("Worker %s for database '%s' finished task %d at %s: success" % (
+        os.getpid(), settings.DATABASES[database]['NAME'], task.id, datetime.now()
+        ))          
+  except Exception as e:
+    # Read the task again from the database and update.
+    task = Task.objects.all().using(database).get(pk=task.id)
+    task.status = 'Failed'
+    now = datetime.now()
+    if not task.started:
+      task.started = now
+    task.finished = now
+    task.message = str(e)
+    task.save(using=database)
+    if 'FREPPLE_TEST' not in os.environ:
+      logger.info("Worker %s for database '%s' finished task %d at %s: failed" % (
+        os.getpid(), settings.DATABASES[database]['NAME'], task.id, datetime.now()
+        ))
 
 
 class Command(BaseCommand):
@@ -85,6 +240,10 @@ class Command(BaseCommand):
       '--continuous', action="store_true",
       default=False, help='Keep the worker alive after the queue is empty'
       )
+    parser.add_argument(
+      '--workers', type=int,
+      help='Maximum number of tasks executed at the same time (default = MAXWORKERS setting)'
+      )
 
 
   def handle(self, *args, **options):
@@ -94,145 +253,74 @@ class Command(BaseCommand):
     if database not in settings.DATABASES:
       raise CommandError("No database settings known for '%s'" % database )
     continuous = options['continuous']
+    workers = max(1, options['workers'] or getattr(settings, 'MAXWORKERS', 1))
 
     # Use the test database if we are running the test suite
     if 'FREPPLE_TEST' in os.environ:
       connections[database].close()
       settings.DATABASES[database]['NAME'] = settings.DATABASES[database]['TEST']['NAME']
 
-    # Check if a worker already exists
-    if checkActive(database):
-      if 'FREPPLE_TEST' not in os.environ:
-        logger.info("Worker process already active")
-      return
-
-    # Spawn a worker-alive thread
-    WorkerAlive(database).start()
+    # Check if a worker already exists.
+    # A dedicated connection holds the worker lock and listens for new tasks.
+    listener = connections[database].get_new_connection(connections[database].get_connection_params())
+    listener.autocommit = True
+    with listener.cursor() as cursor:
+      cursor.execute("select pg_try_advisory_lock(%s)", (WORKER_LOCK,))
+      if not cursor.fetchone()[0]:
+        listener.close()
+        if 'FREPPLE_TEST' not in os.environ:
+          logger.info("Worker process already active")
+        return
+    wakeup = Event()
+    TaskListener(listener, wakeup).start()
 
     # Process the queue
     if 'FREPPLE_TEST' not in os.environ:
       logger.info("Worker %s for database '%s' starting to process jobs" % (
         os.getpid(), settings.DATABASES[database]['NAME']
-        ))      
+        ))
     idle_loop_done = False
+    running = {}
     setattr(_thread_locals, 'database', database)
     while True:
-      try:
-        task = Task.objects.all().using(database).filter(status='Waiting').order_by('id')[0]
-        idle_loop_done = False
-      except:
-        # No more tasks found
-        if continuous:
-          time.sleep(5)
-          continue
-        else:
-          # Special case: we need to permit a single idle loop before shutting down
-          # the worker. If we shut down immediately, a newly launched task could think
-          # that a work is already running - while it just shut down.
-          if idle_loop_done:
-            break
-          else:
-            idle_loop_done = True
-            time.sleep(5)
+      wakeup.clear()
+      for i in [ i for i, t in running.items() if not t.is_alive() ]:
+        del running[i]
+      exclusive = any(t.task.name not in concurrent_tasks for t in running.values())
+      waiting = [
+        i for i in Task.objects.all().using(database).filter(status='Waiting').order_by('id')
+        if i.id not in running
+        ]
+
+      # Start waiting tasks while there are free workers.
+      # Tasks that can't run concurrently are started one at a time in the
+      # order they were submitted.
+      for task in waiting:
+        if len(running) >= workers:
+          break
+        if task.name not in concurrent_tasks:
+          if exclusive:
             continue
-      try:
-        if 'FREPPLE_TEST' not in os.environ:
-          logger.info("Worker %s for database '%s' starting task %d at %s" % (
-            os.getpid(), settings.DATABASES[database]['NAME'], task.id, datetime.now()
-            ))
-        background = False
-        task.started = datetime.now()
-        # A
-        if task.name in ('frepple_run', 'runplan'):
-          kwargs = {}
-          if task.arguments:
-            for i in shlex.split(task.arguments):
-              j = i.split('=')
-              if len(j) > 1:
-                kwargs[j[0][2:]] = j[1]
-              else:
-                kwargs[j[0][2:]] = True
-          if 'background' in kwargs:
-            background = True
-          management.call_command('runplan', database=database, task=task.id, **kwargs)
-        # C
-        elif task.name in ('frepple_flush', 'empty'):
-          # Erase the database contents
-          kwargs = {}
-          if task.arguments:
-            for i in shlex.split(task.arguments):
-              key, val = i.split('=')
-              kwargs[key[2:]] = val
-          management.call_command('empty', database=database, task=task.id, **kwargs)
-        # D
-        elif task.name == 'loaddata':
-          args = shlex.split(task.arguments)
-          management.call_command('loaddata', *args, verbosity=0, database=database, task=task.id)
-        # E
-        elif task.name in ('frepple_copy', 'scenario_copy'):
-          args = shlex.split(task.arguments)
-          management.call_command('scenario_copy', *args, task=task.id)
-        elif task.name in ('frepple_createbuckets', 'createbuckets'):
-          args = {}
-          if task.arguments:
-            for i in shlex.split(task.arguments):
-              key, val = i.split('=')
-              args[key.strip("--").replace('-', '_')] = val
-          management.call_command('createbuckets', database=database, task=task.id, **args)
-        else:
-          # Verify the command exists
-          exists = False
-          for commandname in get_commands():
-            if commandname == task.name:
-              exists = True
-              break
-
-          # Execute the command
-          if not exists:
-            logger.error('Task %s not recognized' % task.name)
-          else:
-            kwargs = {}
-            if task.arguments:
-              for i in shlex.split(task.arguments):
-                key, val = i.split('=')
-                kwargs[key[2:]] = val
-            management.call_command(task.name, database=database, task=task.id, **kwargs)
-
-        # Read the task again from the database and update.
-        task = Task.objects.all().using(database).get(pk=task.id)
-        if task.status not in ('Done', 'Failed') or not task.finished or not task.started:
-          now = datetime.now()
-          if not task.started:
-            task.started = now
-          if not background:
-            if not task.finished:
-              task.finished = now
-            if task.status not in ('Done', 'Failed'):
-              task.status = 'Done'
-          task.save(using=database)
-        if 'FREPPLE_TEST' not in os.environ:
-          logger.info("Worker %s for database '%s' finished task %d at %s: success" % (
-            os.getpid(), settings.DATABASES[database]['NAME'], task.id, datetime.now()
-            ))          
-      except Exception as e:
-        # Read the task again from the database and update.
-        task = Task.objects.all().using(database).get(pk=task.id)
-        task.status = 'Failed'
-        now = datetime.now()
-        if not task.started:
-          task.started = now
-        task.finished = now
-        task.message = str(e)
-        task.save(using=database)
-        if 'FREPPLE_TEST' not in os.environ:
-          logger.info("Worker %s for database '%s' finished task %d at %s: failed" % (
-            os.getpid(), settings.DATABASES[database]['NAME'], task.id, datetime.now()
-            ))
-    # Remove the parameter again
-    try:
-      Parameter.objects.all().using(database).get(pk='Worker alive').delete()
-    except:
-      pass
+          exclusive = True
+        running[task.id] = TaskRunner(task, database, wakeup)
+        running[task.id].start()
+
+      if running or waiting:
+        idle_loop_done = False
+      elif not continuous:
+        # Special case: we need to permit a single idle loop before shutting down
+        # the worker. If we shut down immediately, a newly launched task could think
+        # that a work is already running - while it just shut down.
+        if idle_loop_done:
+          break
+        idle_loop_done = True
+
+      # Wait for a new task or a finished task.
+      # The timeout polls the queue in case a notification got lost.
+      wakeup.wait(5)
+
+    # Release the worker lock
+    listener.close()
     setattr(_thread_locals, 'database', None)
 
     # Remove log files exceeding the configured disk space allocation
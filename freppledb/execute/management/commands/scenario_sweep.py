@@ -0,0 +1,324 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import csv
+from datetime import datetime
+from itertools import product
+import json
+import multiprocessing
+import os
+from time import time
+
+from django.conf import settings
+from django.core import management
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from freppledb.execute.models import Task
+from freppledb.common.models import User, Scenario, Parameter
+from freppledb import VERSION
+
+
+# Scenario database owned by a worker process
+_scenario = None
+
+# Set when the worker process has claimed its scenario with a first copy
+_claimed = False
+
+
+def _initWorker(scenarios):
+  global _scenario
+  from django.apps import apps
+  if not apps.ready:
+    import django
+    django.setup()
+  # Database connections inherited from the parent process can't be shared
+  for conn in connections.all():
+    conn.close()
+  _scenario = scenarios.get()
+
+
+def _runVariant(args):
+  '''
+  Copies the source database into the scenario of the worker, applies the
+  changes of a variant, generates a plan and collects the indicators.
+  '''
+  global _claimed
+  from freppledb.output.views.kpi import Report
+  index, variant, source, user = args
+  starttime = time()
+  try:
+    # The first copy fails when the scenario isn't free anymore. Later
+    # copies overwrite the scenario this worker claimed.
+    management.call_command(
+      'scenario_copy', source, _scenario, force=_claimed, user=user,
+      description="Sweep variant %s: %s" % (index + 1, json.dumps(variant, sort_keys=True))
+      )
+    _claimed = True
+    with transaction.atomic(using=_scenario):
+      for name, value in variant.items():
+        if name == 'demand_multiplier':
+          with connections[_scenario].cursor() as cursor:
+            cursor.execute(
+              "update demand set quantity = quantity * %s where status in ('open', 'quote')",
+              (value,)
+              )
+        elif name not in ('constraint', 'plantype'):
+          Parameter.objects.using(_scenario).update_or_create(
+            name=name, defaults={'value': str(value)}
+            )
+    management.call_command(
+      'runplan', database=_scenario, user=user, env='supply',
+      constraint=int(variant.get('constraint', 15)),
+      plantype=int(variant.get('plantype', 1))
+      )
+    return (index, _scenario, None, Report.getKPIs(_scenario), time() - starttime)
+  except Exception as e:
+    return (index, _scenario, str(e), [], time() - starttime)
+
+
+class Command(BaseCommand):
+  help = '''
+  Evaluates a grid of what-if variants in parallel.
+
+  Every variant is planned in its own scenario: the source database is
+  copied into a free scenario, the changes of the variant are applied and
+  a plan is generated. The performance indicators of all variants are
+  collected in a single comparison table.
+
+  The grid is a JSON dictionary, or a file containing it, that maps every
+  setting on a list of values. All combinations of the values are evaluated.
+  A JSON list of dictionaries defines the variants explicitly. The settings
+  are:
+    - constraint: the constraints considered by the plan
+    - plantype: 1 for a constrained plan, 2 for an unconstrained plan
+    - demand_multiplier: a factor applied to the quantity of all open demands
+    - any other key is a parameter, such as plan.autoFenceOperations
+  '''
+
+  requires_system_checks = False
+
+
+  def get_version(self):
+    return VERSION
+
+
+  def add_arguments(self, parser):
+    parser.add_argument(
+      '--user',
+      help='User running the command'
+      )
+    parser.add_argument(
+      '--database', default=DEFAULT_DB_ALIAS,
+      help='Source database of all variants'
+      )
+    parser.add_argument(
+      '--grid', required=True,
+      help='JSON string or file with the settings to evaluate'
+      )
+    parser.add_argument(
+      '--scenarios',
+      help='Comma separated list of scenarios to use (default = all free scenarios)'
+      )
+    parser.add_argument(
+      '--workers', type=int,
+      help='Maximum number of plans generated at the same time'
+      )
+    parser.add_argument(
+      '--output',
+      help='CSV file to save the comparison table in'
+      )
+    parser.add_argument(
+      '--task', type=int,
+      help='Task identifier (generated automatically if not provided)'
+      )
+
+
+  @staticmethod
+  def getVariants(grid):
+    '''
+    Expands a grid into a list of variants.
+    '''
+    if os.path.isfile(grid):
+      with open(grid) as f:
+        grid = f.read()
+    try:
+      grid = json.loads(grid)
+    except ValueError as e:
+      raise CommandError("Invalid grid: %s" % e)
+    if isinstance(grid, list):
+      variants = grid
+    elif isinstance(grid, dict):
+      keys = sorted(grid.keys())
+      values = [ v if isinstance(v, list) else [v] for v in (grid[k] for k in keys) ]
+      variants = [ dict(zip(keys, i)) for i in product(*values) ]
+    else:
+      raise CommandError("Invalid grid: expecting a dictionary or a list")
+    if not variants or not all(isinstance(i, dict) for i in variants):
+      raise CommandError("Invalid grid: no variants found")
+    return variants
+
+
+  @staticmethod
+  def getWorkers(workers, scenarios):
+    '''
+    Limits the number of parallel plans to the free scenarios, the number
+    of processors, and the number of engines fitting within the memory.
+    '''
+    if not workers:
+      workers = multiprocessing.cpu_count()
+    if settings.MAXMEMORYSIZE:
+      try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+        workers = min(workers, max(1, memory // settings.MAXMEMORYSIZE))
+      except (AttributeError, ValueError, OSError):
+        # Not available on this platform
+        pass
+    return max(1, min(workers, len(scenarios)))
+
+
+  def handle(self, **options):
+    # Pick up the options
+    database = options['database']
+    if database not in settings.DATABASES:
+      raise CommandError("No database settings known for '%s'" % database )
+    if options['user']:
+      try:
+        user = User.objects.all().using(database).get(username=options['user'])
+      except:
+        raise CommandError("User '%s' not found" % options['user'] )
+    else:
+      user = None
+
+    now = datetime.now()
+    task = None
+    try:
+      # Initialize the task
+      if options['task']:
+        try:
+          task = Task.objects.all().using(database).get(pk=options['task'])
+        except:
+          raise CommandError("Task identifier not found")
+        if task.started or task.finished or task.status != "Waiting" or task.name != 'scenario_sweep':
+          raise CommandError("Invalid task identifier")
+        task.status = '0%'
+        task.started = now
+      else:
+        task = Task(name='scenario_sweep', submitted=now, started=now, status='0%', user=user)
+      task.arguments = "--grid=%s" % options['grid']
+      task.save(using=database)
+
+      # Validate the arguments
+      variants = self.getVariants(options['grid'])
+      Scenario.syncWithSettings()
+      if options['scenarios']:
+        scenarios = [ i.strip() for i in options['scenarios'].split(',') if i.strip() ]
+        free = set(
+          Scenario.objects.using(DEFAULT_DB_ALIAS).filter(status='Free').values_list('name', flat=True)
+          )
+        for i in scenarios:
+          if i == database or i not in settings.DATABASES:
+            raise CommandError("Invalid scenario '%s'" % i)
+          if i not in free:
+            raise CommandError("Scenario '%s' isn't free" % i)
+        task.arguments += " --scenarios=%s" % options['scenarios']
+      else:
+        scenarios = [
+          i.name for i in Scenario.objects.using(DEFAULT_DB_ALIAS).filter(status='Free')
+          if i.name != database
+          ]
+      if not scenarios:
+        raise CommandError("No free scenario available")
+      workers = self.getWorkers(options['workers'], scenarios)
+      task.message = "Evaluating %d variants in %d scenarios" % (len(variants), workers)
+      task.save(using=database)
+
+      # Every worker process keeps using the same scenario
+      queue = multiprocessing.Queue()
+      for i in scenarios[:workers]:
+        queue.put(i)
+      for conn in connections.all():
+        conn.close()
+      results = [None] * len(variants)
+      pool = multiprocessing.Pool(processes=workers, initializer=_initWorker, initargs=(queue,))
+      try:
+        done = 0
+        for result in pool.imap_unordered(
+          _runVariant,
+          [ (idx, variant, database, user.username if user else None) for idx, variant in enumerate(variants) ]
+          ):
+          results[result[0]] = result
+          done += 1
+          if result[2]:
+            self.stderr.write("Variant %d failed in scenario %s: %s" % (result[0] + 1, result[1], result[2]))
+          elif int(options['verbosity']) > 0:
+            self.stdout.write("Variant %d planned in scenario %s in %.2f seconds" % (result[0] + 1, result[1], result[4]))
+          task.status = '%d%%' % (100.0 * done / len(variants))
+          task.save(using=database)
+      finally:
+        pool.close()
+        pool.join()
+
+      # Report the comparison table
+      table = self.getTable(variants, results)
+      if options['output']:
+        with open(options['output'], 'w', newline='') as f:
+          csv.writer(f).writerows(table)
+      if int(options['verbosity']) > 0:
+        for idx, variant in enumerate(variants):
+          self.stdout.write("Variant %d: %s" % (idx + 1, json.dumps(variant, sort_keys=True)))
+        widths = [ max(len(str(row[i])) for row in table) for i in range(len(table[0])) ]
+        for row in table:
+          self.stdout.write('  '.join(str(v).ljust(w) for v, w in zip(row, widths)))
+
+      # Task update
+      failed = sum(1 for i in results if i[2])
+      task.status = 'Failed' if failed == len(variants) else 'Done'
+      task.message = "Evaluated %d variants" % len(variants)
+      if failed:
+        task.message += ", %d failed" % failed
+      task.finished = datetime.now()
+
+    except Exception as e:
+      if task:
+        task.status = 'Failed'
+        task.message = '%s' % e
+        task.finished = datetime.now()
+      raise e
+
+    finally:
+      if task:
+        task.save(using=database)
+
+
+  @staticmethod
+  def getTable(variants, results):
+    '''
+    Builds a table with a row per indicator and a column per variant.
+    '''
+    keys = []
+    values = {}
+    for result in results:
+      for category, name, value in result[3]:
+        if (category, name) not in values:
+          keys.append((category, name))
+          values[(category, name)] = {}
+        values[(category, name)][result[0]] = value
+    table = [ ['category', 'name'] + [ 'variant %d' % (i + 1) for i in range(len(variants)) ] ]
+    for key in keys:
+      table.append(list(key) + [ values[key].get(i, '') for i in range(len(variants)) ])
+    return table
@@ -17,18 +17,20 @@
 
 from datetime import datetime, timedelta
 import importlib
+import os
+from time import time
 
 from django.conf import settings
 from django.core import management
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
 from django.db.models import Sum, Max, Count, F
 
 from freppledb import VERSION
 from freppledb.common.models import User, Parameter
 from freppledb.execute.models import Task
 from freppledb.input.models import PurchaseOrder, DistributionOrder, Buffer, Demand, Item
-from freppledb.input.models import ManufacturingOrder, Location
+from freppledb.input.models import ManufacturingOrder, Location, OperationMaterial
 
 
 def load_class(full_class_string):
@@ -75,6 +77,11 @@ class Command(BaseCommand):
   coded in a dedicated simulation class. A default implementation is
   provided, which can easily be extended in a subclass.
 
+  With the option "inprocess" the planning engine loads the model only once,
+  and runs the loop over all buckets in its own process. The plan of each
+  bucket is generated after synchronizing the model in memory with the
+  changes of the simulation, and is exported in delta mode.
+
   Warning: The simulation run will update the data in the database.
   Make a backup if you can't afford loosing the current contents.
   '''
@@ -118,6 +125,10 @@ class Command(BaseCommand):
       '--pause', action="store_true", default=False,
       help='Allows to stop the simulation at the end of each step'
       )
+    parser.add_argument(
+      '--inprocess', action="store_true", default=False,
+      help='Keeps the model in the memory of a single planning engine process during the complete simulation'
+      )
 
 
   def handle(self, **options):
@@ -161,6 +172,10 @@ class Command(BaseCommand):
         raise ValueError("Invalid step: %s" % options['step'])
       task.arguments += " --step=%d" % step
       verbosity = int(options['verbosity'])
+      if options['inprocess']:
+        if options['pause']:
+          raise CommandError("The pause option isn't available for an in-process simulation")
+        task.arguments += " --inprocess"
 
       # Log task
       task.save(using=database)
@@ -174,6 +189,33 @@ class Command(BaseCommand):
           print("Loading initial data")
         management.call_command('loaddata', options.get('initial'), database=database, verbosity=verbosity)
 
+      if options['inprocess']:
+        # The planning engine loads the model only once, and runs the
+        # complete simulation loop in its process.
+        # See the SimulationLoop planning task.
+        task.message = 'Simulating in the planning engine'
+        task.save(using=database)
+        env = [
+          'supply', 'simulation',
+          'simulation_horizon=%d' % horizon,
+          'simulation_step=%d' % step,
+          'simulation_verbosity=%d' % verbosity
+          ]
+        if options.get('simulator', None):
+          env.append('simulation_class=%s' % options['simulator'])
+        try:
+          management.call_command('runplan', database=database, env=','.join(env))
+        finally:
+          # The simulation task has no label, so runplan doesn't reset its
+          # environment variables. Later plans generated in this process
+          # must not run the simulation loop.
+          for i in [ i for i in os.environ if i.startswith('simulation') ]:
+            del os.environ[i]
+        task.status = 'Done'
+        task.message = "Simulated %d days in the planning engine" % horizon
+        task.finished = datetime.now()
+        return
+
       # Get current date
       param = Parameter.objects.all().using(database).get_or_create(name='currentdate')[0]
       try:
@@ -224,74 +266,7 @@ class Command(BaseCommand):
         param.value = strt.strftime("%Y-%m-%d %H:%M:%S")
         param.save(using=database)
 
-        # Initialization of the bucket
-        if verbosity > 1:
-          print("  Starting the bucket")
-        with transaction.atomic(using=database):
-          simulator.start_bucket(strt, nd)
-
-        # Generate new demand records
-        if verbosity > 1:
-          print("  Receive new orders from customers")
-        with transaction.atomic(using=database):
-          simulator.generate_customer_demand(strt, nd)
-
-        # Generate the constrained plan
-        if verbosity > 1:
-          print("  Generating plan...")
-        management.call_command('runplan', database=database)
-
-        if options['pause']:
-          print("\nYou can analyze the plan in the bucket in the user interface now...")
-          input("\nPress Enter to continue the simulation...\n")
-
-        # Release new purchase orders
-        if verbosity > 1:
-          print("  Create new purchase orders")
-        with transaction.atomic(using=database):
-          simulator.create_purchase_orders(strt, nd)
-
-        # Release new manufacturing orders
-        if verbosity > 1:
-          print("  Create new manufacturing orders")
-        with transaction.atomic(using=database):
-          simulator.create_manufacturing_orders(strt, nd)
-
-        # Release new distribution orders
-        if verbosity > 1:
-          print("  Create new distribution orders")
-        with transaction.atomic(using=database):
-          simulator.create_distribution_orders(strt, nd)
-
-        # Receive open purchase orders
-        if verbosity > 1:
-          print("  Receive open purchase orders")
-        with transaction.atomic(using=database):
-          simulator.receive_purchase_orders(strt, nd)
-
-        # Receive open distribution orders
-        if verbosity > 1:
-          print("  Receive open distribution orders")
-        with transaction.atomic(using=database):
-          simulator.receive_distribution_orders(strt, nd)
-
-        # Finish open manufacturing orders
-        if verbosity > 1:
-          print("  Finish open manufacturing orders")
-        with transaction.atomic(using=database):
-          simulator.finish_manufacturing_orders(strt, nd)
-
-        # Ship demand to customers
-        if verbosity > 1:
-          print("  Ship orders to customers")
-        with transaction.atomic(using=database):
-          simulator.ship_customer_demand(strt, nd)
-
-        # Finish of the bucket
-        if verbosity > 1:
-          print("  Ending the bucket")
-        with transaction.atomic(using=database):
-          simulator.end_bucket(strt, nd)
+        simulator.simulate_bucket(strt, nd, pause=options['pause'])
 
       # Report statistics from the simulation.
       # The simulator class collected these results during its run.
@@ -346,6 +321,175 @@ class Simulator(object):
     self.demand_value = 0
     self.demand_count = 0
 
+    # Metrics for the execution time of each step
+    self.timings = {}
+
+    # Data loaded during a step
+    self.onhand = None
+    self.onhand_changes = {}
+    self.operationmaterials = None
+
+
+  def simulate_bucket(self, strt, nd, pause=False):
+    '''
+    Executes all steps to simulate a bucket.
+    '''
+    # Initialization of the bucket
+    if self.verbosity > 1:
+      print("  Starting the bucket")
+    self.runStep('start_bucket', strt, nd)
+
+    # Generate new demand records
+    if self.verbosity > 1:
+      print("  Receive new orders from customers")
+    self.runStep('generate_customer_demand', strt, nd)
+
+    # Generate the constrained plan
+    if self.verbosity > 1:
+      print("  Generating plan...")
+    self.runStep('generate_plan', strt, nd, atomic=False)
+
+    if pause:
+      print("\nYou can analyze the plan in the bucket in the user interface now...")
+      input("\nPress Enter to continue the simulation...\n")
+
+    # Release new purchase orders
+    if self.verbosity > 1:
+      print("  Create new purchase orders")
+    self.runStep('create_purchase_orders', strt, nd)
+
+    # Release new manufacturing orders
+    if self.verbosity > 1:
+      print("  Create new manufacturing orders")
+    self.runStep('create_manufacturing_orders', strt, nd)
+
+    # Release new distribution orders
+    if self.verbosity > 1:
+      print("  Create new distribution orders")
+    self.runStep('create_distribution_orders', strt, nd)
+
+    # Receive open purchase orders
+    if self.verbosity > 1:
+      print("  Receive open purchase orders")
+    self.runStep('receive_purchase_orders', strt, nd)
+
+    # Receive open distribution orders
+    if self.verbosity > 1:
+      print("  Receive open distribution orders")
+    self.runStep('receive_distribution_orders', strt, nd)
+
+    # Finish open manufacturing orders
+    if self.verbosity > 1:
+      print("  Finish open manufacturing orders")
+    self.runStep('finish_manufacturing_orders', strt, nd)
+
+    # Ship demand to customers
+    if self.verbosity > 1:
+      print("  Ship orders to customers")
+    self.runStep('ship_customer_demand', strt, nd)
+
+    # Finish of the bucket
+    if self.verbosity > 1:
+      print("  Ending the bucket")
+    self.runStep('end_bucket', strt, nd)
+
+
+  def runStep(self, step, strt, nd, atomic=True):
+    '''
+    Executes a step of the simulation of a bucket, and measures its duration.
+
+    The inventory changes registered with the addOnhand method are saved
+    at the end of the step.
+    '''
+    start = time()
+    if atomic:
+      with transaction.atomic(using=self.database):
+        getattr(self, step)(strt, nd)
+        self.saveOnhand()
+    else:
+      getattr(self, step)(strt, nd)
+      self.saveOnhand()
+    self.timings[step] = self.timings.get(step, 0) + time() - start
+
+
+  def getOnhand(self, item, location):
+    '''
+    Returns the inventory of a buffer, including the changes registered in
+    the current step. None is returned when the buffer doesn't exist.
+    '''
+    if self.onhand is None:
+      self.onhand = {
+        (i[0], i[1]): i[2] or 0
+        for i in Buffer.objects.all().using(self.database).values_list('item', 'location', 'onhand')
+        }
+    return self.onhand.get((item, location), None)
+
+
+  def addOnhand(self, item, location, quantity):
+    '''
+    Registers a change of the inventory of a buffer.
+    The changes are aggregated per buffer in memory, and saved at the end of
+    the step. Returns False when the buffer doesn't exist.
+    '''
+    if self.getOnhand(item, location) is None:
+      return False
+    key = (item, location)
+    self.onhand[key] += quantity
+    self.onhand_changes[key] = self.onhand_changes.get(key, 0) + quantity
+    return True
+
+
+  def saveOnhand(self):
+    '''
+    Saves the inventory changes of the current step with a single statement.
+    '''
+    if self.onhand_changes:
+      with connections[self.database].cursor() as cursor:
+        cursor.execute(
+          '''
+          update buffer
+          set onhand = coalesce(buffer.onhand, 0) + changes.quantity, lastmodified = %s
+          from unnest(%s::varchar[], %s::varchar[], %s::numeric[]) as changes(item, location, quantity)
+          where buffer.item_id = changes.item and buffer.location_id = changes.location
+          ''', (
+            datetime.now(),
+            [ i[0] for i in self.onhand_changes ],
+            [ i[1] for i in self.onhand_changes ],
+            list(self.onhand_changes.values())
+          ))
+    # The next step reads fresh data again
+    self.onhand = None
+    self.onhand_changes = {}
+    self.operationmaterials = None
+
+
+  def getOperationMaterials(self, operation):
+    '''
+    Returns the item, type and quantity of all operation materials of an operation.
+    '''
+    if self.operationmaterials is None:
+      self.operationmaterials = {}
+      for i in OperationMaterial.objects.all().using(self.database).values_list('operation', 'item', 'type', 'quantity'):
+        self.operationmaterials.setdefault(i[0], []).append(i[1:])
+    return self.operationmaterials.get(operation, [])
+
+
+  def updateStatus(self, model, ids, status):
+    '''
+    Changes the status of a list of operationplans with a single statement.
+    '''
+    if ids:
+      model.objects.all().using(self.database).filter(id__in=ids).update(
+        status=status, lastmodified=datetime.now()
+        )
+
+
+  def generate_plan(self, strt, nd):
+    '''
+    Generates a constrained plan.
+    '''
+    management.call_command('runplan', database=self.database)
+
 
   def start_bucket(self, strt, nd):
     '''
@@ -404,22 +548,24 @@ class Simulator(object):
       - change the status to "closed"
       - execute all operation materials at the end of the operation
     '''
-    for op in ManufacturingOrder.objects.select_for_update().using(self.database).filter(status="confirmed", enddate__lte=nd, demand__isnull=True):
+    closed = []
+    mos = ManufacturingOrder.objects.all().using(self.database) \
+      .filter(status="confirmed", enddate__lte=nd, demand__isnull=True) \
+      .values_list('id', 'quantity', 'operation', 'operation__location')
+    for id, quantity, operation, location in mos:
       if self.verbosity > 2:
-        print("      Closing MO %s - %d of %s" % (op.id, op.quantity, op.operation.name))
-      op.status = "closed"
-      op.save(using=self.database)
-      for fl in op.operation.operationmaterials.all().using(self.database):
-        if not op.operation.location or not fl.item:
+        print("      Closing MO %s - %d of %s" % (id, quantity, operation))
+      closed.append(id)
+      if not location:
+        continue
+      for item, type, qty in self.getOperationMaterials(operation):
+        if type == 'end':
+          qty *= quantity
+        elif type != 'fixed_end':
           continue
-        elif fl.type == 'end':
-          buf = Buffer.objects.select_for_update().using(self.database).get(item=fl.item, location=op.operation.location)
-          buf.onhand += fl.quantity * op.quantity
-          buf.save(using=self.database)
-        elif fl.type == 'fixed_end':
-          buf = Buffer.objects.select_for_update().using(self.database).get(item=fl.item, location=op.operation.location)
-          buf.onhand += fl.quantity
-          buf.save(using=self.database)
+        if not self.addOnhand(item, location, qty):
+          print("        ERROR: can't find the buffer %s @ %s to close the MO" % (item, location))
+    self.updateStatus(ManufacturingOrder, closed, 'closed')
 
 
   def create_manufacturing_orders(self, strt, nd):
@@ -429,22 +575,24 @@ class Simulator(object):
       - change the status to "confirmed"
       - execute all operation materials at the start of the operation
     '''
-    for op in ManufacturingOrder.objects.select_for_update().using(self.database).filter(status="proposed", startdate__lte=nd, demand__isnull=True):
+    confirmed = []
+    mos = ManufacturingOrder.objects.all().using(self.database) \
+      .filter(status="proposed", startdate__lte=nd, demand__isnull=True) \
+      .values_list('id', 'quantity', 'operation', 'operation__location')
+    for id, quantity, operation, location in mos:
       if self.verbosity > 2:
-        print("      Opening MO %s - %d of %s" % (op.id, op.quantity, op.operation.name))
-      for fl in op.operation.operationmaterials.all().using(self.database):
-        if not op.operation.location or not fl.item:
+        print("      Opening MO %s - %d of %s" % (id, quantity, operation))
+      confirmed.append(id)
+      if not location:
+        continue
+      for item, type, qty in self.getOperationMaterials(operation):
+        if type == 'start':
+          qty *= quantity
+        elif type != 'fixed_start':
           continue
-        elif fl.type == 'start':
-          buf = Buffer.objects.select_for_update().using(self.database).get(item=fl.item, location=op.operation.location)
-          buf.onhand += fl.quantity * op.quantity
-          buf.save(using=self.database)
-        elif fl.type == 'fixed_start':
-          buf = Buffer.objects.select_for_update().using(self.database).get(item=fl.item, location=op.operation.location)
-          buf.onhand += fl.quantity
-          buf.save(using=self.database)
-      op.status = 'confirmed'
-      op.save(using=self.database)
+        if not self.addOnhand(item, location, qty):
+          print("        ERROR: can't find the buffer %s @ %s to open the MO" % (item, location))
+    self.updateStatus(ManufacturingOrder, confirmed, 'confirmed')
 
 
   def receive_purchase_orders(self, strt, nd):
@@ -454,17 +602,18 @@ class Simulator(object):
       - change the status to "closed"
       - add the received quantity into the onhand of the buffer
     '''
-    for po in PurchaseOrder.objects.select_for_update().using(self.database).filter(status="confirmed", enddate__lte=nd):
+    closed = []
+    pos = PurchaseOrder.objects.all().using(self.database) \
+      .filter(status="confirmed", enddate__lte=nd) \
+      .values_list('id', 'item', 'location', 'quantity')
+    for id, item, location, quantity in pos:
       if self.verbosity > 2:
-        print("      Closing PO %s - %d of %s@%s" % (po.id, po.quantity, po.item.name, po.location.name))
-      try:
-        buf = Buffer.objects.select_for_update().using(self.database).get(item=po.item, location=po.location)
-        buf.onhand += po.quantity
-        buf.save(using=self.database)
-        po.status = 'closed'
-        po.save(using=self.database)
-      except Buffer.DoesNotExist:
+        print("      Closing PO %s - %d of %s@%s" % (id, quantity, item, location))
+      if self.addOnhand(item, location, quantity):
+        closed.append(id)
+      else:
         print("        ERROR: can't find the buffer to receive the PO")
+    self.updateStatus(PurchaseOrder, closed, 'closed')
 
 
   def create_purchase_orders(self, strt, nd):
@@ -473,11 +622,11 @@ class Simulator(object):
     For each of these purchase orders:
       - change the status to "confirmed"
     '''
-    for po in PurchaseOrder.objects.select_for_update().using(self.database).filter(status="proposed", startdate__lte=nd):
-      if self.verbosity > 2:
-        print("      Opening PO %s - %d of %s@%s" % (po.id, po.quantity, po.item.name, po.location.name))
-      po.status = 'confirmed'
-      po.save(using=self.database)
+    pos = PurchaseOrder.objects.all().using(self.database).filter(status="proposed", startdate__lte=nd)
+    if self.verbosity > 2:
+      for id, item, location, quantity in pos.values_list('id', 'item', 'location', 'quantity'):
+        print("      Opening PO %s - %d of %s@%s" % (id, quantity, item, location))
+    pos.update(status='confirmed', lastmodified=datetime.now())
 
 
   def create_distribution_orders(self, strt, nd):
@@ -487,17 +636,18 @@ class Simulator(object):
       - change the status to "confirmed"
       - consume the material from the source location
     '''
-    for do in DistributionOrder.objects.select_for_update().using(self.database).filter(status="proposed", startdate__lte=nd):
+    confirmed = []
+    dos = DistributionOrder.objects.all().using(self.database) \
+      .filter(status="proposed", startdate__lte=nd) \
+      .values_list('id', 'item', 'origin', 'destination', 'quantity')
+    for id, item, origin, destination, quantity in dos:
       if self.verbosity > 2:
-        print("      Opening DO %s - %d from %s@%s to %s@%s" % (do.id, do.quantity, do.item.name, do.origin.name, do.item.name, do.destination.name))
-      try:
-        buf = Buffer.objects.select_for_update().using(self.database).get(item=do.item, location=do.origin)
-        buf.onhand -= do.quantity
-        buf.save(using=self.database)
-        do.status = 'confirmed'
-        do.save(using=self.database)
-      except Buffer.DoesNotExist:
+        print("      Opening DO %s - %d from %s@%s to %s@%s" % (id, quantity, item, origin, item, destination))
+      if self.addOnhand(item, origin, -quantity):
+        confirmed.append(id)
+      else:
         print("        ERROR: can't find the buffer to create the DO")
+    self.updateStatus(DistributionOrder, confirmed, 'confirmed')
 
 
   def receive_distribution_orders(self, strt, nd):
@@ -507,17 +657,18 @@ class Simulator(object):
       - change the status to "closed"
       - add the received quantity into the onhand of the buffer
     '''
-    for do in DistributionOrder.objects.select_for_update().using(self.database).filter(status="confirmed", enddate__lte=nd):
+    closed = []
+    dos = DistributionOrder.objects.all().using(self.database) \
+      .filter(status="confirmed", enddate__lte=nd) \
+      .values_list('id', 'item', 'destination', 'quantity')
+    for id, item, destination, quantity in dos:
       if self.verbosity > 2:
-        print("      Closing DO %s - %d of %s@%s" % (do.id, do.quantity, do.item.name, do.destination.name))
-      try:
-        buf = Buffer.objects.select_for_update().using(self.database).get(item=do.item, location=do.destination)
-        buf.onhand += do.quantity
-        buf.save(using=self.database)
-        do.status = 'closed'
-        do.save(using=self.database)
-      except Buffer.DoesNotExist:
+        print("      Closing DO %s - %d of %s@%s" % (id, quantity, item, destination))
+      if self.addOnhand(item, destination, quantity):
+        closed.append(id)
+      else:
         print("        ERROR: can't find the buffer to receive the DO")
+    self.updateStatus(DistributionOrder, closed, 'closed')
 
 
   def generate_customer_demand(self, strt, nd):
@@ -552,24 +703,28 @@ class Simulator(object):
     '''
     Verify whether an operationplan of a given quantity is material-feasible.
     '''
-    for fl in oper.operationmaterials.all().using(self.database):
-      if fl.quantity > 0 and not consume:
+    for item, type, quantity in self.getOperationMaterials(oper.name):
+      if quantity > 0 and not consume:
         continue
-      if not fl.item or not oper.location:
+      if not item or not oper.location_id:
         continue
-      buf = Buffer.objects.using(self.database).get(item=fl.item, location=oper.location)
-      if fl.type in ('start', 'end') or not fl.type:
+      onhand = self.getOnhand(item, oper.location_id)
+      if onhand is None:
         if consume:
-          buf.onhand += qty * fl.quantity
-          buf.save(using=self.database)
-        elif buf.onhand < - fl.quantity * min_qty:
+          continue
+        # A missing buffer can't supply anything
+        return 0
+      if type in ('start', 'end') or not type:
+        if consume:
+          self.addOnhand(item, oper.location_id, qty * quantity)
+        elif onhand < - quantity * min_qty:
           # Even the minimum isn't available
           return 0
         else:
           if qty > min_qty:
-            ship_qty = min(- buf.onhand / fl.quantity, qty - min_qty)
+            ship_qty = min(- onhand / quantity, qty - min_qty)
           else:
-            ship_qty = - buf.onhand / fl.quantity
+            ship_qty = - onhand / quantity
           if ship_qty < min_qty:
             # Remaining open quantity after an ok would be less than the minimum
             return 0
@@ -579,18 +734,17 @@ class Simulator(object):
           else:
             # Partial satisfying is possible
             qty = ship_qty
-      if fl.type in ('fixed_start', 'fixed_end'):
+      if type in ('fixed_start', 'fixed_end'):
         if consume:
-          buf.onhand += qty
-          buf.save(using=self.database)
-        elif buf.onhand < - min_qty:
+          self.addOnhand(item, oper.location_id, qty)
+        elif onhand < - min_qty:
           # Even the minimum isn't available
           return 0
         else:
           if qty > min_qty:
-            ship_qty = min(- buf.onhand, qty - min_qty)
+            ship_qty = min(- onhand, qty - min_qty)
           else:
-            ship_qty = - buf.onhand
+            ship_qty = - onhand
           if ship_qty < min_qty:
             # Remaining open quantity after an ok would be less than the minimum
             return 0
@@ -656,7 +810,7 @@ class Simulator(object):
           - reduce the quantity of the demand
           - reduce the inventory of the product
     '''
-    for dmd in Demand.objects.using(self.database).filter(due__lt=nd, status='open').order_by('priority', 'due'):
+    for dmd in Demand.objects.using(self.database).filter(due__lt=nd, status='open').select_related('operation').order_by('priority', 'due'):
       oper = dmd.operation
       if oper:
         # Case 1: Delivery operation specified
@@ -676,24 +830,22 @@ class Simulator(object):
           continue
       else:
         # Case 2: Automatically generated delivery operation
-        try:
-          buf = Buffer.objects.select_for_update().using(self.database).get(item=dmd.item, location=dmd.location)
-        except Buffer.DoesNotExist:
+        onhand = self.getOnhand(dmd.item_id, dmd.location_id)
+        if onhand is None:
           self.checkDemandExpired(dmd, nd)
           continue
-        if buf.onhand < (dmd.minshipment or 0):
+        if onhand < (dmd.minshipment or 0):
           # Not sufficient to ship something
           self.checkDemandExpired(dmd, nd)
           continue
-        elif buf.onhand >=  dmd.quantity:
+        elif onhand >= dmd.quantity:
           # Shipping the complete remaining quantity
-          buf.onhand -= dmd.quantity
-          buf.save(using=self.database)
+          self.addOnhand(dmd.item_id, dmd.location_id, -dmd.quantity)
         else:
           if dmd.quantity > (dmd.minshipment or 0):
-            ship_qty = min(buf.onhand, dmd.quantity - (dmd.minshipment or 0))
+            ship_qty = min(onhand, dmd.quantity - (dmd.minshipment or 0))
           else:
-            ship_qty = buf.onhand
+            ship_qty = onhand
           if ship_qty <= (dmd.minshipment or 0):
             # Remaining open quantity after a partial shipment would be less than the minimum shipment
             self.checkDemandExpired(dmd, nd)
@@ -702,8 +854,7 @@ class Simulator(object):
             # Partial shipment is possible
             dmd.quantity -= ship_qty
             dmd.save(using=self.database)
-            buf.onhand -= ship_qty
-            buf.save(using=self.database)
+            self.addOnhand(dmd.item_id, dmd.location_id, -ship_qty)
             if self.verbosity > 2:
               print("      Partially shipping demand %s - %d of %s@%s due on %s - delay %s" % (
                 dmd.name, dmd.quantity, dmd.item.name,
@@ -779,3 +930,8 @@ class Simulator(object):
       self.inventory_quantity/self.buckets, self.inventory_value/self.buckets
       ))
     print("   Average work in progress: %.2f units" % (self.wip_quantity/self.buckets))
+    print("   Execution time per step:")
+    for step, duration in sorted(self.timings.items(), key=lambda i: -i[1]):
+      print("     %s: %.2f seconds, %.3f seconds per bucket" % (
+        step, duration, duration / self.buckets
+        ))
@@ -0,0 +1,50 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('execute', '0006_export_inventorybuckets'),
+  ]
+
+  operations = [
+    migrations.CreateModel(
+      name='TaskStep',
+      fields=[
+        ('id', models.AutoField(editable=False, primary_key=True, serialize=False, verbose_name='identifier')),
+        ('sequence', models.FloatField(editable=False, verbose_name='sequence')),
+        ('description', models.CharField(editable=False, max_length=300, verbose_name='description')),
+        ('weight', models.FloatField(editable=False, null=True, verbose_name='weight')),
+        ('started', models.DateTimeField(editable=False, verbose_name='started')),
+        ('wallclock', models.FloatField(editable=False, help_text='Seconds', verbose_name='wall clock time')),
+        ('cputime', models.FloatField(editable=False, help_text='Seconds', null=True, verbose_name='cpu time')),
+        ('memory', models.FloatField(editable=False, help_text='MB', null=True, verbose_name='peak memory')),
+        ('rows', models.IntegerField(editable=False, null=True, verbose_name='rows')),
+        ('task', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='steps', to='execute.Task', verbose_name='task')),
+      ],
+      options={
+        'db_table': 'execute_taskstep',
+        'verbose_name': 'task step',
+        'verbose_name_plural': 'task steps',
+        'ordering': ['task', 'id'],
+      },
+    ),
+  ]
@@ -14,7 +14,12 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from django.db import models
+import sys
+from time import time
+
+from django.db import models, connections
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
 from freppledb.common.models import User
@@ -22,6 +27,9 @@ from freppledb.common.models import User
 import logging
 logger = logging.getLogger(__name__)
 
+# PostgreSQL channel on which new tasks are notified to the worker
+TASK_CHANNEL = 'frepple_task'
+
 
 class Task(models.Model):
   '''
@@ -58,8 +66,87 @@ class Task(models.Model):
     verbose_name_plural = _('tasks')
     verbose_name = _('task')
 
+  # Minimum number of seconds between 2 progress updates of a task
+  progressinterval = 5
+
   @staticmethod
   def submitTask():
     # Add record to the database
     # Check if a worker is present. If not launch one.
     return 1
+
+  def setProgress(self, status=None, message=None, using=None, force=False):
+    '''
+    Updates the status and message of a running task.
+
+    The database is updated at most once every progressinterval seconds,
+    unless the force argument is passed. Only the status and message fields
+    are written.
+    '''
+    if status is not None:
+      self.status = status
+    if message is not None:
+      self.message = message
+    now = time()
+    if not force and now - getattr(self, '_progresssaved', 0) < self.progressinterval:
+      return False
+    self._progresssaved = now
+    if self.pk:
+      self.save(using=using, update_fields=['status', 'message'])
+    else:
+      self.save(using=using)
+    return True
+
+
+class TaskStep(models.Model):
+  '''
+  Profile of a step executed by a task: wall clock time, cpu time, peak
+  memory of the process and number of processed records.
+  '''
+  # Database fields
+  id = models.AutoField(_('identifier'), primary_key=True, editable=False)
+  task = models.ForeignKey(
+    Task, verbose_name=_('task'), related_name='steps',
+    editable=False, on_delete=models.CASCADE
+    )
+  sequence = models.FloatField(_('sequence'), editable=False)
+  #. Translators: Translation included with Django
+  description = models.CharField(_('description'), max_length=300, editable=False)
+  weight = models.FloatField(_('weight'), null=True, editable=False)
+  started = models.DateTimeField(_('started'), editable=False)
+  wallclock = models.FloatField(_('wall clock time'), editable=False, help_text=_('Seconds'))
+  cputime = models.FloatField(_('cpu time'), null=True, editable=False, help_text=_('Seconds'))
+  memory = models.FloatField(_('peak memory'), null=True, editable=False, help_text=_('MB'))
+  rows = models.IntegerField(_('rows'), null=True, editable=False)
+
+  def __str__(self):
+    return "%s - %s - %s" % (self.task_id, self.sequence, self.description)
+
+  class Meta:
+    db_table = "execute_taskstep"
+    verbose_name_plural = _('task steps')
+    verbose_name = _('task step')
+    ordering = ['task', 'id']
+
+  @staticmethod
+  def getPeakMemory():
+    '''
+    Returns the peak resident memory of the process in MB, or None when
+    the platform doesn't report it.
+    '''
+    try:
+      import resource
+      peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      # Linux reports kilobytes, macOS reports bytes
+      return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+    except (ImportError, AttributeError):
+      return None
+
+
+@receiver(post_save, sender=Task)
+def notifyWorker(sender, instance, using, **kwargs):
+  # Wake up the worker of the database when a task is queued.
+  # The notification is delivered when the transaction commits.
+  if instance.status == 'Waiting':
+    with connections[using].cursor() as cursor:
+      cursor.execute("notify %s" % TASK_CHANNEL)
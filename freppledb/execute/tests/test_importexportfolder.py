@@ -46,6 +46,36 @@ class execute_with_commands(TransactionTestCase):
 
 
   def test_exportimportfromfolder(self):
+    self.exportimport()
+
+
+  def test_exportimportfromfolder_bulk(self):
+    self.exportimport(mode='bulk')
+
+
+  def test_exportimportfromfolder_parallel(self):
+    self.exportimport(jobs=3)
+
+
+  def test_importfromfolder_parallel_proxies(self):
+    # Order files of the same table get their identifiers from the highest
+    # identifier in the table, and can't be loaded at the same time
+    countMO = ManufacturingOrder.objects.count()
+    countPO = PurchaseOrder.objects.count()
+    with open(os.path.join(self.datafolder, 'purchaseorder.csv'), 'w') as f:
+      f.write('item,location,supplier,quantity,startdate,enddate,status\n')
+      for i in range(50):
+        f.write('box,factory 1,Cardboard manfacturer,%s,2020-01-01 00:00:00,2020-01-02 00:00:00,confirmed\n' % (i + 1))
+    with open(os.path.join(self.datafolder, 'manufacturingorder.csv'), 'w') as f:
+      f.write('operation,quantity,startdate,enddate,status\n')
+      for i in range(50):
+        f.write('Make fabric @ factory 1,%s,2020-01-01 00:00:00,2020-01-02 00:00:00,confirmed\n' % (i + 1))
+    management.call_command('importfromfolder', jobs=2)
+    self.assertEqual(PurchaseOrder.objects.count(), countPO + 50)
+    self.assertEqual(ManufacturingOrder.objects.count(), countMO + 50)
+
+
+  def exportimport(self, **options):
     self.assertTrue(ManufacturingOrder.objects.count() > 30)
     self.assertTrue(PurchaseOrder.objects.count() > 20)
     self.assertTrue(DistributionOrder.objects.count() > 0)
@@ -72,7 +102,7 @@ class execute_with_commands(TransactionTestCase):
         os.path.join(self.datafolder, file)
         )
 
-    management.call_command('importfromfolder')
+    management.call_command('importfromfolder', **options)
 
     self.assertEqual(DistributionOrder.objects.count(), countDO)
     self.assertEqual(PurchaseOrder.objects.count(), countPO)
@@ -22,14 +22,17 @@ from time import sleep
 
 from django.conf import settings
 from django.core import management
+from django.core.management.base import CommandError
 from django.db import DEFAULT_DB_ALIAS, transaction
 from django.db.models import Sum, Count, Q
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
 
 import freppledb.output as output
 import freppledb.input as input
 import freppledb.common as common
 from freppledb.common.models import Parameter, User
+from freppledb.execute.models import Task, TaskStep
+from freppledb.execute.management.commands.scenario_sweep import Command as ScenarioSweep
 
 
 class execute_with_commands(TransactionTestCase):
@@ -72,6 +75,11 @@ class execute_with_commands(TransactionTestCase):
     self.assertTrue(input.models.OperationPlanResource.objects.count() > 20)
     self.assertTrue(input.models.OperationPlan.objects.count() > 300)
 
+    # Every step of the plan is profiled
+    task = Task.objects.filter(name='runplan').order_by('-id')[0]
+    self.assertTrue(TaskStep.objects.filter(task=task).count() > 10)
+    self.assertTrue(TaskStep.objects.filter(task=task, description='Importing locations', rows__gt=0).exists())
+
 
 class execute_multidb(TransactionTestCase):
 
@@ -205,6 +213,78 @@ class execute_simulation(TransactionTestCase):
       )
     # TODO add comparison with initial_planned_late
 
+  def getSimulationResult(self):
+    return (
+      list(input.models.Demand.objects.all().order_by('name').values_list('name', 'status')),
+      list(
+        input.models.OperationPlan.objects.all()
+        .values('type', 'status').annotate(count=Count('id'), quantity=Sum('quantity'))
+        .order_by('type', 'status')
+        )
+      )
+
+  def test_run_inprocess(self):
+    # Simulate with a new plan in every bucket
+    management.call_command('runplan', plantype=1, constraint=15, env='supply')
+    management.call_command('simulation', step=7, horizon=30, verbosity=0)
+    expected = self.getSimulationResult()
+
+    # Simulate again from the same data, with the model kept in memory
+    management.call_command('flush', interactive=False, verbosity=0)
+    management.call_command('loaddata', 'demo', verbosity=0)
+    self.setUp()
+    management.call_command('runplan', plantype=1, constraint=15, env='supply')
+    management.call_command('simulation', step=7, horizon=30, verbosity=0, inprocess=True)
+    self.assertEqual(self.getSimulationResult(), expected)
+
+    # The simulation settings don't leak into later plans of this process
+    self.assertFalse([ i for i in os.environ if i.startswith('simulation') ])
+
+
+class scenario_sweep(SimpleTestCase):
+
+  def test_variants(self):
+    # A dictionary is expanded into all combinations of its values
+    self.assertEqual(
+      ScenarioSweep.getVariants('{"plantype": [1, 2], "constraint": [13, 15], "plan.autoFenceOperations": 7}'),
+      [
+        {'constraint': 13, 'plan.autoFenceOperations': 7, 'plantype': 1},
+        {'constraint': 13, 'plan.autoFenceOperations': 7, 'plantype': 2},
+        {'constraint': 15, 'plan.autoFenceOperations': 7, 'plantype': 1},
+        {'constraint': 15, 'plan.autoFenceOperations': 7, 'plantype': 2},
+      ])
+    # A list is used as it is
+    self.assertEqual(
+      ScenarioSweep.getVariants('[{"plantype": 1}, {"plantype": 2}]'),
+      [{'plantype': 1}, {'plantype': 2}]
+      )
+    for grid in ('{"plantype": [1', '3', '[]', '[1, 2]'):
+      with self.assertRaises(CommandError):
+        ScenarioSweep.getVariants(grid)
+
+  def test_table(self):
+    results = [
+      (1, 'scenario2', None, [('demand', 'late', 3), ('inventory', 'value', 20)], 5),
+      (0, 'scenario1', None, [('demand', 'late', 1)], 4),
+      (2, 'scenario3', 'failed', [], 1),
+      ]
+    self.assertEqual(
+      ScenarioSweep.getTable([{}, {}, {}], results),
+      [
+        ['category', 'name', 'variant 1', 'variant 2', 'variant 3'],
+        ['demand', 'late', 1, 3, ''],
+        ['inventory', 'value', '', 20, ''],
+      ])
+
+  @override_settings(MAXMEMORYSIZE=10 ** 9)
+  def test_workers(self):
+    # The memory limit also caps an explicit number of workers
+    self.assertEqual(ScenarioSweep.getWorkers(4, ['scenario1', 'scenario2']), 1)
+
+  @override_settings(MAXMEMORYSIZE=None)
+  def test_workers_scenarios(self):
+    self.assertEqual(ScenarioSweep.getWorkers(4, ['scenario1', 'scenario2']), 2)
+
 
 class remote_commands(TransactionTestCase):
 
@@ -505,7 +505,7 @@ class FileManager:
       # File upload folder
       return (
         settings.DATABASES[request.database]['FILEUPLOADFOLDER'],
-        ('.xlsx', '.csv', '.csv.gz')
+        ('.xlsx', '.csv', '.csv.gz', '.csv.zst')
         )
     elif foldercode == '1':
       # Export folder
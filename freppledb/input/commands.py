@@ -62,6 +62,21 @@ class LoadTask(PlanTask):
 
   filter = None
 
+  @classmethod
+  def runChanged(cls, database, table, since):
+    '''
+    Loads only the records of a table changed since a certain date, eg to
+    synchronize a model kept in memory with the database.
+    '''
+    previous = cls.filter
+    cls.filter = "%s.lastmodified >= '%s'" % (table, since)
+    if previous:
+      cls.filter += " and (%s)" % previous
+    try:
+      return cls.run(database=database)
+    finally:
+      cls.filter = previous
+
 
 @PlanTaskRegistry.register
 class checkBuckets(CheckTask):
@@ -303,6 +318,7 @@ class loadLocations(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d locations in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -339,6 +355,7 @@ class loadCalendars(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d calendars in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -411,6 +428,7 @@ class loadCalendarBuckets(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d calendar buckets in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -445,6 +463,7 @@ class loadCustomers(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d customers in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -479,6 +498,7 @@ class loadSuppliers(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d suppliers in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -624,6 +644,7 @@ class loadOperations(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d operations in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -672,6 +693,7 @@ class loadSuboperations(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d suboperations in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -718,6 +740,7 @@ class loadItems(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d items in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -784,6 +807,7 @@ class loadItemSuppliers(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d item suppliers in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -850,6 +874,7 @@ class loadItemDistributions(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d item distributions in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -901,6 +926,7 @@ class loadBuffers(LoadTask):
         if i[6]:
           b.minimum_calendar = frepple.calendar(name=i[6])
       logger.info('Loaded %d buffers in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -933,6 +959,7 @@ class loadSetupMatrices(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d setup matrices in %.2f seconds' % (cnt, time() - starttime))
+      matrices = cnt
 
     with connections[database].chunked_cursor() as cursor:
       cnt = 0
@@ -958,6 +985,7 @@ class loadSetupMatrices(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d setup matrix rules in %.2f seconds' % (cnt, time() - starttime))
+      return matrices + cnt
 
 
 @PlanTaskRegistry.register
@@ -1037,6 +1065,7 @@ class loadResources(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d resources in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -1077,6 +1106,7 @@ class loadResourceSkills(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d resource skills in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -1132,6 +1162,7 @@ class loadOperationMaterials(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d operation materials in %.2f seconds' % (cnt, time() - starttime))
+      loaded = cnt
 
       # Check for operations where:
       #  - operation.item is still blank
@@ -1156,6 +1187,7 @@ class loadOperationMaterials(LoadTask):
           cnt += 1
           oper.item = item
       logger.info('Auto-update of %s operation items in %.2f seconds' % (cnt, time() - starttime))
+      return loaded
 
 
 @PlanTaskRegistry.register
@@ -1213,6 +1245,7 @@ class loadOperationResources(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d resource loads in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -1264,6 +1297,7 @@ class loadDemand(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d demands in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -1434,6 +1468,7 @@ class loadOperationPlans(LoadTask):
         ''')
       d = cursor.fetchone()
       frepple.settings.id = d[0]
+    return cnt_mo + cnt_po + cnt_do + cnt_dlvr
 
 
 @PlanTaskRegistry.register
@@ -1472,6 +1507,7 @@ class loadOperationPlanMaterials(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d operationplanmaterials in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
@@ -1505,6 +1541,7 @@ class loadOperationPlanResources(LoadTask):
         except Exception as e:
           logger.error("**** %s ****" % e)
       logger.info('Loaded %d operationplanresources in %.2f seconds' % (cnt, time() - starttime))
+      return cnt
 
 
 @PlanTaskRegistry.register
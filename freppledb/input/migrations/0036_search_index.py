@@ -0,0 +1,63 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, transaction
+
+
+# Tables searched by name in the search box
+searchtables = (
+  'calendar', 'location', 'customer', 'item', 'operation', 'buffer',
+  'setupmatrix', 'resource', 'skill', 'supplier', 'demand'
+  )
+
+
+def createSearchIndexes(apps, schema_editor):
+  '''
+  Trigram indexes allow the search box to find a substring of a name
+  without scanning the complete table.
+  Creating the pg_trgm extension requires sufficient privileges. Without
+  it the search box keeps working, but without index.
+  '''
+  with schema_editor.connection.cursor() as cursor:
+    try:
+      with transaction.atomic(using=schema_editor.connection.alias):
+        cursor.execute("create extension if not exists pg_trgm")
+    except Exception:
+      print("\n  Warning: pg_trgm extension not available: search box not indexed")
+      return
+    for table in searchtables:
+      cursor.execute(
+        "create index if not exists %s_name_trgm on %s using gin (name gin_trgm_ops)"
+        % (table, table)
+        )
+
+
+def dropSearchIndexes(apps, schema_editor):
+  with schema_editor.connection.cursor() as cursor:
+    for table in searchtables:
+      cursor.execute("drop index if exists %s_name_trgm" % table)
+
+
+class Migration(migrations.Migration):
+
+  dependencies = [
+    ('input', '0035_parameter_wip'),
+  ]
+
+  operations = [
+    migrations.RunPython(createSearchIndexes, dropSearchIndexes),
+  ]
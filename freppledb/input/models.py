@@ -400,10 +400,8 @@ class Buffer(AuditModel):
   def __str__(self):
     return self.name
 
-  def save(self, *args, **kwargs):
+  def presave(self):
     self.name = "%s @ %s" % (self.item.name if self.item else "NULL", self.location.name if self.location else "NULL")
-    # Call the real save() method
-    super(Buffer, self).save(*args, **kwargs)
 
   class Meta(AuditModel.Meta):
     db_table = 'buffer'
@@ -1334,10 +1332,9 @@ class DistributionOrder(OperationPlan):
 
   objects = DistributionOrderManager()
 
-  def save(self, *args, **kwargs):
+  def presave(self):
     self.type = 'DO'
     self.operation = self.owner = self.location = self.supplier = None
-    super(DistributionOrder, self).save(*args, **kwargs)
 
   class Meta:
     proxy = True
@@ -1360,10 +1357,9 @@ class PurchaseOrder(OperationPlan):
 
   objects = PurchaseOrderManager()
 
-  def save(self, *args, **kwargs):
+  def presave(self):
     self.type = 'PO'
     self.operation = self.owner = self.origin = self.destination = None
-    super(PurchaseOrder, self).save(*args, **kwargs)
 
   class Meta:
     proxy = True
@@ -1383,13 +1379,14 @@ class ManufacturingOrder(OperationPlan):
 
   objects = ManufacturingOrderManager()
 
-  def save(self, *args, **kwargs):
+  presaveRelated = {'operation': ('item', 'location')}
+
+  def presave(self):
     self.type = 'MO'
     self.supplier = self.origin = self.destination = None
     if self.operation:
       self.item = self.operation.item
       self.location = self.operation.location
-    super(ManufacturingOrder, self).save(*args, **kwargs)
 
   class Meta:
     proxy = True
@@ -1409,13 +1406,14 @@ class DeliveryOrder(OperationPlan):
 
   objects = DeliveryOrderManager()
 
-  def save(self, *args, **kwargs):
+  presaveRelated = {'demand': ('item', 'location')}
+
+  def presave(self):
     self.type = 'DLVR'
     self.supplier = self.origin = self.destination = self.operation = self.owner = None
     if self.demand:
       self.item = self.demand.item
       self.location = self.demand.location
-    super(DeliveryOrder, self).save(*args, **kwargs)
 
   class Meta:
     proxy = True
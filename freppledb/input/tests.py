@@ -14,11 +14,15 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import json
+from logging import ERROR
 import tempfile
 
 from django.test import TestCase
 
-from freppledb.input.models import Location
+from freppledb.common.dataload import parseCSVdata
+from freppledb.common.models import User
+from freppledb.input.models import Buffer, Demand, Item, ItemSupplier, Location, OperationPlan, Supplier
 
 
 class DataLoadTest(TestCase):
@@ -57,6 +61,93 @@ class DataLoadTest(TestCase):
     response = self.client.get('/data/input/suboperation/?format=json')
     self.assertContains(response, '"records":4,')
 
+  def test_search(self):
+    response = self.client.get('/search/?term=factory')
+    self.assertEqual(response.status_code, 200)
+    result = json.loads(response.content.decode())
+    self.assertIn({'value': None, 'label': 'Location - 2 matches'}, result)
+    self.assertIn({'url': '/detail/input/location/', 'value': 'factory 1'}, result)
+    # Short terms only match the start of a name
+    response = self.client.get('/search/?term=ct')
+    self.assertNotIn('factory 1', [ i['value'] for i in json.loads(response.content.decode()) ])
+
+  def test_operationplan_update(self):
+    opplans = list(OperationPlan.objects.filter(type='MO').order_by('id')[:2])
+    response = self.client.post(
+      '/operationplan/',
+      json.dumps([
+        {'id': opplans[0].id, 'quantity': 123, 'status': 'approved'},
+        {'id': opplans[1].id, 'reference': 'updated'},
+        {'id': 999999999, 'quantity': 1}
+        ]),
+      content_type='application/json',
+      HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+      )
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(
+      [ i['status'] for i in json.loads(response.content.decode()) ],
+      ['OK', 'OK', 'error']
+      )
+    opplan = OperationPlan.objects.get(id=opplans[0].id)
+    self.assertEqual((float(opplan.quantity), opplan.status), (123.0, 'approved'))
+    self.assertEqual(OperationPlan.objects.get(id=opplans[1].id).reference, 'updated')
+
+  def test_supplypath(self):
+    response = self.client.get('/supplypath/item/fabric/?format=json')
+    self.assertContains(response, 'Make fabric @ factory 1')
+    self.assertContains(response, 'Purchase thread @ factory 1 from Raw material supplier')
+    self.assertNotContains(response, 'Purchase fabric')
+    # Saving a record refreshes the cached supply network
+    ItemSupplier(
+      item=Item.objects.get(name='fabric'),
+      supplier=Supplier.objects.get(name='Raw material supplier')
+      ).save()
+    response = self.client.get('/supplypath/item/fabric/?format=json')
+    self.assertContains(response, 'Purchase fabric @ factory 1 from Raw material supplier')
+    response = self.client.get('/whereused/item/ink/?format=json')
+    self.assertContains(response, 'Make fabric @ factory 1')
+
+  def test_pagination(self):
+    User.objects.filter(username='admin').update(pagesize=5)
+    expected = list(Demand.objects.order_by('name').values_list('name', flat=True))
+    self.assertEqual(len(expected), 14)
+    # Scrolling through the pages uses the last record of the previous page
+    scrolled = []
+    lastkey = ''
+    for page in range(1, 4):
+      response = self.client.get('/data/input/demand/', {'format': 'json', 'page': page, 'lastkey': lastkey})
+      self.assertContains(response, '"records":14,')
+      data = json.loads(response.content.decode())
+      scrolled.extend([ i['name'] for i in data['rows'][:5] ])
+      lastkey = json.dumps(data.get('lastkey', ''))
+    self.assertEqual(scrolled, expected)
+    # A record deleted between two page requests doesn't shift the next page
+    response = self.client.get('/data/input/demand/?format=json&page=1')
+    lastkey = json.dumps(json.loads(response.content.decode())['lastkey'])
+    Demand.objects.filter(name=expected[2]).delete()
+    response = self.client.get('/data/input/demand/', {'format': 'json', 'page': 2, 'lastkey': lastkey})
+    self.assertEqual(
+      [ i['name'] for i in json.loads(response.content.decode())['rows'][:5] ],
+      expected[5:10]
+      )
+    # The key of another sort order is ignored
+    response = self.client.get('/data/input/demand/', {'format': 'json', 'page': 2, 'lastkey': lastkey, 'sidx': 'name', 'sord': 'desc'})
+    self.assertEqual(
+      [ i['name'] for i in json.loads(response.content.decode())['rows'][:5] ],
+      [ i for i in reversed(expected) if i != expected[2] ][5:10]
+      )
+    expected.remove(expected[2])
+    # Jumping to a page gives the same result
+    response = self.client.get('/data/input/demand/?format=json&page=3&sord=desc&sidx=name')
+    self.assertEqual(
+      [ i['name'] for i in json.loads(response.content.decode())['rows'] ],
+      list(reversed(expected))[10:]
+      )
+    # The exact count can be requested, bypassing the cached count
+    Demand.objects.filter(name=expected[0]).delete()
+    response = self.client.get('/data/input/demand/?format=json&exactcount=1')
+    self.assertContains(response, '"records":12,')
+
   def test_csv_upload(self):
     self.assertEqual(
       [(i.name, i.category or u'') for i in Location.objects.all()],
@@ -78,3 +169,79 @@ class DataLoadTest(TestCase):
       [(i.name, i.category or u'') for i in Location.objects.order_by('name')],
       [(u'All locations', u''), (u'factory 1', u''), (u'factory 2', u''), (u'factory 3', u'cat1'), (u'factory 4', u'')]  # Test result is different in Enterprise Edition
       )
+
+  def test_bulk_upload_errors(self):
+    # The buffer name is computed from the item and location, and the second
+    # row clashes with the first one when the batch is saved
+    data = [
+      ['name', 'item', 'location', 'onhand'],
+      ['buffer 1', 'ink', 'factory 2', '5'],
+      ['buffer 2', 'ink', 'factory 2', '6'],
+      ['buffer 3', 'thread', 'factory 2', '7'],
+      ]
+    errors = [
+      i for i in parseCSVdata(Buffer, iter(data), bulk=True)
+      if i[0] == ERROR
+      ]
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(errors[0][1], 3)
+    self.assertEqual(Buffer.objects.get(name='ink @ factory 2').onhand, 5)
+    self.assertEqual(Buffer.objects.get(name='thread @ factory 2').onhand, 7)
+
+
+class HierarchyTest(TestCase):
+
+  def assertHierarchy(self):
+    Location.rebuildHierarchy()
+    nodes = { i.name: i for i in Location.objects.all() }
+    for node in nodes.values():
+      self.assertIsNotNone(node.lft)
+      # The nested intervals must match the chain of owners
+      ancestors = set()
+      parent = node.owner_id
+      while parent:
+        ancestors.add(parent)
+        parent = nodes[parent].owner_id
+      self.assertEqual(len(ancestors), node.lvl)
+      self.assertEqual(
+        ancestors,
+        set(
+          i.name for i in nodes.values()
+          if i.lft < node.lft and i.rght > node.rght
+          )
+        )
+      self.assertEqual(
+        node.rght == node.lft + 1,
+        not any(i.owner_id == node.name for i in nodes.values())
+        )
+
+  def test_incremental(self):
+    root = Location.objects.create(name='root')
+    for i in range(10):
+      Location.objects.create(name='child %s' % i, owner=root)
+      for j in range(10):
+        Location.objects.create(name='child %s-%s' % (i, j), owner_id='child %s' % i)
+    self.assertHierarchy()
+
+    # Add and move a few nodes: the numbering is updated incrementally
+    Location.objects.create(name='child 1-new', owner_id='child 1')
+    Location.objects.create(name='other root')
+    for i in range(3):
+      node = Location.objects.get(name='child 2-%s' % i)
+      node.owner_id = 'child 0'
+      node.save()
+    node = Location.objects.get(name='child 1')
+    node.owner_id = 'other root'
+    node.save()
+    self.assertHierarchy()
+
+    # Changes that don't move a node keep the numbering
+    node = Location.objects.get(name='child 0')
+    lft = node.lft
+    node.description = 'updated'
+    node.save()
+    self.assertEqual(Location.objects.get(name='child 0').lft, lft)
+
+    # Delete a node
+    Location.objects.get(name='child 1-0').delete()
+    self.assertHierarchy()
@@ -15,15 +15,20 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 from datetime import datetime
 import json
+from threading import Lock
+from time import time
 
 from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
-from django.db import connections
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
 from django.db.models import Q
 from django.db.models.expressions import RawSQL
 from django.db.models.fields import CharField
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.http import HttpResponse, Http404
 from django.http.response import StreamingHttpResponse, HttpResponseServerError
 from django.utils.decorators import method_decorator
@@ -54,28 +59,81 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Number of matches shown per model in the search box
+SEARCH_RESULTS = 10
+
+# Above this number of matches, the search box doesn't count any further
+SEARCH_COUNT_LIMIT = 1000
+
+
 @staff_member_required
 def search(request):
-  term = request.GET.get('term').strip()
+  '''
+  Autocomplete of the search box.
+
+  A single SQL statement collects the first matches and a capped count of
+  the matches of all models. The matching uses the trigram indexes created
+  on the primary keys when the pg_trgm extension is available. Short terms
+  only match the start of the keys, which is what the index can handle for
+  them.
+  '''
+  term = request.GET.get('term', '').strip()
   result = []
+  pattern = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+  if len(term) < 3:
+    pattern = "%s%%" % pattern
+  else:
+    pattern = "%%%s%%" % pattern
 
   # Loop over all models in the data_site
   # We are interested in models satisfying these criteria:
   #  - primary key is of type text
   #  - user has change permissions
+  models = []
+  sql = []
+  args = []
+  connection = connections[request.database]
   for cls, admn in data_site._registry.items():
     if request.user.has_perm("%s.view_%s" % (cls._meta.app_label, cls._meta.object_name.lower())) and isinstance(cls._meta.pk, CharField):
-      query = cls.objects.using(request.database).filter(pk__icontains=term).order_by('pk').values_list('pk')
-      count = len(query)
-      if count > 0:
-        result.append( {'value': None, 'label': (ungettext(
-           '%(name)s - %(count)d match',
-           '%(name)s - %(count)d matches', count) % {'name': force_text(cls._meta.verbose_name), 'count': count}).capitalize()
-           })
-        result.extend([ {
-          'url': "/detail/%s/%s/" % (cls._meta.app_label, cls._meta.object_name.lower()),
-          'value': i[0]
-          } for i in query[:10] ])
+      table = connection.ops.quote_name(cls._meta.db_table)
+      pk = connection.ops.quote_name(cls._meta.pk.column)
+      sql.append(
+        "(select %d, %s, null::bigint from %s where %s ilike %%s order by %s limit %d)"
+        % (len(models), pk, table, pk, pk, SEARCH_RESULTS)
+        )
+      sql.append(
+        "(select %d, null, count(*) from (select 1 from %s where %s ilike %%s limit %d) matches)"
+        % (len(models), table, pk, SEARCH_COUNT_LIMIT)
+        )
+      args += [pattern, pattern]
+      models.append(cls)
+
+  # Run the search in a single round trip
+  matches = [ [] for i in models ]
+  counts = [ 0 for i in models ]
+  if term and models:
+    with connection.cursor() as cursor:
+      cursor.execute(" union all ".join(sql), args)
+      for idx, value, count in cursor.fetchall():
+        if count is None:
+          matches[idx].append(value)
+        else:
+          counts[idx] = count
+
+  for idx, cls in enumerate(models):
+    count = counts[idx]
+    if count > 0:
+      if count >= SEARCH_COUNT_LIMIT:
+        label = _('%(name)s - over %(count)d matches') % {'name': force_text(cls._meta.verbose_name), 'count': count}
+      else:
+        label = ungettext(
+          '%(name)s - %(count)d match',
+          '%(name)s - %(count)d matches', count) % {'name': force_text(cls._meta.verbose_name), 'count': count}
+      result.append( {'value': None, 'label': force_text(label).capitalize()} )
+      result.extend([ {
+        'url': "/detail/%s/%s/" % (cls._meta.app_label, cls._meta.object_name.lower()),
+        'value': i
+        } for i in matches[idx] ])
 
   # Construct reply
   return HttpResponse(
@@ -84,6 +142,163 @@ def search(request):
      )
 
 
+class SupplyNetwork:
+  '''
+  In-memory copy of the supply network of a database.
+
+  The supply path and where-used reports walk the network from these
+  dictionaries rather than querying the database at every level of the
+  path.
+
+  The network of a database is cached. The cache entry is dropped when a
+  record of the network is saved or deleted in this process. Changes made
+  by other processes or with plain SQL are picked up by comparing a
+  checksum of the tables, which happens at most once every cacheInterval
+  seconds.
+  '''
+  _cache = {}
+  _cachelock = Lock()
+  cacheInterval = 10
+
+  tables = (
+    'item', 'location', 'buffer', 'operation', 'operationmaterial',
+    'operationresource', 'suboperation', 'itemsupplier', 'itemdistribution',
+    'resource', 'supplier'
+    )
+
+  @classmethod
+  def get(cls, database=DEFAULT_DB_ALIAS):
+    entry = cls._cache.get(database, None)
+    now = time()
+    if entry and now - entry[2] < cls.cacheInterval:
+      return entry[0]
+    with cls._cachelock, connections[database].cursor() as cursor:
+      cursor.execute("select md5(%s)" % " || ';' || ".join([
+        "(select count(*) || ',' || coalesce(max(lastmodified)::text, '') from %s)" % t
+        for t in cls.tables
+        ]))
+      checksum = cursor.fetchone()[0]
+      entry = cls._cache.get(database, None)
+      if not entry or entry[1] != checksum:
+        entry = (cls(database), checksum, now)
+      else:
+        entry = (entry[0], checksum, now)
+      cls._cache[database] = entry
+      return entry[0]
+
+  @classmethod
+  def clearCache(cls, database=None):
+    if database:
+      cls._cache.pop(database, None)
+    else:
+      cls._cache.clear()
+
+  def __init__(self, database):
+    self.locations = {
+      i.name: i for i in Location.objects.using(database).order_by('name')
+      }
+    # Items are only instantiated when needed
+    self.owners = dict(Item.objects.using(database).values_list('name', 'owner'))
+    self.items = {}
+    self.buffers = {}
+    self.buffersByItem = {}
+    for i in Buffer.objects.using(database).select_related('item', 'location'):
+      self.buffers[(i.item_id, i.location_id)] = i
+      self.buffersByItem.setdefault(i.item_id, []).append(i)
+    self.operations = {}
+    self.operationsByItem = {}
+    for i in Operation.objects.using(database).select_related('item', 'location'):
+      self.operations[i.name] = i
+      if i.item_id:
+        self.operationsByItem.setdefault(i.item_id, []).append(i)
+    self.materials = {}
+    self.consumers = {}
+    for i in OperationMaterial.objects.using(database).select_related('item').order_by('id'):
+      i.operation = self.operations[i.operation_id]
+      self.materials.setdefault(i.operation_id, []).append(i)
+      if i.quantity < 0:
+        self.consumers.setdefault(i.item_id, []).append(i)
+    self.loads = {}
+    self.loadsByResource = {}
+    for i in OperationResource.objects.using(database).select_related('resource').order_by('id'):
+      i.operation = self.operations[i.operation_id]
+      self.loads.setdefault(i.operation_id, []).append(i)
+      self.loadsByResource.setdefault(i.resource_id, []).append(i)
+    self.suboperations = {}
+    self.superoperations = {}
+    for i in SubOperation.objects.using(database).order_by('-priority', 'id'):
+      i.operation = self.operations[i.operation_id]
+      i.suboperation = self.operations[i.suboperation_id]
+      self.suboperations.setdefault(i.operation_id, []).append(i)
+      self.superoperations.setdefault(i.suboperation_id, []).append(i)
+    self.itemsuppliers = {}
+    for i in ItemSupplier.objects.using(database).select_related('item', 'location', 'supplier', 'resource').order_by('id'):
+      self.itemsuppliers.setdefault(i.item_id, []).append(i)
+    self.itemdistributions = {}
+    for i in ItemDistribution.objects.using(database).select_related('item', 'location', 'origin', 'resource').order_by('id'):
+      self.itemdistributions.setdefault(i.item_id, []).append(i)
+
+  def getItem(self, name):
+    it = self.items.get(name, None)
+    if not it and name in self.owners:
+      it = Item(name=name, owner_id=self.owners[name])
+      self.items[name] = it
+    return it
+
+  def getLocation(self, name):
+    return self.locations.get(name, None)
+
+  def getBuffer(self, item, location):
+    '''
+    Returns the buffer of an item at a location. If it doesn't exist a
+    buffer record is created in memory, without saving it.
+    '''
+    buf = self.buffers.get((item.name, location.name if location else None), None)
+    if not buf:
+      buf = Buffer(
+        name='%s @ %s' % (item.name, location.name if location else None),
+        item=item, location=location
+        )
+    return buf
+
+  def getAncestors(self, item):
+    '''
+    Returns the name of the item and all its parents in the hierarchy.
+    '''
+    result = []
+    while item and item not in result:
+      result.append(item)
+      item = self.owners.get(item, None)
+    return result
+
+  def select(self, records, item):
+    '''
+    Returns the records of an item or of its parent items.
+    '''
+    for i in self.getAncestors(item):
+      for r in records.get(i, []):
+        yield r
+
+
+def _copyRecord(obj):
+  '''
+  Records shared in the cached supply network are copied before a report
+  assigns a different item or location to them.
+  '''
+  c = copy.copy(obj)
+  c._state = copy.copy(obj._state)
+  if hasattr(obj._state, 'fields_cache'):
+    c._state.fields_cache = dict(obj._state.fields_cache)
+  return c
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def clearSupplyNetwork(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+  if getattr(sender._meta, 'db_table', None) in SupplyNetwork.tables:
+    SupplyNetwork.clearCache(using)
+
+
 class PathReport(GridReport):
   '''
   A report showing the upstream supply path or following downstream a
@@ -156,30 +371,22 @@ class PathReport(GridReport):
   def findDeliveries(reportclass, item, location, db):
     # Automatically detect delivery operations. This is done by looking for
     # a buffer for this item and location combination.
-    buf = None
-    # Find a buffer record
-    for b in Buffer.objects.using(db).filter(item=item, location=location):
-      buf = b
-    if not buf:
-      # Create a buffer record
-      buf = Buffer(
-        name='%s @ %s' % (item, location),
-        item=Item.objects.using(db).get(name=item),
-        location=Location.objects.using(db).get(name=location)
-        )
+    buf = SupplyNetwork.get(db).getBuffer(item, location)
     return reportclass.findReplenishment(buf, db, 0, 1, 0, False)
 
 
   @classmethod
   def findUsage(reportclass, buffer, db, level, curqty, realdepth, pushsuper):
+    network = SupplyNetwork.get(db)
     result = [
       (level - 1, None, i.operation, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
-      for i in buffer.item.operationmaterials.filter(quantity__lt=0).filter(operation__location__name=buffer.location.name).only('operation').using(db)
+      for i in network.consumers.get(buffer.item.name, [])
+      if i.operation.location_id == buffer.location.name
       ]
-    for i in ItemDistribution.objects.using(db).filter(
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft,
-        origin__name=buffer.location.name
-        ):
+    for i in network.select(network.itemdistributions, buffer.item.name):
+      if i.origin_id != buffer.location.name:
+        continue
+      i = _copyRecord(i)
       i.item = buffer.item
       result.append( (level - 1, None, i, curqty, 0, None, realdepth - 1, pushsuper, i.location.name if i.location else None) )
     return result
@@ -193,31 +400,29 @@ class PathReport(GridReport):
     # item supplier models for the item and location combination. (As a special
     # case in case only a single location exists in the model, a match on the
     # item is sufficient).
+    network = SupplyNetwork.get(db)
     result = []
-    if Location.objects.using(db).count() > 1:
+    if len(network.locations) > 1:
       # Multiple locations
-      for i in ItemSupplier.objects.using(db).filter(
-        Q(location__isnull=True) | Q(location__name=buffer.location.name),
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
+      for i in network.select(network.itemsuppliers, buffer.item.name):
+        if i.location_id is None or i.location_id == buffer.location.name:
+          i = _copyRecord(i)
           i.item = buffer.item
           i.location = buffer.location
           result.append(
             (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
             )
-      for i in ItemDistribution.objects.using(db).filter(
-        Q(location__isnull=True) | Q(location__name=buffer.location.name),
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
+      for i in network.select(network.itemdistributions, buffer.item.name):
+        if i.location_id is None or i.location_id == buffer.location.name:
+          i = _copyRecord(i)
           i.item = buffer.item
           i.location = buffer.location
           result.append(
             (level, None, i, curqty, 0, None, realdepth, pushsuper, i.location.name if i.location else None)
             )
-      for i in Operation.objects.using(db).filter(
-        Q(location__isnull=True) | Q(location__name=buffer.location.name),
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
+      for i in network.select(network.operationsByItem, buffer.item.name):
+        if i.location_id is None or i.location_id == buffer.location.name:
+          i = _copyRecord(i)
           i.item = buffer.item
           i.location = buffer.location
           result.append(
@@ -225,22 +430,20 @@ class PathReport(GridReport):
             )
     else:
       # Single location
-      for i in ItemSupplier.objects.using(db).filter(
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
+      for i in network.select(network.itemsuppliers, buffer.item.name):
+        i = _copyRecord(i)
+        i.item = buffer.item
+        i.location = buffer.location
+        result.append(
+          (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
+          )
+      for i in network.select(network.operationsByItem, buffer.item.name):
+        i = _copyRecord(i)
         i.item = buffer.item
         i.location = buffer.location
         result.append(
           (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
           )
-      for i in Operation.objects.using(db).filter(
-        item__lft__lte=buffer.item.lft, item__rght__gt=buffer.item.lft
-        ):
-          i.item = buffer.item
-          i.location = buffer.location
-          result.append(
-            (level, None, i, curqty, 0, None, realdepth, pushsuper, buffer.location.name if buffer.location else None)
-            )
     return result
 
 
@@ -249,9 +452,9 @@ class PathReport(GridReport):
     '''
     A function that recurses upstream or downstream in the supply chain.
     '''
-    # Update item and location hierarchies
-    Item.rebuildHierarchy(database=request.database)
-    Location.rebuildHierarchy(database=request.database)
+    # The supply network is read from memory. The item hierarchy is walked
+    # from the owner fields, so it doesn't need to be rebuilt.
+    network = SupplyNetwork.get(request.database)
 
     entity = basequery.query.get_compiler(basequery.db).as_sql(with_col_aliases=False)[1]
     entity = entity[0]
@@ -270,13 +473,13 @@ class PathReport(GridReport):
       curnode = counter
       counter += 1
       if isinstance(location, str):
-        curlocation = Location.objects.all().using(request.database).get(name=location)
+        curlocation = network.getLocation(location)
 
       # If an operation has parent operations we forget about the current operation
       # and use only the parent
       if pushsuper and not isinstance(curoperation, (ItemSupplier, ItemDistribution)):
         hasParents = False
-        for x in curoperation.superoperations.using(request.database).only('operation').order_by("-priority"):
+        for x in network.superoperations.get(curoperation.name, []):
           root.append( (level, parent, x.operation, curqty, issuboperation, parentoper, realdepth, False, location) )
           hasParents = True
         if hasParents:
@@ -308,12 +511,10 @@ class PathReport(GridReport):
             resources = [ (curoperation.resource.name, float(curoperation.resource_qty)) ]
           else:
             resources = None
-          try:
-            downstr = Buffer.objects.using(request.database).get(name="%s @ %s" % (curoperation.item.name, curoperation.location.name))
-            root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, True) )
-          except Buffer.DoesNotExist:
+          downstr = network.buffers.get((curoperation.item.name, curoperation.location.name), None)
+          if not downstr:
             downstr = Buffer(name="%s @ %s" % (curoperation.item.name, curoperation.location.name), item=curoperation.item, location=curlocation)
-            root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, True) )
+          root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, True) )
         elif isinstance(curoperation, ItemDistribution):
           name = 'Ship %s from %s to %s' % (curoperation.item.name, curoperation.origin.name, curoperation.location.name)
           optype = "distribution"
@@ -327,31 +528,32 @@ class PathReport(GridReport):
             resources = [ (curoperation.resource.name, float(curoperation.resource_qty)) ]
           else:
             resources = None
-          try:
-            downstr = Buffer.objects.using(request.database).get(name="%s @ %s" % (curoperation.item.name, location))
-            root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, True) )
-          except Buffer.DoesNotExist:
+          downstr = network.buffers.get((curoperation.item.name, location), None)
+          if not downstr:
             downstr = Buffer(name="%s @ %s" % (curoperation.item.name, location), item=curoperation.item, location=curlocation)
-            root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, True) )
+          root.extend( reportclass.findUsage(downstr, request.database, level, curqty, realdepth + 1, True) )
         else:
           name = curoperation.name
           optype = curoperation.type
           duration = curoperation.duration
           duration_per = curoperation.duration_per
-          buffers = [ ('%s @ %s' % (x.item.name, curoperation.location.name), float(x.quantity)) for x in curoperation.operationmaterials.only('item', 'quantity').using(request.database) ]
-          resources = [ (x.resource.name, float(x.quantity)) for x in curoperation.operationresources.only('resource', 'quantity').using(request.database) ]
-          for x in curoperation.operationmaterials.filter(quantity__gt=0).only('item').using(request.database):
-            curflows = x.item.operationmaterials.filter(quantity__lt=0, operation__location=curoperation.location.name).only('operation', 'quantity').using(request.database)
+          buffers = [ ('%s @ %s' % (x.item.name, curoperation.location.name), float(x.quantity)) for x in network.materials.get(curoperation.name, []) ]
+          resources = [ (x.resource.name, float(x.quantity)) for x in network.loads.get(curoperation.name, []) ]
+          for x in network.materials.get(curoperation.name, []):
+            if x.quantity <= 0:
+              continue
+            curflows = [
+              y for y in network.consumers.get(x.item.name, [])
+              if y.operation.location_id == curoperation.location.name
+              ]
             for y in curflows:
               hasChildren = True
               root.append( (level - 1, curnode, y.operation, - curqty * y.quantity, subcount, None, realdepth - 1, pushsuper, x.operation.location.name if x.operation.location else None) )
-            try:
-              downstr = Buffer.objects.using(request.database).get(name="%s @ %s" % (x.item.name, location))
-              root.extend( reportclass.findUsage(downstr, request.database, level - 1, curqty, realdepth - 1, True) )
-            except Buffer.DoesNotExist:
+            downstr = network.buffers.get((x.item.name, location), None)
+            if not downstr:
               downstr = Buffer(name="%s @ %s" % (curoperation.item.name, location), item=x.item, location=curlocation)
-              root.extend( reportclass.findUsage(downstr, request.database, level - 1, curqty, realdepth - 1, True) )
-          for x in curoperation.suboperations.using(request.database).only('suboperation').order_by("-priority"):
+            root.extend( reportclass.findUsage(downstr, request.database, level - 1, curqty, realdepth - 1, True) )
+          for x in network.suboperations.get(curoperation.name, []):
             subcount += curoperation.type == "routing" and 1 or -1
             root.append( (level - 1, curnode, x.suboperation, curqty, subcount, curoperation, realdepth, False, location) )
             hasChildren = True
@@ -380,20 +582,16 @@ class PathReport(GridReport):
             resources = [ (curoperation.resource.name, float(curoperation.resource_qty)) ]
           else:
             resources = None
-          try:
-            upstr = Buffer.objects.using(request.database).get(name="%s @ %s" % (curoperation.item.name, curoperation.origin.name))
-            root.extend( reportclass.findReplenishment(upstr, request.database, level + 2, curqty, realdepth + 1, True) )
-          except Buffer.DoesNotExist:
-            upstr = Buffer(name="%s @ %s" % (curoperation.item.name, curoperation.origin.name), item=curoperation.item, location=curoperation.origin)
-            root.extend( reportclass.findReplenishment(upstr, request.database, level + 2, curqty, realdepth + 1, True) )
+          upstr = network.getBuffer(curoperation.item, curoperation.origin)
+          root.extend( reportclass.findReplenishment(upstr, request.database, level + 2, curqty, realdepth + 1, True) )
         else:
           name = curoperation.name
           optype = curoperation.type
           duration = curoperation.duration
           duration_per = curoperation.duration_per
-          buffers = [ ('%s @ %s' % (x.item.name, curoperation.location.name), float(x.quantity)) for x in curoperation.operationmaterials.only('item', 'quantity').using(request.database) ]
-          resources = [ (x.resource.name, float(x.quantity)) for x in curoperation.operationresources.only('resource', 'quantity').using(request.database) ]
-          curflows = curoperation.operationmaterials.filter(quantity__lt=0).only('item', 'quantity').using(request.database)
+          buffers = [ ('%s @ %s' % (x.item.name, curoperation.location.name), float(x.quantity)) for x in network.materials.get(curoperation.name, []) ]
+          resources = [ (x.resource.name, float(x.quantity)) for x in network.loads.get(curoperation.name, []) ]
+          curflows = [ x for x in network.materials.get(curoperation.name, []) if x.quantity < 0 ]
           for y in curflows:
             b = Buffer(
               name='%s @ %s' % (y.item.name, curoperation.location.name),
@@ -401,7 +599,7 @@ class PathReport(GridReport):
               location=curoperation.location
               )
             root.extend( reportclass.findReplenishment(b, request.database, level + 2, curqty, realdepth + 1, True) )
-          for x in curoperation.suboperations.using(request.database).only('suboperation').order_by("-priority"):
+          for x in network.suboperations.get(curoperation.name, []):
             subcount += curoperation.type == "routing" and 1 or -1
             root.append( (level + 1, curnode, x.suboperation, curqty, subcount, curoperation, realdepth, False, location) )
             hasChildren = True
@@ -458,68 +656,42 @@ class UpstreamItemPath(PathReport):
 
   @classmethod
   def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      locs = set()
-      result = []
-      it = Item.objects.using(request.database).get(name=entity)
-      if reportclass.downstream:
-        # Find all buffers where the item is being stored and walk downstream
-        for b in Buffer.objects.filter(item=it).using(request.database):
-          locs.add(b.location.name)
-          result.extend( reportclass.findUsage(b, request.database, 0, 1, 0, True) )
-        # Add item locations that can be replenished
-        for itmdist in ItemDistribution.objects.using(request.database).filter(
-          item__lft__lte=it.lft, item__rght__gt=it.lft
-          ):
-            if itmdist.location.name in locs:
-              continue
-            locs.add(itmdist.location.name)
-            itmdist.item = it
-            result.append(
-              (0, None, itmdist, 1, 0, None, 0, False, itmdist.location.name)
-              )
-        # Add item locations that can be replenished
-        for itmsup in Operation.objects.using(request.database).filter(
-          item__lft__lte=it.lft, item__rght__gt=it.lft
-          ):
-            if itmsup.location.name in locs:
-              continue
-            locs.add(itmsup.location.name)
-            itmsup.item = it
-            result.append(
-              (0, None, itmsup, 1, 0, None, 0, False, itmsup.location.name)
-              )
-        return result
-      else:
-        # Find the supply path of all buffers of this item
-        for b in Buffer.objects.filter(item=entity).using(request.database):
-          result.extend( reportclass.findReplenishment(b, request.database, 0, 1, 0, True) )
-        # Add item locations that can be replenished
-        for itmdist in ItemDistribution.objects.using(request.database).filter(
-          item__lft__lte=it.lft, item__rght__gt=it.lft
-          ):
-            if itmdist.location.name in locs:
-              continue
-            locs.add(itmdist.location.name)
-            itmdist.item = it
-            result.append(
-              (0, None, itmdist, 1, 0, None, 0, False, itmdist.location.name)
-              )
-        # Add item locations that can be replenished
-        for itmsup in Operation.objects.using(request.database).filter(
-          item__lft__lte=it.lft, item__rght__gt=it.lft
-          ):
-            if itmsup.location.name in locs:
-              continue
-            locs.add(itmsup.location.name)
-            itmsup.item = it
-            result.append(
-              (0, None, itmsup, 1, 0, None, 0, False, itmsup.location.name)
-              )
-        return result
-    except ObjectDoesNotExist:
+    network = SupplyNetwork.get(request.database)
+    it = network.getItem(entity)
+    if not it:
       raise Http404("item %s doesn't exist" % entity)
+    locs = set()
+    result = []
+    if reportclass.downstream:
+      # Find all buffers where the item is being stored and walk downstream
+      for b in network.buffersByItem.get(entity, []):
+        locs.add(b.location.name)
+        result.extend( reportclass.findUsage(b, request.database, 0, 1, 0, True) )
+    else:
+      # Find the supply path of all buffers of this item
+      for b in network.buffersByItem.get(entity, []):
+        result.extend( reportclass.findReplenishment(b, request.database, 0, 1, 0, True) )
+    # Add item locations that can be replenished
+    for itmdist in network.select(network.itemdistributions, entity):
+      if itmdist.location.name in locs:
+        continue
+      locs.add(itmdist.location.name)
+      itmdist = _copyRecord(itmdist)
+      itmdist.item = it
+      result.append(
+        (0, None, itmdist, 1, 0, None, 0, False, itmdist.location.name)
+        )
+    # Add item locations that can be replenished
+    for itmsup in network.select(network.operationsByItem, entity):
+      if itmsup.location.name in locs:
+        continue
+      locs.add(itmsup.location.name)
+      itmsup = _copyRecord(itmsup)
+      itmsup.item = it
+      result.append(
+        (0, None, itmsup, 1, 0, None, 0, False, itmsup.location.name)
+        )
+    return result
 
 
 class UpstreamBufferPath(PathReport):
@@ -530,7 +702,7 @@ class UpstreamBufferPath(PathReport):
   def getRoot(reportclass, request, entity):
     from django.core.exceptions import ObjectDoesNotExist
     try:
-      buf = Buffer.objects.using(request.database).get(name=entity)
+      buf = Buffer.objects.using(request.database).select_related('item', 'location').get(name=entity)
       if reportclass.downstream:
         return reportclass.findUsage(buf, request.database, 0, 1, 0, True)
       else:
@@ -545,14 +717,11 @@ class UpstreamResourcePath(PathReport):
 
   @classmethod
   def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      root = Resource.objects.using(request.database).get(name=entity)
-    except ObjectDoesNotExist:
+    if not Resource.objects.using(request.database).filter(name=entity).exists():
       raise Http404("resource %s doesn't exist" % entity)
     return [
       (0, None, i.operation, 1, 0, None, 0, True, i.operation.location.name if i.operation.location else None)
-      for i in root.operationresources.using(request.database).all()
+      for i in SupplyNetwork.get(request.database).loadsByResource.get(entity, [])
       ]
 
 
@@ -562,12 +731,10 @@ class UpstreamOperationPath(PathReport):
 
   @classmethod
   def getRoot(reportclass, request, entity):
-    from django.core.exceptions import ObjectDoesNotExist
-    try:
-      oper = Operation.objects.using(request.database).get(name=entity)
-      return [ (0, None, oper, 1, 0, None, 0, True, oper.location.name if oper.location else None) ]
-    except ObjectDoesNotExist:
+    oper = SupplyNetwork.get(request.database).operations.get(entity, None)
+    if not oper:
       raise Http404("operation %s doesn't exist" % entity)
+    return [ (0, None, oper, 1, 0, None, 0, True, oper.location.name if oper.location else None) ]
 
 
 class DownstreamItemPath(UpstreamItemPath):
@@ -2611,7 +2778,7 @@ class OperationPlanDetail(View):
     # Current date
     try:
       current_date = datetime.strptime(
-        Parameter.objects.using(request.database).get(name="currentdate").value,
+        Parameter.getValue("currentdate", request.database),
         "%Y-%m-%d %H:%M:%S"
         )
     except:
@@ -2623,15 +2790,103 @@ class OperationPlanDetail(View):
     first = True
     if not ids:
       yield "[]"
-      raise StopIteration
+      return
     try:
       opplans = [ x for x in OperationPlan.objects.all().using(request.database).filter(id__in=ids).select_related("operation") ]
-      opplanmats = [ x for x in OperationPlanMaterial.objects.all().using(request.database).filter(operationplan__id__in=ids).values() ]
-      opplanrscs = [ x for x in OperationPlanResource.objects.all().using(request.database).filter(operationplan__id__in=ids).values() ]
+      # Materials and resources grouped by operationplan
+      opplanmats = {}
+      for x in OperationPlanMaterial.objects.all().using(request.database).filter(operationplan__id__in=ids).values():
+        opplanmats.setdefault(x['operationplan_id'], []).append(x)
+      opplanrscs = {}
+      for x in OperationPlanResource.objects.all().using(request.database).filter(operationplan__id__in=ids).values():
+        opplanrscs.setdefault(x['operationplan_id'], []).append(x)
+      # Demands pegged to the operationplans
+      pegging = {}
+      cursor.execute('''
+        select out_pegging.operationplan_id, demand.name, demand.item_id, demand.due, sum(out_pegging.quantity)
+        from out_pegging
+        inner join demand
+          on demand.name = out_pegging.demand
+        where out_pegging.operationplan_id = any(%s)
+        group by out_pegging.operationplan_id, demand.name, demand.item_id, demand.due
+        order by demand.name, demand.due
+        ''', ([ int(i) for i in ids ],))
+      for i in cursor.fetchall():
+        pegging.setdefault(i[0], []).append({
+          "demand": {"name": i[1], "item": {"name": i[2]}, "due": i[3].strftime("%Y-%m-%dT%H:%M:%S")},
+          "quantity": float(i[4])
+          })
+      # Network status of all items, retrieved at once
+      network = {}
+      items = list({ x.item_id for x in opplans if x.item_id })
+      if items:
+        cursor.execute('''
+          with items as (
+             select name from item where name = any(%s)
+             )
+          select
+            items.name, false, location.name, onhand.qty, orders_plus.PO,
+            coalesce(orders_plus.DO, 0) - coalesce(orders_minus.DO, 0),
+            orders_plus.MO, sales.BO, sales.SO
+          from items
+          cross join location
+          left outer join (
+            select item_id, location_id, onhand as qty
+            from buffer
+            inner join items on items.name = buffer.item_id
+            ) onhand
+          on onhand.item_id = items.name and onhand.location_id = location.name
+          left outer join (
+            select item_id, coalesce(location_id, destination_id) as location_id,
+            sum(case when type = 'MO' then quantity end) as MO,
+            sum(case when type = 'PO' then quantity end) as PO,
+            sum(case when type = 'DO' then quantity end) as DO
+            from operationplan
+            inner join items on items.name = operationplan.item_id
+            and status in ('approved', 'confirmed')
+            group by item_id, coalesce(location_id, destination_id)
+            ) orders_plus
+          on orders_plus.item_id = items.name and orders_plus.location_id = location.name
+          left outer join (
+            select item_id, origin_id as location_id,
+            sum(quantity) as DO
+            from operationplan
+            inner join items on items.name = operationplan.item_id
+            and status in ('approved', 'confirmed')
+            and type = 'DO'
+            group by item_id, origin_id
+            ) orders_minus
+          on orders_minus.item_id = items.name and orders_minus.location_id = location.name
+          left outer join (
+            select item_id, location_id,
+            sum(case when due < %s then quantity end) as BO,
+            sum(case when due >= %s then quantity end) as SO
+            from demand
+            inner join items on items.name = demand.item_id
+            where status in ('open', 'quote')
+            group by item_id, location_id
+            ) sales
+          on sales.item_id = items.name and sales.location_id = location.name
+          where
+            onhand.qty is not null
+            or orders_plus.MO is not null
+            or orders_plus.PO is not null
+            or orders_plus.DO is not null
+            or orders_minus.DO is not null
+            or sales.BO is not null
+            or sales.SO is not null
+          order by items.name, location.name
+          ''', (items, current_date, current_date))
+        for a in cursor.fetchall():
+          network.setdefault(a[0], []).append([
+            a[0], a[1], a[2],
+            float(a[3] or 0), float(a[4] or 0), float(a[5] or 0),
+            float(a[6] or 0), float(a[7] or 0), float(a[8] or 0)
+            ])
     except Exception as e:
       logger.error("Error retrieving operationplan data: %s" % e)
       yield "[]"
-      raise StopIteration
+      return
 
     # Store my permissions
     view_PO = request.user.has_perm("input.view_purchaseorder")
@@ -2671,21 +2926,8 @@ class OperationPlanDetail(View):
            "color": float(opplan.color) if opplan.color else ''
            }
         if opplan.plan and 'pegging' in opplan.plan:
-          res["pegging_demand"] = []
-          for d, q in opplan.plan['pegging'].items():
-            try:
-              obj = Demand.objects.all().using(request.database).only("name", "item", "due").get(name=d)
-              dmd = obj.name
-              due = obj.due.strftime("%Y-%m-%dT%H:%M:%S")
-              item = obj.item.name
-            except Demand.DoesNotExist:
-              # Looks like this demand was deleted since the plan was generated
-              continue
-            res["pegging_demand"].append({
-              "demand": {"name": dmd, "item": {"name": item}, "due": due},
-              "quantity": q
-              })
-          res["pegging_demand"].sort(key=lambda f: (f['demand']['name'], f['demand']['due']))
+          # Demands deleted since the plan was generated are skipped
+          res["pegging_demand"] = pegging.get(opplan.id, [])
         if opplan.operation:
           res['operation'] = {
             "name": opplan.operation.name,
@@ -2693,106 +2935,35 @@ class OperationPlanDetail(View):
             }
 
         # Information on materials
-        if view_OpplanMaterial:
-          firstmat = True
-          for m in opplanmats:
-            if m['operationplan_id'] != opplan.id:
-              continue
-            if firstmat:
-              firstmat = False
-              res['flowplans'] = []
-            res['flowplans'].append({
+        if view_OpplanMaterial and opplan.id in opplanmats:
+          res['flowplans'] = [
+            {
               "date": m['flowdate'].strftime("%Y-%m-%dT%H:%M:%S"),
               "quantity": float(m['quantity']),
               "onhand": float(m['onhand'] or 0),
               "buffer": {
                 "name": "%s @ %s" % (m['item_id'], m['location_id'])
                 }
-              })
+            }
+            for m in opplanmats[opplan.id]
+            ]
 
         # Information on resources
-        if view_OpplanResource:
-          firstres = True
-          for m in opplanrscs:
-            if m['operationplan_id'] != opplan.id:
-              continue
-            if firstres:
-              firstres = False
-              res['loadplans'] = []
-            res['loadplans'].append({
+        if view_OpplanResource and opplan.id in opplanrscs:
+          res['loadplans'] = [
+            {
               "date": m['startdate'].strftime("%Y-%m-%dT%H:%M:%S"),
               "quantity": float(m['quantity']),
               "resource": {
                 "name": m['resource_id']
                 }
-              })
+            }
+            for m in opplanrscs[opplan.id]
+            ]
 
-        # Retrieve network status
+        # Network status
         if opplan.item_id:
-          cursor.execute('''
-            with items as (
-               select name from item where name = %s
-               )
-            select
-              items.name, false, location.name, onhand.qty, orders_plus.PO,
-              coalesce(orders_plus.DO, 0) - coalesce(orders_minus.DO, 0),
-              orders_plus.MO, sales.BO, sales.SO
-            from items
-            cross join location
-            left outer join (
-              select item_id, location_id, onhand as qty
-              from buffer
-              inner join items on items.name = buffer.item_id
-              ) onhand
-            on onhand.item_id = items.name and onhand.location_id = location.name
-            left outer join (
-              select item_id, coalesce(location_id, destination_id) as location_id,
-              sum(case when type = 'MO' then quantity end) as MO,
-              sum(case when type = 'PO' then quantity end) as PO,
-              sum(case when type = 'DO' then quantity end) as DO
-              from operationplan
-              inner join items on items.name = operationplan.item_id
-              and status in ('approved', 'confirmed')
-              group by item_id, coalesce(location_id, destination_id)
-              ) orders_plus
-            on orders_plus.item_id = items.name and orders_plus.location_id = location.name
-            left outer join (
-              select item_id, origin_id as location_id,
-              sum(quantity) as DO
-              from operationplan
-              inner join items on items.name = operationplan.item_id
-              and status in ('approved', 'confirmed')
-              and type = 'DO'
-              group by item_id, origin_id
-              ) orders_minus
-            on orders_minus.item_id = items.name and orders_minus.location_id = location.name
-            left outer join (
-              select item_id, location_id,
-              sum(case when due < %s then quantity end) as BO,
-              sum(case when due >= %s then quantity end) as SO
-              from demand
-              inner join items on items.name = demand.item_id
-              where status in ('open', 'quote')
-              group by item_id, location_id
-              ) sales
-            on sales.item_id = items.name and sales.location_id = location.name
-            where
-              onhand.qty is not null
-              or orders_plus.MO is not null
-              or orders_plus.PO is not null
-              or orders_plus.DO is not null
-              or orders_minus.DO is not null
-              or sales.BO is not null
-              or sales.SO is not null
-            order by items.name, location.name
-            ''', (opplan.item_id, current_date, current_date))
-          res['network'] = []
-          for a in cursor.fetchall():
-            res['network'].append([
-              a[0], a[1], a[2],
-              float(a[3] or 0), float(a[4] or 0), float(a[5] or 0),
-              float(a[6] or 0), float(a[7] or 0), float(a[8] or 0)
-              ])
+          res['network'] = network.get(opplan.item_id, [])
 
         # Final result
         if first:
@@ -2800,10 +2971,10 @@ class OperationPlanDetail(View):
           first = False
         else:
           yield ',%s' % json.dumps(res)
-        yield "]"
       except Exception as e:
         # Ignore exceptions and move on
         logger.error("Error retrieving operationplan: %s" % e)
+    yield "[]" if first else "]"
 
 
   @method_decorator(csrf_exempt)
@@ -2842,54 +3013,99 @@ class OperationPlanDetail(View):
     update_PO = request.user.has_perm("input.change_purchaseorder")
     update_MO = request.user.has_perm("input.change_manufacturingorder")
     update_DO = request.user.has_perm("input.change_distributionorder")
+    if not isinstance(data, list):
+      data = [data]
 
+    # Read all operationplans in a single query
+    ids = []
     for opplan_data in data:
       try:
-        # Read the object from the database
-        opplan = OperationPlan.objects.all().using(request.database).get(id=opplan_data.get('id', None))
+        ids.append(int(opplan_data['id']))
+      except Exception:
+        pass
+    opplans = {
+      i[0]: list(i) for i in OperationPlan.objects.all().using(request.database)
+        .filter(id__in=ids)
+        .values_list('id', 'type', 'startdate', 'enddate', 'quantity', 'status', 'reference')
+      }
 
-        # Check permissions
-        if opplan.type == "DO" and not update_DO:
-          continue
-        if opplan.type == "PO" and not update_PO:
+    # Apply the changes in memory
+    results = []
+    changed = {}
+    for opplan_data in data:
+      try:
+        opplan_id = int(opplan_data['id'])
+        opplan = opplans.get(opplan_id, None)
+        if not opplan:
+          results.append({"id": opplan_id, "status": "error", "message": "Not found"})
           continue
-        if opplan.type == "MO" and not update_MO:
+
+        # Check permissions
+        if not {"DO": update_DO, "PO": update_PO, "MO": update_MO}.get(opplan[1], True):
+          results.append({"id": opplan_id, "status": "error", "message": "Permission denied"})
           continue
 
         # Update fields
         save = False
         if "start" in opplan_data:
           # Update start date
-          opplan.startdate = datetime.strptime(opplan_data['start'], "%Y-%m-%dT%H:%M:%S")
+          opplan[2] = datetime.strptime(opplan_data['start'], "%Y-%m-%dT%H:%M:%S")
           save = True
         if "end" in opplan_data:
           # Update end date
-          opplan.enddate = datetime.strptime(opplan_data['end'], "%Y-%m-%dT%H:%M:%S")
+          opplan[3] = datetime.strptime(opplan_data['end'], "%Y-%m-%dT%H:%M:%S")
           save = True
         if "quantity" in opplan_data:
           # Update quantity
-          opplan.quantity = opplan_data['quantity']
+          opplan[4] = float(opplan_data['quantity'])
           save = True
         if "status" in opplan_data:
           # Status quantity
-          opplan.status = opplan_data['status']
+          if opplan_data['status'] not in dict(OperationPlan.orderstatus):
+            raise Exception("Invalid status '%s'" % opplan_data['status'])
+          opplan[5] = opplan_data['status']
           save = True
-
         if "reference" in opplan_data:
           # Update reference
-          opplan.reference = opplan_data['reference']
+          opplan[6] = opplan_data['reference']
           save = True
-
-        # Save if changed
         if save:
-          opplan.save(
-            using=request.database,
-            update_fields=["startdate", "enddate", "quantity", "reference", "lastmodified"]
-            )
-      except OperationPlan.DoesNotExist:
-        # Silently ignore
-        pass
+          changed[opplan_id] = opplan
+        results.append({"id": opplan_id, "status": "OK"})
       except Exception as e:
-        # Swallow the exception and move on
+        # Report the error and move on
         logger.error("Error updating operationplan: %s" % e)
-    return HttpResponse(content="OK")
+        results.append({"id": opplan_data.get('id', None) if isinstance(opplan_data, dict) else None, "status": "error", "message": str(e)})
+
+    # Save all changes in a single statement
+    if changed:
+      try:
+        with transaction.atomic(using=request.database):
+          with connections[request.database].cursor() as cursor:
+            cursor.execute('''
+              update operationplan
+              set startdate = changes.startdate, enddate = changes.enddate,
+                quantity = changes.quantity, status = changes.status,
+                reference = changes.reference, lastmodified = %s
+              from unnest(
+                %s::integer[], %s::timestamp with time zone[], %s::timestamp with time zone[],
+                %s::numeric[], %s::varchar[], %s::varchar[]
+                ) as changes(id, startdate, enddate, quantity, status, reference)
+              where operationplan.id = changes.id
+              ''', (
+                datetime.now(),
+                [ i[0] for i in changed.values() ],
+                [ i[2] for i in changed.values() ],
+                [ i[3] for i in changed.values() ],
+                [ i[4] for i in changed.values() ],
+                [ i[5] for i in changed.values() ],
+                [ i[6] for i in changed.values() ]
+                ))
+      except Exception as e:
+        logger.error("Error updating operationplan data: %s" % e)
+        return HttpResponseServerError("Error updating operationplan data", content_type='text/html')
+
+    return HttpResponse(
+      content_type='application/json; charset=%s' % settings.DEFAULT_CHARSET,
+      content=json.dumps(results).encode(settings.DEFAULT_CHARSET)
+      )
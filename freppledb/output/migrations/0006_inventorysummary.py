@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0005_number_precision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventorySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(max_length=300, verbose_name='granularity')),
+                ('item', models.CharField(max_length=300, verbose_name='item')),
+                ('location', models.CharField(max_length=300, verbose_name='location')),
+                ('bucket', models.CharField(max_length=300, verbose_name='bucket')),
+                ('startdate', models.DateTimeField(verbose_name='startdate')),
+                ('enddate', models.DateTimeField(verbose_name='enddate')),
+                ('startoh', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='start inventory')),
+                ('startohdoc', models.IntegerField(default=0, verbose_name='start inventory days of cover')),
+                ('safetystock', models.DecimalField(decimal_places=8, max_digits=20, null=True, verbose_name='safety stock')),
+                ('consumed', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='total consumed')),
+                ('consumed_mo', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='consumed by MO')),
+                ('consumed_do', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='consumed by DO')),
+                ('consumed_so', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='consumed by SO')),
+                ('produced', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='total produced')),
+                ('produced_mo', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='produced by MO')),
+                ('produced_do', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='produced by DO')),
+                ('produced_po', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='produced by PO')),
+                ('total_in_progress', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='total in progress')),
+                ('work_in_progress_mo', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='work in progress MO')),
+                ('on_order_po', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='on order PO')),
+                ('in_transit_do', models.DecimalField(decimal_places=8, default=0, max_digits=20, verbose_name='in transit DO')),
+                ('lastmodified', models.DateTimeField(db_index=True, verbose_name='last modified')),
+            ],
+            options={
+                'verbose_name': 'inventory summary',
+                'verbose_name_plural': 'inventory summaries',
+                'db_table': 'out_inventoryplan',
+                'ordering': ['granularity', 'item', 'location', 'startdate'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='inventorysummary',
+            unique_together=set([('granularity', 'item', 'location', 'startdate')]),
+        ),
+    ]
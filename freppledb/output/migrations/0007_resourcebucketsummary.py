@@ -0,0 +1,53 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0006_inventorysummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResourceBucketSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(max_length=300, verbose_name='granularity')),
+                ('resource', models.CharField(max_length=300, verbose_name='resource')),
+                ('bucket', models.CharField(max_length=300, verbose_name='bucket')),
+                ('startdate', models.DateTimeField(verbose_name='startdate')),
+                ('enddate', models.DateTimeField(verbose_name='enddate')),
+                ('available', models.DecimalField(decimal_places=8, max_digits=20, null=True, verbose_name='available')),
+                ('unavailable', models.DecimalField(decimal_places=8, max_digits=20, null=True, verbose_name='unavailable')),
+                ('setup', models.DecimalField(decimal_places=8, max_digits=20, null=True, verbose_name='setup')),
+                ('load', models.DecimalField(decimal_places=8, max_digits=20, null=True, verbose_name='load')),
+            ],
+            options={
+                'verbose_name': 'resource bucket summary',
+                'verbose_name_plural': 'resource bucket summaries',
+                'db_table': 'out_resourcebucketplan',
+                'ordering': ['granularity', 'resource', 'startdate'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='resourcebucketsummary',
+            unique_together=set([('granularity', 'resource', 'startdate')]),
+        ),
+    ]
@@ -0,0 +1,44 @@
+#
+# Copyright (C) 2018 by frePPLe bvba
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('output', '0007_resourcebucketsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Pegging',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('demand', models.CharField(db_index=True, max_length=300, verbose_name='demand')),
+                ('operationplan_id', models.IntegerField(db_index=True, verbose_name='operationplan')),
+                ('level', models.IntegerField(verbose_name='level')),
+                ('quantity', models.DecimalField(decimal_places=8, max_digits=20, verbose_name='quantity')),
+            ],
+            options={
+                'verbose_name': 'pegging',
+                'verbose_name_plural': 'peggings',
+                'db_table': 'out_pegging',
+                'ordering': ['demand', 'id'],
+            },
+        ),
+    ]
@@ -15,8 +15,14 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from datetime import datetime
+
 from django.utils.translation import ugettext_lazy as _
-from django.db import models
+from django.db import connections, models, transaction
+
+
+# Key of the PostgreSQL advisory lock held while refreshing the inventory profile
+INVENTORY_REFRESH_LOCK = 20180601
 
 
 class Problem(models.Model):
@@ -62,6 +68,24 @@ class Constraint(models.Model):
     verbose_name_plural = _('constraints')
 
 
+class Pegging(models.Model):
+  '''
+  The pegging of the demands: the operationplans that supply a demand, at
+  every level of its supply path. The records of a demand are stored in the
+  order of the pegging.
+  '''
+  demand = models.CharField(_('demand'), max_length=300, db_index=True)
+  operationplan_id = models.IntegerField(_('operationplan'), db_index=True)
+  level = models.IntegerField(_('level'))
+  quantity = models.DecimalField(_('quantity'), max_digits=20, decimal_places=8)
+
+  class Meta:
+    db_table = 'out_pegging'
+    ordering = ['demand', 'id']
+    verbose_name = 'pegging'  # No need to translate these since only used internally
+    verbose_name_plural = 'peggings'
+
+
 class ResourceSummary(models.Model):
   resource = models.CharField(_('resource'), max_length=300)
   startdate = models.DateTimeField(_('startdate'))
@@ -77,3 +101,310 @@ class ResourceSummary(models.Model):
     unique_together = (('resource', 'startdate'),)
     verbose_name = 'resource summary'  # No need to translate these since only used internally
     verbose_name_plural = 'resource summaries'
+
+
+class ResourceBucketSummary(models.Model):
+  '''
+  The daily resource plans of out_resourceplan, rolled up in the time buckets
+  of the bucket granularities.
+  '''
+  granularity = models.CharField(_('granularity'), max_length=300)
+  resource = models.CharField(_('resource'), max_length=300)
+  bucket = models.CharField(_('bucket'), max_length=300)
+  startdate = models.DateTimeField(_('startdate'))
+  enddate = models.DateTimeField(_('enddate'))
+  available = models.DecimalField(_('available'), max_digits=20, decimal_places=8, null=True)
+  unavailable = models.DecimalField(_('unavailable'), max_digits=20, decimal_places=8, null=True)
+  setup = models.DecimalField(_('setup'), max_digits=20, decimal_places=8, null=True)
+  load = models.DecimalField(_('load'), max_digits=20, decimal_places=8, null=True)
+
+  class Meta:
+    db_table = 'out_resourcebucketplan'
+    ordering = ['granularity', 'resource', 'startdate']
+    unique_together = (('granularity', 'resource', 'startdate'),)
+    verbose_name = 'resource bucket summary'  # No need to translate these since only used internally
+    verbose_name_plural = 'resource bucket summaries'
+
+  @staticmethod
+  def build(cursor, granularity):
+    '''
+    Rolls up the resource plans in the buckets of a granularity.
+    '''
+    cursor.execute('''
+      insert into out_resourcebucketplan (
+        granularity, resource, bucket, startdate, enddate,
+        available, unavailable, setup, load
+        )
+      select
+        d.bucket_id, out_resourceplan.resource, d.name, d.startdate, d.enddate,
+        sum(out_resourceplan.available), sum(out_resourceplan.unavailable),
+        sum(out_resourceplan.setup), sum(out_resourceplan.load)
+      from out_resourceplan
+      inner join common_bucketdetail d
+        on d.bucket_id = %s
+        and out_resourceplan.startdate >= d.startdate
+        and out_resourceplan.startdate < d.enddate
+      group by d.bucket_id, out_resourceplan.resource, d.name, d.startdate, d.enddate
+      ''', (granularity,))
+
+  @staticmethod
+  def isValid(database, granularity, start, end):
+    '''
+    Returns True when the rollup of a granularity is available, and its
+    buckets between the start and end date still match the bucket dates.
+    Bucket dates that are edited after the plan export make the rollup
+    invalid.
+    '''
+    with connections[database].cursor() as cursor:
+      cursor.execute('''
+        select
+          exists (
+            select 1 from out_resourcebucketplan
+            where granularity = %s
+            ),
+          not exists (
+            select 1 from out_resourcebucketplan
+            where granularity = %s
+            and startdate < %s and enddate > %s
+            and not exists (
+              select 1 from common_bucketdetail d
+              where d.bucket_id = out_resourcebucketplan.granularity
+              and d.startdate = out_resourcebucketplan.startdate
+              and d.enddate = out_resourcebucketplan.enddate
+              )
+            )
+        ''', (granularity, granularity, end, start))
+      available, matching = cursor.fetchone()
+      return available and matching
+
+
+class InventorySummary(models.Model):
+  '''
+  The inventory profile of the buffers, aggregated in the time buckets of
+  the bucket granularities.
+
+  The table is populated by the plan export. The first bucket of the
+  horizon starts at the current date of the plan, which is also the start
+  of the default horizon of the inventory report.
+  '''
+  granularity = models.CharField(_('granularity'), max_length=300)
+  item = models.CharField(_('item'), max_length=300)
+  location = models.CharField(_('location'), max_length=300)
+  bucket = models.CharField(_('bucket'), max_length=300)
+  startdate = models.DateTimeField(_('startdate'))
+  enddate = models.DateTimeField(_('enddate'))
+  startoh = models.DecimalField(_('start inventory'), max_digits=20, decimal_places=8, default=0)
+  startohdoc = models.IntegerField(_('start inventory days of cover'), default=0)
+  safetystock = models.DecimalField(_('safety stock'), max_digits=20, decimal_places=8, null=True)
+  consumed = models.DecimalField(_('total consumed'), max_digits=20, decimal_places=8, default=0)
+  consumed_mo = models.DecimalField(_('consumed by MO'), max_digits=20, decimal_places=8, default=0)
+  consumed_do = models.DecimalField(_('consumed by DO'), max_digits=20, decimal_places=8, default=0)
+  consumed_so = models.DecimalField(_('consumed by SO'), max_digits=20, decimal_places=8, default=0)
+  produced = models.DecimalField(_('total produced'), max_digits=20, decimal_places=8, default=0)
+  produced_mo = models.DecimalField(_('produced by MO'), max_digits=20, decimal_places=8, default=0)
+  produced_do = models.DecimalField(_('produced by DO'), max_digits=20, decimal_places=8, default=0)
+  produced_po = models.DecimalField(_('produced by PO'), max_digits=20, decimal_places=8, default=0)
+  total_in_progress = models.DecimalField(_('total in progress'), max_digits=20, decimal_places=8, default=0)
+  work_in_progress_mo = models.DecimalField(_('work in progress MO'), max_digits=20, decimal_places=8, default=0)
+  on_order_po = models.DecimalField(_('on order PO'), max_digits=20, decimal_places=8, default=0)
+  in_transit_do = models.DecimalField(_('in transit DO'), max_digits=20, decimal_places=8, default=0)
+  lastmodified = models.DateTimeField(_('last modified'), db_index=True)
+
+  class Meta:
+    db_table = 'out_inventoryplan'
+    ordering = ['granularity', 'item', 'location', 'startdate']
+    unique_together = (('granularity', 'item', 'location', 'startdate'),)
+    verbose_name = 'inventory summary'  # No need to translate these since only used internally
+    verbose_name_plural = 'inventory summaries'
+
+  @staticmethod
+  def build(cursor, granularities, start, end, timestamp, buffers=None):
+    '''
+    Computes the inventory profile of the buffers in a single set-based
+    statement.
+
+    The profile is computed for all time buckets of the granularities that
+    overlap with the horizon. The start of the first bucket is moved to the
+    start of the horizon. When a list of (item, location) tuples is passed
+    only these buffers are computed, otherwise all buffers with a flow or a
+    buffer record are.
+    '''
+    if buffers is None:
+      scope = '''
+        select item_id, location_id from operationplanmaterial
+        union
+        select item_id, location_id from buffer
+        '''
+      scope_join = ''
+      params = [start, list(granularities), start, end, timestamp]
+    else:
+      scope = 'select * from unnest(%s::varchar[], %s::varchar[]) as buffers(item_id, location_id)'
+      scope_join = 'inner join scope on scope.item_id = opm.item_id and scope.location_id = opm.location_id'
+      params = [
+        [ i[0] for i in buffers ], [ i[1] for i in buffers ],
+        start, list(granularities), start, end, timestamp
+        ]
+    cursor.execute('''
+      with scope as (%s),
+      d as (
+        select bucket_id as granularity, name as bucket, startdate, enddate,
+          greatest(startdate, %%s) as datefrom
+        from common_bucketdetail
+        where bucket_id = any(%%s) and enddate > %%s and startdate < %%s
+        ),
+      flows as (
+        select opm.item_id, opm.location_id, d.granularity, d.datefrom,
+          sum(case when opm.quantity < 0 then -opm.quantity else 0 end) as consumed,
+          sum(case when opm.quantity < 0 and operationplan.type = 'MO' then -opm.quantity else 0 end) as consumed_mo,
+          sum(case when opm.quantity < 0 and operationplan.type = 'DO' then -opm.quantity else 0 end) as consumed_do,
+          sum(case when opm.quantity < 0 and operationplan.type = 'DLVR' then -opm.quantity else 0 end) as consumed_so,
+          sum(case when opm.quantity > 0 then opm.quantity else 0 end) as produced,
+          sum(case when opm.quantity > 0 and operationplan.type = 'MO' then opm.quantity else 0 end) as produced_mo,
+          sum(case when opm.quantity > 0 and operationplan.type = 'DO' then opm.quantity else 0 end) as produced_do,
+          sum(case when opm.quantity > 0 and operationplan.type = 'PO' then opm.quantity else 0 end) as produced_po
+        from operationplanmaterial opm
+        inner join operationplan on operationplan.id = opm.operationplan_id
+        %s
+        inner join d on opm.flowdate >= d.datefrom and opm.flowdate < d.enddate
+        group by opm.item_id, opm.location_id, d.granularity, d.datefrom
+        ),
+      progress as (
+        select opm.item_id, opm.location_id, d.granularity, d.datefrom,
+          sum(opm.quantity) as total_in_progress,
+          sum(case when operationplan.type = 'MO' then opm.quantity else 0 end) as work_in_progress_mo,
+          sum(case when operationplan.type = 'PO' then opm.quantity else 0 end) as on_order_po,
+          sum(case when operationplan.type = 'DO' then opm.quantity else 0 end) as in_transit_do
+        from operationplanmaterial opm
+        inner join operationplan on operationplan.id = opm.operationplan_id
+        %s
+        inner join d on operationplan.startdate < d.enddate and operationplan.enddate >= d.enddate
+        where opm.quantity > 0
+        group by opm.item_id, opm.location_id, d.granularity, d.datefrom
+        )
+      insert into out_inventoryplan (
+        granularity, item, location, bucket, startdate, enddate,
+        startoh, startohdoc, safetystock,
+        consumed, consumed_mo, consumed_do, consumed_so,
+        produced, produced_mo, produced_do, produced_po,
+        total_in_progress, work_in_progress_mo, on_order_po, in_transit_do,
+        lastmodified
+        )
+      select
+        d.granularity, scope.item_id, scope.location_id, d.bucket, d.datefrom, d.enddate,
+        coalesce(oh.onhand, 0),
+        case
+          when coalesce(oh.onhand, 0) <= 0 then 0
+          when coalesce(oh.periodofcover, 0) = 0 or oh.periodofcover = 86313600 then 999
+          else floor((extract(epoch from oh.flowdate - d.startdate) + oh.periodofcover) / 86400)
+        end,
+        (select safetystock from
+          (
+          select 1 as priority, coalesce((select value from calendarbucket
+          where calendar_id = 'SS for '||scope.item_id||' @ '||scope.location_id
+          and d.datefrom >= startdate and d.datefrom < enddate
+          order by priority limit 1), (select defaultvalue from calendar where name = 'SS for '||scope.item_id||' @ '||scope.location_id)) as safetystock
+          union all
+          select 2 as priority, coalesce((select value from calendarbucket
+          where calendar_id = (select minimum_calendar_id from buffer where name = scope.item_id||' @ '||scope.location_id)
+          and d.datefrom >= startdate and d.datefrom < enddate
+          order by priority limit 1), (select defaultvalue from calendar where name = (select minimum_calendar_id from buffer where name = scope.item_id||' @ '||scope.location_id))) as safetystock
+          union all
+          select 3 as priority, minimum as safetystock from buffer where name = scope.item_id||' @ '||scope.location_id
+          ) t
+          where t.safetystock is not null
+          order by priority
+          limit 1),
+        coalesce(flows.consumed, 0), coalesce(flows.consumed_mo, 0),
+        coalesce(flows.consumed_do, 0), coalesce(flows.consumed_so, 0),
+        coalesce(flows.produced, 0), coalesce(flows.produced_mo, 0),
+        coalesce(flows.produced_do, 0), coalesce(flows.produced_po, 0),
+        coalesce(progress.total_in_progress, 0), coalesce(progress.work_in_progress_mo, 0),
+        coalesce(progress.on_order_po, 0), coalesce(progress.in_transit_do, 0),
+        %%s
+      from scope
+      cross join d
+      left outer join lateral (
+        select onhand, flowdate, periodofcover
+        from operationplanmaterial
+        where item_id = scope.item_id and location_id = scope.location_id
+        and flowdate < d.datefrom
+        order by flowdate desc, id desc
+        limit 1
+        ) oh on true
+      left outer join flows
+        on flows.item_id = scope.item_id and flows.location_id = scope.location_id
+        and flows.granularity = d.granularity and flows.datefrom = d.datefrom
+      left outer join progress
+        on progress.item_id = scope.item_id and progress.location_id = scope.location_id
+        and progress.granularity = d.granularity and progress.datefrom = d.datefrom
+      ''' % (scope, scope_join, scope_join), params)
+
+  @staticmethod
+  def getHorizon(database, granularity):
+    '''
+    Returns the start and end date of the materialized profile of a bucket
+    granularity, or None when the granularity isn't materialized.
+    All buffers have a record for the same list of buckets, so it suffices to
+    look at one of them.
+    '''
+    with connections[database].cursor() as cursor:
+      cursor.execute('''
+        select min(startdate), max(enddate)
+        from out_inventoryplan
+        where granularity = %s
+        and (item, location) = (
+          select item, location from out_inventoryplan
+          where granularity = %s limit 1
+          )
+        ''', (granularity, granularity))
+      start, end = cursor.fetchone()
+      return (start, end) if start else None
+
+  @classmethod
+  def refresh(cls, database, granularity, start, end):
+    '''
+    Recomputes the profile of the buffers with operationplans that were
+    created or edited after their profile was computed.
+    Operationplans that were deleted are only reflected after the next plan
+    export.
+    When another refresh is already running, this method returns immediately
+    and the report shows the profile as it is.
+    '''
+    with transaction.atomic(using=database), connections[database].cursor() as cursor:
+      cursor.execute("select pg_try_advisory_xact_lock(%s)", (INVENTORY_REFRESH_LOCK,))
+      if not cursor.fetchone()[0]:
+        return
+      cursor.execute("select min(lastmodified) from out_inventoryplan")
+      watermark = cursor.fetchone()[0]
+      if not watermark:
+        return
+      cursor.execute('''
+        select distinct item_id, location_id
+        from (
+          select opm.item_id, opm.location_id, operationplan.lastmodified
+          from operationplan
+          inner join operationplanmaterial opm on opm.operationplan_id = operationplan.id
+          where operationplan.lastmodified > %s
+          union all
+          select item_id, location_id, lastmodified
+          from operationplan
+          where lastmodified > %s and item_id is not null and location_id is not null
+          ) edited
+        where not exists (
+          select 1 from out_inventoryplan
+          where granularity = %s
+          and item = edited.item_id and location = edited.location_id
+          and lastmodified >= edited.lastmodified
+          )
+        ''', (watermark, watermark, granularity))
+      buffers = cursor.fetchall()
+      if not buffers:
+        return
+      cursor.execute('''
+        delete from out_inventoryplan
+        where granularity = %s
+        and (item, location) in (
+          select * from unnest(%s::varchar[], %s::varchar[])
+          )
+        ''', (granularity, [ i[0] for i in buffers ], [ i[1] for i in buffers ]))
+      cls.build(cursor, (granularity,), start, end, datetime.now(), buffers)
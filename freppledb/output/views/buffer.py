@@ -26,6 +26,7 @@ from django.utils.translation import string_concat
 from freppledb.boot import getAttributeFields
 from freppledb.input.models import Buffer, Item, Location, OperationPlanMaterial
 from freppledb.input.views import OperationPlanMixin
+from freppledb.output.models import InventorySummary
 from freppledb.common.report import GridReport, GridPivot, GridFieldText, GridFieldNumber
 from freppledb.common.report import GridFieldDateTime, GridFieldInteger, GridFieldDuration
 from freppledb.common.report import GridFieldCurrency, GridFieldLastModified, GridFieldBool
@@ -137,6 +138,14 @@ class OverviewReport(GridPivot):
 
   @classmethod
   def query(reportclass, request, basequery, sortsql='1 asc'):
+    # Read the profile computed by the plan export when it covers the horizon
+    horizon = InventorySummary.getHorizon(request.database, request.report_bucket)
+    if horizon and request.report_enddate and horizon[0] == request.report_startdate \
+      and horizon[1] >= request.report_enddate:
+      InventorySummary.refresh(request.database, request.report_bucket, *horizon)
+      yield from reportclass.querySummary(request, basequery, sortsql)
+      return
+
     cursor = connections[request.database].cursor()
     basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(with_col_aliases=False)
 
@@ -302,6 +311,123 @@ class OverviewReport(GridPivot):
           idx += 1
         yield res
 
+  @classmethod
+  def querySummary(reportclass, request, basequery, sortsql='1 asc'):
+    '''
+    Builds the report from the inventory profile materialized by the plan
+    export. The cost of this query doesn't depend on the number of flows.
+    '''
+    basesql, baseparams = basequery.query.get_compiler(basequery.db).as_sql(with_col_aliases=False)
+    bucketstart = { i['name']: i['startdate'] for i in request.report_bucketlist }
+    query = '''
+       select item.name||' @ '||location.name,
+       item.name item_id,
+       location.name location_id,
+       item.description,
+       item.category,
+       item.subcategory,
+       item.cost,
+       item.owner_id,
+       item.source,
+       item.lastmodified,
+       location.description,
+       location.category,
+       location.subcategory,
+       location.available_id,
+       location.owner_id,
+       location.source,
+       location.lastmodified,
+       %s
+       inv.bucket,
+       inv.startdate,
+       inv.enddate,
+       inv.startoh,
+       inv.startohdoc,
+       inv.safetystock,
+       inv.consumed,
+       inv.consumed_mo,
+       inv.consumed_do,
+       inv.consumed_so,
+       inv.produced,
+       inv.produced_mo,
+       inv.produced_do,
+       inv.produced_po,
+       inv.total_in_progress,
+       inv.work_in_progress_mo,
+       inv.on_order_po,
+       inv.in_transit_do
+       from
+       (%s) opplanmat
+       inner join item on item.name = opplanmat.item_id
+       inner join location on location.name = opplanmat.location_id
+       inner join out_inventoryplan inv
+         on inv.granularity = %%s
+         and inv.item = opplanmat.item_id
+         and inv.location = opplanmat.location_id
+         and inv.enddate > %%s and inv.startdate < %%s
+       order by %s, inv.startdate
+    ''' % (
+        reportclass.attr_sql, basesql, sortsql
+      )
+
+    with connections[request.database].chunked_cursor() as cursor_chunked:
+      cursor_chunked.execute(
+        query,
+        baseparams +  # opplanmat
+        (request.report_bucket, request.report_startdate, request.report_enddate),  # inv
+        )
+      for row in cursor_chunked:
+        numfields = len(row)
+        startoh = round(row[numfields - 15], 1)
+        produced = round(row[numfields - 8], 1)
+        consumed = round(row[numfields - 12], 1)
+        res = {
+          'buffer': row[0],
+          'item': row[1],
+          'location': row[2],
+          'item__description': row[3],
+          'item__category': row[4],
+          'item__cost': row[6],
+          'item__owner': row[7],
+          'item__source': row[8],
+          'item__lastmodified': row[9],
+          'location__description': row[10],
+          'location__category': row[11],
+          'location__subcategory': row[12],
+          'location__available_id': row[13],
+          'location__owner_id': row[14],
+          'location__source': row[15],
+          'location__lastmodified': row[16],
+          'bucket': row[numfields - 18],
+          'startdate': bucketstart.get(row[numfields - 18], row[numfields - 17]).date(),
+          'enddate': row[numfields - 16].date(),
+          'startoh': startoh,
+          'startohdoc': row[numfields - 14],
+          'safetystock': round(row[numfields - 13] or 0, 1),
+          'consumed': consumed,
+          'consumedMO': round(row[numfields - 11], 1),
+          'consumedDO': round(row[numfields - 10], 1),
+          'consumedSO': round(row[numfields - 9], 1),
+          'produced': produced,
+          'producedMO': round(row[numfields - 7], 1),
+          'producedDO': round(row[numfields - 6], 1),
+          'producedPO': round(row[numfields - 5], 1),
+          'total_in_progress': round(row[numfields - 4], 1),
+          'work_in_progress_mo': round(row[numfields - 3], 1),
+          'on_order_po': round(row[numfields - 2], 1),
+          'in_transit_do': round(row[numfields - 1], 1),
+          'endoh': round(float(startoh) + float(produced) - float(consumed), 1),
+          }
+        # Add attribute fields
+        idx = 17
+        for f in getAttributeFields(Item, related_name_prefix="item"):
+          res[f.field_name] = row[idx]
+          idx += 1
+        for f in getAttributeFields(Location, related_name_prefix="location"):
+          res[f.field_name] = row[idx]
+          idx += 1
+        yield res
+
 
 class DetailReport(OperationPlanMixin, GridReport):
   '''
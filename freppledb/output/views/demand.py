@@ -26,7 +26,8 @@ from django.utils.encoding import force_text
 
 from freppledb.boot import getAttributeFields
 from freppledb.common.report import GridPivot, GridFieldText
-from freppledb.input.models import Demand, Item, PurchaseOrder, DistributionOrder, ManufacturingOrder
+from freppledb.input.models import Item, PurchaseOrder, DistributionOrder, ManufacturingOrder
+from freppledb.output.models import Pegging
 
 
 class OverviewReport(GridPivot):
@@ -180,10 +181,10 @@ def OperationPlans(request):
   so_list = request.GET.getlist('demand')
 
   # Collect operationplans associated with the sales order(s)
-  id_list = []
-  for dm in Demand.objects.all().using(request.database).filter(pk__in=so_list).only('plan'):
-    for op in dm.plan['pegging']:
-      id_list.append(op['opplan'])
+  id_list = Pegging.objects.all().using(request.database) \
+    .filter(demand__in=so_list) \
+    .values_list('operationplan_id', flat=True) \
+    .distinct()
 
   # Collect details on the operationplans
   result = []
@@ -40,8 +40,19 @@ class Report(GridReport):
 
   @staticmethod
   def query(request, basequery):
-    # Execute the query
-    cursor = connections[request.database].cursor()
+    for row in Report.getKPIs(request.database):
+      yield {
+        'category': row[0],
+        'name': row[1],
+        'value': row[2],
+        }
+
+  @staticmethod
+  def getKPIs(database):
+    '''
+    Returns a list with the category, name and value of all indicators.
+    '''
+    cursor = connections[database].cursor()
     cursor.execute('''
       select 101 as id, 'Problem count' as category, name as name, count(*) as value
       from out_problem
@@ -94,11 +105,4 @@ class Report(GridReport):
       order by 1
       '''
       )
-
-    # Build the python result
-    for row in cursor.fetchall():
-      yield {
-        'category': row[1],
-        'name': row[2],
-        'value': row[3],
-        }
+    return [ row[1:] for row in cursor.fetchall() ]
@@ -81,18 +81,14 @@ class ReportByDemand(GridReport):
     # Get the earliest and latest operationplan, and the demand due date
     cursor = connections[request.database].cursor()
     cursor.execute('''
-      with dmd as (
-        select
-          due,
-          cast(jsonb_array_elements(plan->'pegging')->>'opplan' as integer) opplan
-        from demand
-        where name = %s
-        )
-      select min(dmd.due), min(startdate), max(enddate)
-      from dmd
+      select min(demand.due), min(startdate), max(enddate)
+      from demand
+      inner join out_pegging
+      on out_pegging.demand = demand.name
       inner join operationplan
-      on dmd.opplan = operationplan.id
+      on out_pegging.operationplan_id = operationplan.id
       and type <> 'STCK'
+      where demand.name = %s
       ''', (args[0]))
     x = cursor.fetchone()
     (due, start, end) = x
@@ -130,7 +126,7 @@ class ReportByDemand(GridReport):
     horizon = (request.report_enddate - request.report_startdate).total_seconds() / 10000
     try:
       current = datetime.strptime(
-        Parameter.objects.using(request.database).get(name="currentdate").value,
+        Parameter.getValue("currentdate", request.database),
         "%Y-%m-%d %H:%M:%S"
         )
     except:
@@ -143,16 +139,16 @@ class ReportByDemand(GridReport):
         select
           min(rownum) as rownum, min(due) as due, opplan, min(lvl) as lvl, sum(quantity) as quantity
         from (select
-          row_number() over () as rownum, opplan, due, lvl, quantity
-        from (select
-          due,
-          cast(jsonb_array_elements(plan->'pegging')->>'opplan' as integer) as opplan,
-          cast(jsonb_array_elements(plan->'pegging')->>'level' as integer) as lvl,
-          cast(jsonb_array_elements(plan->'pegging')->>'quantity' as numeric) as quantity
+          row_number() over (order by out_pegging.id) as rownum,
+          out_pegging.operationplan_id as opplan,
+          demand.due,
+          out_pegging.level as lvl,
+          out_pegging.quantity
           from demand
-          where name = %s
+          inner join out_pegging
+            on out_pegging.demand = demand.name
+          where demand.name = %s
           ) d1
-          )d2
         group by opplan
         )
       select
@@ -23,6 +23,7 @@ from django.utils.translation import string_concat
 from freppledb.boot import getAttributeFields
 from freppledb.input.models import Resource, Location, OperationPlanResource, Operation
 from freppledb.input.views import OperationPlanMixin
+from freppledb.output.models import ResourceBucketSummary
 from freppledb.common.models import Parameter
 from freppledb.common.report import GridReport, GridPivot, GridFieldCurrency
 from freppledb.common.report import GridFieldLastModified, GridFieldDuration
@@ -103,15 +104,12 @@ class OverviewReport(GridPivot):
 
   @classmethod
   def getUnits(reportclass, request):
-    try:
-      units = Parameter.objects.using(request.database).get(name="loading_time_units")
-      if units.value == 'hours':
-        return (1.0, _('hours'))
-      elif units.value == 'weeks':
-        return (1.0 / 168.0, _('weeks'))
-      else:
-        return (1.0 / 24.0, _('days'))
-    except Exception:
+    units = Parameter.getValue("loading_time_units", request.database)
+    if units == 'hours':
+      return (1.0, _('hours'))
+    elif units == 'weeks':
+      return (1.0 / 168.0, _('weeks'))
+    else:
       return (1.0 / 24.0, _('days'))
 
   @classmethod
@@ -124,7 +122,121 @@ class OverviewReport(GridPivot):
     # Assure the item hierarchy is up to date
     Resource.rebuildHierarchy(database=basequery.db)
 
-    # Execute the query
+    # Read the rollup of the plan export when it's available for the bucket
+    # granularity, otherwise aggregate the daily resource plans.
+    if ResourceBucketSummary.isValid(request.database, request.report_bucket, request.report_startdate, request.report_enddate):
+      query, params = reportclass.querySummary(request, basesql, baseparams, sortsql, units)
+    else:
+      query, params = reportclass.queryPlan(request, basesql, baseparams, sortsql, units)
+
+    # Build the python result
+    with connections[request.database].chunked_cursor() as cursor_chunked:
+      cursor_chunked.execute(query, params)
+      for row in cursor_chunked:
+        numfields = len(row)
+        if row[numfields-4] != 0:
+          util = row[numfields-2] * 100 / row[numfields-4]
+        else:
+          util = 0
+        result = {
+          'resource': row[0], 'description': row[1], 'category': row[2],
+          'subcategory': row[3], 'type': row[4], 'maximum': row[5],
+          'maximum_calendar': row[6], 'cost': row[7], 'maxearly': row[8],
+          'setupmatrix': row[9], 'setup': row[10],
+          'location__name': row[11], 'location__description': row[12],
+          'location__category': row[13], 'location__subcategory': row[14],
+          'location__available': row[15],
+          'avgutil': round(row[16], 2),
+          'available_calendar': row[17],
+          'owner': row[18],
+          'bucket': row[numfields-6],
+          'startdate': row[numfields-5].date(),
+          'available': round(row[numfields-4], 1),
+          'unavailable': round(row[numfields-3], 1),
+          'load': round(row[numfields-2], 1),
+          'setup': round(row[numfields-1], 1),
+          'utilization': round(util, 2)
+          }
+        idx = 17
+        for f in getAttributeFields(Resource):
+          result[f.field_name] = row[idx]
+          idx += 1
+        for f in getAttributeFields(Location):
+          result[f.field_name] = row[idx]
+          idx += 1
+        yield result
+
+  @classmethod
+  def querySummary(reportclass, request, basesql, baseparams, sortsql, units):
+    '''
+    Query on the rollup of the resource plans per bucket.
+    Buckets that are only partially in the horizon are aggregated from the
+    daily resource plans, so the result is identical to the query on the
+    daily resource plans. The average utilization is computed over the
+    same rows.
+    '''
+    query = '''
+      select res.name, res.description, res.category, res.subcategory,
+        res.type, res.maximum, res.maximum_calendar_id, res.cost, res.maxearly,
+        res.setupmatrix_id, res.setup, location.name, location.description,
+        location.category, location.subcategory, location.available_id,
+        coalesce(
+          sum(coalesce(summary.load, partial.load, 0) + coalesce(summary.setup, partial.setup, 0)) over (partition by res.name)
+          * 100.0 / greatest(sum(coalesce(summary.available, partial.available)) over (partition by res.name), 0.0001),
+          0) as avgutil,
+        res.available_id available_calendar, res.owner_id,
+        %s
+        d.bucket as col1, d.startdate as col2,
+        coalesce(summary.available, partial.available, 0) * (case when res.type = 'buckets' then 1 else %f end) as available,
+        coalesce(summary.unavailable, partial.unavailable, 0) * (case when res.type = 'buckets' then 1 else %f end) as unavailable,
+        coalesce(summary.load, partial.load, 0) * (case when res.type = 'buckets' then 1 else %f end) as loading,
+        coalesce(summary.setup, partial.setup, 0) * (case when res.type = 'buckets' then 1 else %f end) as setup
+      from (%s) res
+      left outer join location
+        on res.location_id = location.name
+      -- Multiply with buckets
+      cross join (
+                   select name as bucket, startdate, enddate,
+                     startdate >= %%s and enddate <= %%s as complete
+                   from common_bucketdetail
+                   where bucket_id = %%s and enddate > %%s and startdate < %%s
+                   ) d
+      -- Utilization info of buckets completely in the horizon
+      left outer join out_resourcebucketplan summary
+        on d.complete
+        and summary.granularity = %%s
+        and summary.resource = res.name
+        and summary.startdate = d.startdate
+      -- Utilization info of buckets partially in the horizon
+      left outer join lateral (
+          select
+            sum(out_resourceplan.available) as available,
+            sum(out_resourceplan.unavailable) as unavailable,
+            sum(out_resourceplan.load) as load,
+            sum(out_resourceplan.setup) as setup
+          from out_resourceplan
+          where not d.complete
+          and out_resourceplan.resource = res.name
+          and out_resourceplan.startdate >= greatest(d.startdate, %%s)
+          and out_resourceplan.startdate < least(d.enddate, %%s)
+          ) partial on true
+      order by %s, d.startdate
+      ''' % (
+        reportclass.attr_sql, units[0], units[0], units[0], units[0],
+        basesql, sortsql
+      )
+    return query, baseparams + (
+      request.report_startdate, request.report_enddate,  # complete
+      request.report_bucket, request.report_startdate, request.report_enddate,  # d
+      request.report_bucket,  # summary
+      request.report_startdate, request.report_enddate  # partial
+      )
+
+  @classmethod
+  def queryPlan(reportclass, request, basesql, baseparams, sortsql, units):
+    '''
+    Query on the daily resource plans.
+    '''
     query = '''
       select res.name, res.description, res.category, res.subcategory,
         res.type, res.maximum, res.maximum_calendar_id, res.cost, res.maxearly,
@@ -180,43 +292,7 @@ class OverviewReport(GridPivot):
         request.report_startdate, request.report_enddate,
         reportclass.attr_sql, sortsql
       )
-
-    # Build the python result
-    with connections[request.database].chunked_cursor() as cursor_chunked:
-      cursor_chunked.execute(query, baseparams)
-      for row in cursor_chunked:
-        numfields = len(row)
-        if row[numfields-4] != 0:
-          util = row[numfields-2] * 100 / row[numfields-4]
-        else:
-          util = 0
-        result = {
-          'resource': row[0], 'description': row[1], 'category': row[2],
-          'subcategory': row[3], 'type': row[4], 'maximum': row[5],
-          'maximum_calendar': row[6], 'cost': row[7], 'maxearly': row[8],
-          'setupmatrix': row[9], 'setup': row[10],
-          'location__name': row[11], 'location__description': row[12],
-          'location__category': row[13], 'location__subcategory': row[14],
-          'location__available': row[15],
-          'avgutil': round(row[16], 2),
-          'available_calendar': row[17],
-          'owner': row[18],
-          'bucket': row[numfields-6],
-          'startdate': row[numfields-5].date(),
-          'available': round(row[numfields-4], 1),
-          'unavailable': round(row[numfields-3], 1),
-          'load': round(row[numfields-2], 1),
-          'setup': round(row[numfields-1], 1),
-          'utilization': round(util, 2)
-          }
-        idx = 17
-        for f in getAttributeFields(Resource):
-          result[f.field_name] = row[idx]
-          idx += 1
-        for f in getAttributeFields(Location):
-          result[f.field_name] = row[idx]
-          idx += 1
-        yield result
+    return query, baseparams
 
 
 class DetailReport(OperationPlanMixin, GridReport):
@@ -288,7 +288,7 @@ class ManufacturingOrderWidget(Widget):
       db = DEFAULT_DB_ALIAS
     try:
       current = datetime.strptime(
-        Parameter.objects.using(db).get(name="currentdate").value,
+        Parameter.getValue("currentdate", db),
         "%Y-%m-%d %H:%M:%S"
         )
     except:
@@ -517,7 +517,7 @@ class DistributionOrderWidget(Widget):
       db = DEFAULT_DB_ALIAS
     try:
       current = datetime.strptime(
-        Parameter.objects.using(db).get(name="currentdate").value,
+        Parameter.getValue("currentdate", db),
         "%Y-%m-%d %H:%M:%S"
         )
     except:
@@ -750,7 +750,7 @@ class PurchaseOrderWidget(Widget):
       db = DEFAULT_DB_ALIAS
     try:
       current = datetime.strptime(
-        Parameter.objects.using(db).get(name="currentdate").value,
+        Parameter.getValue("currentdate", db),
         "%Y-%m-%d %H:%M:%S"
         )
     except: